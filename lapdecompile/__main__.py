@@ -1,22 +1,34 @@
 #!/usr/bin/env python
 from spark_parser.ast import AST
 
-from lapdecompile.scanner import LapScanner
-from lapdecompile.parser import ElispParser, ParserError
+from lapdecompile.scanner import LapScanner, MmapLapScanner
+from lapdecompile.elc import ElcReader
+from lapdecompile.parser import ParserError, new_parser, parse_segments
+from lapdecompile.prereduce import prereduce
 from lapdecompile.semantics import SourceWalker
 from lapdecompile.transform import TransformTree
 from lapdecompile.bb import basic_blocks, ingest
 from lapdecompile.cfg import ControlFlowGraph
-from lapdecompile.dominators import DominatorTree, build_df
+from lapdecompile.dominators import build_df
+from lapdecompile.simplify import simplify
 
 
 import os, sys
 import click
 
 
-def control_flow(name, instructions, show_assembly, write_cfg):
+def control_flow(name, instructions, show_assembly, write_cfg, labels=None,
+                 simplify_cfg=False, minimal_markers=False, use_regions=False):
     #  Flow control analysis of instruction
-    bblocks, instructions = basic_blocks(instructions, show_assembly)
+    bblocks, instructions = basic_blocks(instructions, show_assembly, labels)
+    if simplify_cfg:
+        # Thread jumps, drop dead code and merge blocks, then start
+        # over on what is left.
+        cfg = ControlFlowGraph(bblocks.bb_list, instructions)
+        instructions, simplified = simplify(cfg, instructions)
+        if show_assembly:
+            print(simplified)
+        bblocks, instructions = basic_blocks(instructions, show_assembly)
 
     for bb in bblocks.bb_list:
         if write_cfg:
@@ -25,11 +37,17 @@ def control_flow(name, instructions, show_assembly, write_cfg):
             print("\t", bb)
             pass
         pass
-    cfg = ControlFlowGraph(bblocks.bb_list)
+    cfg = ControlFlowGraph(bblocks.bb_list, instructions)
     try:
-        dom_tree = DominatorTree(cfg).tree()
-        dom_tree = build_df(dom_tree)
+        # Only what is needed is computed: stack heights for ingest,
+        # loops for the parser, which sees them in the flags of each
+        # token's basic block, and dominators when graphs are written.
+        heights = cfg.stack_heights()
+        cfg.loops()
+        if use_regions:
+            cfg.regions()
         if write_cfg:
+            dom_tree = build_df(cfg.dominators().tree())
             dot_path = "/tmp/flow-dom-%s.dot" % name
             png_path = "/tmp/flow-dom-%s.png" % name
             open(dot_path, "w").write(dom_tree.to_dot())
@@ -41,7 +59,8 @@ def control_flow(name, instructions, show_assembly, write_cfg):
             print("%s written" % dot_path)
             os.system("dot -Tpng %s > %s" % (dot_path, png_path))
             print("=" * 30)
-        instructions = ingest(bblocks, instructions, show_assembly)
+        instructions = ingest(bblocks, instructions, show_assembly, heights,
+                              minimal_markers)
         return instructions
     except:
         import traceback
@@ -52,84 +71,101 @@ def control_flow(name, instructions, show_assembly, write_cfg):
         return instructions
 
 
-def deparse(path, outstream, show_assembly, write_cfg, show_grammar, show_tree):
-    # Scan...
-    with open(path, "r") as fp:
-        scanner = LapScanner(fp, show_assembly=show_assembly)
-        pass
-
+def deparse(path, outstream, show_assembly, write_cfg, show_grammar, show_tree,
+            use_mmap=False, simplify_cfg=False, minimal_markers=False,
+            use_regions=False, segments=False, prereduce_exprs=False):
     import os.path as osp
 
     rc = 0
-    for fn_name, fn in scanner.fns.items():
-
-        tokens, customize = fn.tokens, fn.customize
-        name = f"{osp.basename(path)}:{fn_name}"
-        tokens = control_flow(name, tokens, show_assembly, write_cfg)
-
-        # Parse...
-        p = ElispParser(AST, tokens)
-        p.add_custom_rules(tokens, customize)
-
-        parser_debug = {
-            "rules": False,
-            "transition": False,
-            "reduce": show_grammar,
-            "errorstack": "full",
-            "dups": False,
-        }
-
-        try:
-            ast = p.parse(tokens, debug=parser_debug)
-        except ParserError as e:
-            print("file: %s\n\t %s\n" % (path, e))
-            rc = 1
-            continue
 
-        # Before transformation
-        if show_tree in ("full", "before"):
-            print(ast)
-
-        # .. and Generate Elisp
-        transformed_ast = TransformTree(ast, debug=False).traverse(ast)
-
-        if show_tree == "full":
-            print("=" * 30)
-
-        # After transformation
-        if show_tree in ("full", "after"):
-            print(ast)
-
-        formatter = SourceWalker(transformed_ast)
-        is_file = fn.fn_type == "file"
-        if is_file:
-            indent = header = ""
-        else:
-            indent = "  "
-            header = "(%s %s%s%s" % (
-                fn.fn_type,
-                fn.name,
-                fn.args,
-                fn.docstring,
-            )
-
-        # from trepan.api import debug; debug()
-        result = formatter.traverse(ast, indent)
-        result = result.rstrip()
-
-        if not header.endswith("\n") and not result.startswith("\n") or fn.interactive:
-            header += "\n"
-
-        if fn.interactive is not None:
-            outstream.write(
-                "%s%s(interactive %s)\n%s%s)"
-                % (header, indent, fn.interactive, indent, result)
-            )
-        elif is_file:
-            outstream.write("%s%s\n" % (header, result))
-        else:
-            outstream.write("%s%s%s)\n" % (header, indent, result))
+    # Scan lazily: each function is decompiled and written out as soon as
+    # the scanner has read it, and is dropped after that.
+    # Byte-compiled files are read directly; anything else is taken
+    # to be LAP text.
+    if path.endswith(".elc"):
+        scanner_class, mode = ElcReader, "rb"
+    else:
+        scanner_class = MmapLapScanner if use_mmap else LapScanner
+        mode = "r"
+    with open(path, mode) as fp:
+        scanner = scanner_class(fp, show_assembly=show_assembly, lazy=True)
+        for fn in scanner.fn_scanner():
+
+            tokens, customize = fn.tokens, fn.customize
+            name = f"{osp.basename(path)}:{fn.name}"
+            tokens = control_flow(name, tokens, show_assembly, write_cfg, fn.labels,
+                                  simplify_cfg, minimal_markers, use_regions)
+            if prereduce_exprs:
+                tokens = prereduce(AST, tokens)
+
+            # Parse...
+            parser_debug = {
+                "rules": False,
+                "transition": False,
+                "reduce": show_grammar,
+                "errorstack": "full",
+                "dups": False,
+            }
+
+            try:
+                if segments:
+                    ast = parse_segments(AST, tokens, customize, use_regions,
+                                         parser_debug)
+                else:
+                    p = new_parser(AST, tokens, use_regions, customize)
+                    ast = p.parse(tokens, debug=parser_debug)
+            except ParserError as e:
+                print("file: %s\n\t %s\n" % (path, e))
+                rc = 1
+                continue
+
+            # Before transformation
+            if show_tree in ("full", "before"):
+                print(ast)
+
+            # .. and Generate Elisp
+            transformed_ast = TransformTree(ast, debug=False).traverse(ast)
+
+            if show_tree == "full":
+                print("=" * 30)
+
+            # After transformation
+            if show_tree in ("full", "after"):
+                print(ast)
+
+            formatter = SourceWalker(transformed_ast)
+            is_file = fn.fn_type == "file"
+            if is_file:
+                indent = header = ""
+            else:
+                indent = "  "
+                header = "(%s %s%s%s" % (
+                    fn.fn_type,
+                    fn.name,
+                    fn.args,
+                    fn.docstring,
+                )
+
+            # from trepan.api import debug; debug()
+            result = formatter.traverse(ast, indent)
+            result = result.rstrip()
+
+            if not header.endswith("\n") and not result.startswith("\n") or fn.interactive:
+                header += "\n"
+
+            if fn.interactive is not None:
+                outstream.write(
+                    "%s%s(interactive %s)\n%s%s)"
+                    % (header, indent, fn.interactive, indent, result)
+                )
+            elif is_file:
+                outstream.write("%s%s\n" % (header, result))
+            else:
+                outstream.write("%s%s%s)\n" % (header, indent, result))
+                pass
             pass
+        if scanner.errors:
+            rc = 1
         pass
     return rc
 
@@ -146,16 +182,58 @@ def deparse(path, outstream, show_assembly, write_cfg, show_grammar, show_tree):
     type=click.Choice(["after", "before", "full", "none"]),
     help="Show parse tree",
 )
+@click.option(
+    "--mmap/--no-mmap",
+    default=False,
+    help="Memory-map the LAP file and scan it as bytes. Faster on very large files",
+)
+@click.option(
+    "--simplify/--no-simplify",
+    default=False,
+    help="Thread jumps, drop unreachable code and merge blocks before parsing",
+)
+@click.option(
+    "--minimal-markers/--no-minimal-markers",
+    default=False,
+    help="Add one COME_FROM per jump target, and STACK-ACCESS only where "
+    "stack depths are certain",
+)
+@click.option(
+    "--regions/--no-regions",
+    default=False,
+    help="Reject parses of control constructs that straddle single-entry "
+    "single-exit regions of the control-flow graph",
+)
+@click.option(
+    "--segments/--no-segments",
+    default=False,
+    help="Parse long function bodies in pieces, split between statements "
+    "where no jump crosses",
+)
+@click.option(
+    "--prereduce/--no-prereduce",
+    "prereduce_exprs",
+    default=False,
+    help="Build the trees of simple expressions before parsing",
+)
 @click.option("-t", "tree_alias", flag_value="after", help="alias for --tree=after")
 @click.option("-T", "tree_alias", flag_value="full", help="alias for --tree=full")
 @click.argument("lap-filename", type=click.Path(exists=True))
-def main(assembly, graphs, grammar, tree, tree_alias, lap_filename):
-    """Lisp Assembler Program (LAP) decompiler"""
+def main(assembly, graphs, grammar, tree, mmap, simplify, minimal_markers,
+         regions, segments, prereduce_exprs, tree_alias, lap_filename):
+    """Lisp Assembler Program (LAP) decompiler
+
+    LAP-FILENAME is either LAP text produced by elisp/dedis.el or an
+    Emacs bytecode file ending in .elc.
+    """
     if tree_alias:
         tree = tree_alias
     sys.exit(deparse(lap_filename, sys.stdout, show_assembly=assembly,
                      write_cfg=graphs,
-                     show_grammar=grammar, show_tree=tree))
+                     show_grammar=grammar, show_tree=tree, use_mmap=mmap,
+                     simplify_cfg=simplify, minimal_markers=minimal_markers,
+                     use_regions=regions, segments=segments,
+                     prereduce_exprs=prereduce_exprs))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+  Analysis manager
+
+  Keeps the facts computed about a control-flow graph, such as its
+  dominator tree, so that each is computed only when something asks
+  for it, and only once until the graph changes.
+"""
+
+
+class AnalysisManager(object):
+    """
+      Analyses of the ControlFlowGraph "cfg", by name.
+
+      An analysis is a function of the cfg registered under a name.
+      get() runs it the first time its result is asked for and then
+      returns the cached result. Analyses that are asked for while
+      another one runs are recorded as what it depends on, so that
+      invalidating one also invalidates everything computed from it.
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.analyses = {}
+        self.results = {}
+        # Analysis name -> names of the cached analyses that used it
+        self.dependents = {}
+        # The analyses being computed, innermost last
+        self.running = []
+
+    def register(self, name, analysis):
+        """Make "analysis", a function taking the cfg, available as
+        "name". Any cached result for "name" is dropped."""
+        self.invalidate(name)
+        self.analyses[name] = analysis
+
+    def get(self, name):
+        """Return the result of analysis "name", computing it if needed"""
+        if self.running:
+            self.dependents.setdefault(name, set()).add(self.running[-1])
+        if name in self.results:
+            return self.results[name]
+        if name not in self.analyses:
+            raise KeyError("no analysis named %s" % name)
+        if name in self.running:
+            raise RuntimeError("analysis %s depends on itself" % name)
+        self.running.append(name)
+        try:
+            result = self.analyses[name](self.cfg)
+        finally:
+            self.running.pop()
+        self.results[name] = result
+        return result
+
+    def cached(self, name):
+        """Has analysis "name" been computed?"""
+        return name in self.results
+
+    def invalidate(self, name=None):
+        """Drop the result of analysis "name" and of those computed
+        from it, or of all analyses if "name" is None. Use this after
+        changing the cfg."""
+        if name is None:
+            self.results.clear()
+            self.dependents.clear()
+            return
+        stack = [name]
+        while stack:
+            name = stack.pop()
+            self.results.pop(name, None)
+            stack.extend(self.dependents.pop(name, ()))
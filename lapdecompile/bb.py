@@ -1,15 +1,18 @@
 from lapdecompile.graph import BB_ENTRY, BB_JUMP_UNCONDITIONAL, BB_NOFOLLOW
 from lapdecompile.tok import Token
-from lapdecompile.stack_effect import STACK_EFFECT, STACK_EFFECTS
+from lapdecompile.stack_effect import (
+    CONDITIONAL_POP,
+    OP_COME_FROM,
+    OP_STACK_ACCESS,
+    STACK_EFFECT,
+    STACK_POP,
+)
 
 
 def compute_stack_change(instructions):
     stack_change = 0
     for instr in instructions:
-        stack_effect = STACK_EFFECT[instr.kind.lower()]
-        if isinstance(stack_effect, tuple):
-            stack_effect = stack_effect[0]
-        stack_change += stack_effect
+        stack_change += STACK_EFFECT[instr.op]
 
     # For debugging:
     # if len(instructions) > 0 and instructions[0].bb:
@@ -21,6 +24,19 @@ def compute_stack_change(instructions):
     return stack_change
 
 
+def stack_change_prefix(instructions):
+    """Return the list of cumulative stack effects of "instructions":
+    entry k is compute_stack_change(instructions[:k]), so the stack
+    change of instructions[first:last] is the difference of two
+    entries."""
+    prefix = [0]
+    stack_change = 0
+    for instr in instructions:
+        stack_change += STACK_EFFECT[instr.op]
+        prefix.append(stack_change)
+    return prefix
+
+
 class BasicBlock(object):
     """Represents a basic block (or rather extended basic block) from the
     bytecode. It's a bit more than just the a continuous range of the
@@ -39,12 +55,19 @@ class BasicBlock(object):
         stack_effect,
         flags=set(),
         jump_offsets=set([]),
+        start_index=None,
+        end_index=None,
     ):
 
         # The offset of the first and last instructions of the basic block.
         self.start_offset = start_offset
         self.end_offset = end_offset
 
+        # The block's instructions are instructions[start_index:end_index]
+        # in the list given to basic_blocks().
+        self.start_index = start_index
+        self.end_index = end_index
+
         # The follow offset is just the offset that follows the last
         # offset of this basic block. It is None in the very last
         # basic block. Note that the the block that follows isn't
@@ -56,12 +79,14 @@ class BasicBlock(object):
         self.follow_offset = follow_offset
 
         # The stack effect is how this basic block changes the evaluations stack
+        # when it falls through to the next block.
         # usually it is a net 0 effect but there can be disparity when combined with
         # various large compound structures. (The compounds then have a net effect 0)
-        # cumulative_stack_effect takes into account the stack_effect coming into the
-        # block. We assume that different branches into the block will have the same
-        # stack_effect value.
-        self.cumulative_stack_effect = self.stack_effect = stack_effect
+        self.stack_effect = stack_effect
+
+        # The stack depths on entry to the block and when it falls through.
+        # These are filled in by stack_height.StackHeights.
+        self.entry_depth = self.exit_depth = None
 
         # Jump offsets is the targets of all of the jump instructions
         # inside the basic block. Note that jump offsets can come from
@@ -73,13 +98,22 @@ class BasicBlock(object):
         self.flags = flags
         self.index = (start_offset, end_offset)
 
-        # Lists of predecessor and successor bacic blocks
-        # This is computed in cfg.
-        self.predecessors = set([])
-        self.successors = set([])
-
         # Set true if this is dead code, or unureachable
         self.unreachable = False
+
+        # The header block number of the innermost loop the block is
+        # in, or None, and how many loops it is in. These are filled
+        # in by loops.LoopForest.
+        self.loop_header = None
+        self.loop_depth = 0
+
+        # The smallest single-entry single-exit region the block is in,
+        # if regions.Regions has been computed and there is one.
+        self.region = None
+
+        # The block's node number in the control-flow graph. Its
+        # predecessors and successors are found there.
+        # This is computed in cfg.
         self.number = None
 
     # A nice print routine for a Basic block
@@ -124,153 +158,102 @@ class BBMgr(object):
         self.jumps2offset = {}
         self.jump_targets = {}
 
-    @staticmethod
-    def offset_convert(offset):
-        if isinstance(offset, int):
-            return offset
-        assert isinstance(offset, str)
-        if offset.isdigit():
-            return int(offset)
-        else:
-            return int(offset[: offset.find(":")])
-
     def add_bb(
-        self, start_offset, end_offset, follow_offset, flags, jump_offsets, instructions
+        self,
+        instructions,
+        start_index,
+        end_index,
+        follow_offset,
+        flags,
+        jump_offsets,
+        stack_effect,
     ):
-
-        stack_effect = 0
-        j = 0
-        offset = instructions[j].offset
-        while self.offset_convert(offset) < start_offset:
-            j += 1
-            offset = instructions[j].offset
-        n = len(instructions)
-        while self.offset_convert(offset) <= end_offset:
-            instr = instructions[j]
-
-            offset = instructions[j].offset
-            stack_change = STACK_EFFECT[instr.kind.lower()]
-            if isinstance(stack_change, tuple):
-                assert self.offset_convert(offset) == end_offset
-                stack_effect = (
-                    stack_effect + stack_change[0],
-                    stack_effect + stack_change[1],
-                )
-                break
-            else:
-                assert isinstance(stack_change, int)
-                stack_effect += stack_change
-            instr.block_stack_effect = stack_effect
-            j += 1
-            if j == n:
-                break
-
+        """Add the basic block made up of instructions[start_index:end_index],
+        and point those instructions at it."""
         bb = BasicBlock(
-            start_offset,
-            end_offset,
+            instructions[start_index].offset,
+            instructions[end_index - 1].offset,
             follow_offset,
             stack_effect=stack_effect,
             flags=flags,
             jump_offsets=jump_offsets,
+            start_index=start_index,
+            end_index=end_index,
         )
-        for inst in instructions:
-            inst.bb = bb
+        for i in range(start_index, end_index):
+            instructions[i].bb = bb
         self.bb_list.append(bb)
-        self.start_offsets[start_offset] = bb
-        self.end_offsets[end_offset] = bb
-        start_offset = end_offset
-        flags = set([])
-        jump_offsets = set([])
-        return flags, jump_offsets, stack_effect
-
-
-def get_offset(inst):
-    offset = inst.offset
-    if isinstance(offset, int):
-        return offset
-    if offset.find(":") > -1:
-        offset = offset[: offset.find(":")]
-    # try:
-    #   int(offset)
-    # except:
-    #   from trepan.api import debug; debug()
-    return int(offset)
-
-
-def basic_blocks(instructions, show_assembly):
-    """Create a list of basic blocks found in a code object
+        self.start_offsets[bb.start_offset] = bb
+        self.end_offsets[bb.end_offset] = bb
+        return bb
+
+
+def basic_blocks(instructions, show_assembly, labels=None):
+    """Create a list of basic blocks found in a code object.
+    "labels" maps label numbers to the index of their LABEL
+    instruction, as in Func.labels; if it is not given it is
+    computed from "instructions".
+
+    Besides splitting the instructions into blocks, this sets each
+    instruction's "bb" and "block_stack_effect". All of this is done
+    in one pass over the instructions once the jump targets are known.
     """
 
     bblocks = BBMgr()
-    bblocks.label2offset = {}
-    bblocks.jumps2offset = {}
 
-    # Populate label2offset map
-    for i, inst in enumerate(instructions):
-        op = inst.kind
-        offset = get_offset(inst)
-        if op == "LABEL":
-            bblocks.label2offset[inst.attr[1:]] = offset
-            pass
-        pass
+    if labels is None:
+        labels = {
+            inst.attr: i for i, inst in enumerate(instructions) if inst.kind == "LABEL"
+        }
+    label2offset = bblocks.label2offset = {
+        label: instructions[i].offset for label, i in labels.items()
+    }
 
     # Get jump targets
-    jump_targets = set()
-    bblocks.jumps2offset = {}
+    jumps2offset = bblocks.jumps2offset
     for inst in instructions:
-        op = inst.kind
-        offset = get_offset(inst)
-
-        if op in JUMP_INSTRUCTIONS:
-            jump_offset = bblocks.label2offset[inst.attr]
-            jump_targets.add(jump_offset)
-            if jump_offset not in bblocks.jumps2offset:
-                bblocks.jumps2offset[jump_offset] = [offset]
+        if inst.kind in JUMP_INSTRUCTIONS:
+            jump_offset = label2offset[inst.attr]
+            if jump_offset not in jumps2offset:
+                jumps2offset[jump_offset] = [inst.offset]
             else:
-                bblocks.jumps2offset[jump_offset].append(offset)
+                jumps2offset[jump_offset].append(inst.offset)
             pass
 
-    new_instructions = []
-    start_offset = 0
-    end_offset = -1
+    n = len(instructions)
+    start_index = 0
+    start_offset = instructions[0].offset if n else 0
     jump_offsets = set()
-    prev_offset = -1
-    endloop_offsets = [-1]
     flags = set([BB_ENTRY])
+
+    # The stack effect of the instructions so far in the current block
     stack_effect = 0
 
     for i, inst in enumerate(instructions):
-        prev_offset = end_offset
-        end_offset = get_offset(inst)
-        op = inst.kind
-        offset = get_offset(inst)
-        if i + 1 < len(instructions):
-            follow_offset = get_offset(instructions[i + 1])
-        else:
-            follow_offset = get_offset(instructions[i]) + 1
-
-        if offset == endloop_offsets[-1]:
-            endloop_offsets.pop()
-        pass
+        offset = inst.offset
 
-        if offset in jump_targets:
+        if offset in jumps2offset and start_offset < offset:
             # Fallthrough path and jump target path.
             # This instruction definitely starts a new basic block
             # Close off any prior basic block
-            if start_offset < end_offset:
-
-                flags, jump_offsets, stack_effect = bblocks.add_bb(
-                    start_offset,
-                    prev_offset,
-                    end_offset,
-                    flags,
-                    jump_offsets,
-                    instructions,
-                )
-                start_offset = end_offset
+            bblocks.add_bb(
+                instructions,
+                start_index,
+                i,
+                offset,
+                flags,
+                jump_offsets,
+                stack_effect,
+            )
+            start_index, start_offset = i, offset
+            flags, jump_offsets, stack_effect = set(), set(), 0
+
+        stack_effect += STACK_EFFECT[inst.op]
+        inst.block_stack_effect = stack_effect
 
         # Add block flags for certain classes of instructions
-        if op in JUMP_INSTRUCTIONS:
+        kind = inst.kind
+        if kind in JUMP_INSTRUCTIONS:
             # Some sort of jump instruction.
             # While in theory an absolute jump could be part of the
             # same (extened) basic block, for our purposes we would like to
@@ -279,107 +262,107 @@ def basic_blocks(instructions, show_assembly):
 
             # Figure out where we jump to amd add it to this
             # basic block's jump offsets.
-            jump_offset = bblocks.label2offset[inst.attr]
-
-            jump_offsets.add(jump_offset)
-            if op in JUMP_UNCONDITONAL:
+            jump_offsets.add(label2offset[inst.attr])
+            if kind in JUMP_UNCONDITONAL:
                 flags.add(BB_JUMP_UNCONDITIONAL)
                 pass
-            flags, jump_offsets, stack_effect = bblocks.add_bb(
-                start_offset,
-                end_offset,
-                follow_offset,
-                flags,
-                jump_offsets,
-                instructions,
-            )
-            start_offset = follow_offset
-        elif op in NOFOLLOW_INSTRUCTIONS:
+        elif kind in NOFOLLOW_INSTRUCTIONS:
             flags.add(BB_NOFOLLOW)
-            flags, jump_offsets, stack_effect = bblocks.add_bb(
-                start_offset,
-                end_offset,
-                follow_offset,
-                flags,
-                jump_offsets,
-                instructions,
-            )
-            start_offset = follow_offset
-            pass
-        new_instructions.append(inst)
-        pass
-    instructions = new_instructions
+        else:
+            continue
 
-    if show_assembly and instructions != new_instructions:
-        print("-" * 40)
-        for i in new_instructions:
-            print(i)
+        follow_offset = instructions[i + 1].offset if i + 1 < n else offset + 1
+        bblocks.add_bb(
+            instructions,
+            start_index,
+            i + 1,
+            follow_offset,
+            flags,
+            jump_offsets,
+            stack_effect,
+        )
+        start_index, start_offset = i + 1, follow_offset
+        flags, jump_offsets, stack_effect = set(), set(), 0
+        pass
 
+    if start_index < n:
+        bblocks.add_bb(
+            instructions,
+            start_index,
+            n,
+            None,
+            flags,
+            jump_offsets,
+            stack_effect,
+        )
     if len(bblocks.bb_list):
         bblocks.bb_list[-1].follow_offset = None
-    if start_offset <= end_offset:
-        bblocks.bb_list.append(
-            BasicBlock(
-                start_offset,
-                end_offset,
-                None,
-                stack_effect=stack_effect,
-                flags=flags,
-                jump_offsets=jump_offsets,
-            )
-        )
 
     return bblocks, instructions
 
 
 # Add Markers for stack access, and control-flow markers
 # This needs to be done *after* control flow analysis and
-# dominator information has been performed
-def ingest(bblocks, instructions, show_assembly):
-    last_offset = -1
+# stack heights have been computed.
+def ingest(bblocks, instructions, show_assembly, heights, minimal=False):
+    """Return "instructions" with COME_FROM markers added before jump
+    targets, and STACK-ACCESS markers added before instructions that
+    use values pushed before the start of their basic block.
+    "heights" is the stack_height.StackHeights for the instructions.
+
+    If "minimal" is set, fewer markers are added: a jump target gets
+    a single COME_FROM whose attr is the tuple of jump offsets, so its
+    count is the number of jumps to it, and there are no STACK-ACCESS
+    markers in blocks whose stack depth isn't known for sure, that is
+    unreachable blocks and those reached with different depths.
+    """
     new_instructions = []
-    # stack_size = 0
-    stack_effect = 0
-    for i, inst in enumerate(instructions):
-        offset = get_offset(inst)
-        if offset != last_offset:
-            sources = bblocks.jumps2offset.get(offset, [])
-            for source in sorted(sources, reverse=True):
-                new_instructions.append(Token("COME_FROM", source, offset))
-                pass
-            last_offset = offset
-        if offset in bblocks.start_offsets:
-            bb = bblocks.start_offsets[offset]
-
-            # if isinstance(bb.cumulative_stack_effect, int):
-            #     cumulative_effect = bb.cumulative_stack_effect
-            # else:
-            #     cumulative_effect = bb.cumulative_stack_effect[0]
-
-            # if isinstance(bb.stack_effect, int):
-            #     stack_effect = bb.stack_effect
-            # else:
-            #     stack_effect = bb.stack_effect[0]
-            # stack_size + cumulative_effect - stack_effect
-            stack_effect = 0
-
-        read_write = STACK_EFFECTS[inst.kind.lower()]
-        if isinstance(read_write[0], int):
-            # stack_size += read_write[0]
-            stack_effect += read_write[0]
-            # FIXME we need a more rigorous way to figure out if we should add STACK-ACCESS.
-            # The heuristic below is that if the stacked parameters are part of a call
-            # then parsing will pick up the parameters from instruction where the stacking occurs
-            # Testing on RETURN is kind of a hack.
-            if (stack_effect < 0 and not
-                (inst.kind.startswith("CALL_") or inst.kind in
-                 ("DISCARD", "RETURN", "UNBIND"))):
-                for j in range(stack_effect, 0):
-                    new_instructions.append(Token("STACK-ACCESS", -j, offset))
-                stack_effect = 0
-            # stack_size += read_write[1]
-            stack_effect += read_write[1]
-        new_instructions.append(inst)
+    jumps2offset = bblocks.jumps2offset
+    before = heights.before
+    unproven = heights.unreachable | heights.conflicts
+    last_offset = -1
+    for b, bb in enumerate(bblocks.bb_list):
+        # The lowest the stack has been in this block, not counting
+        # the operands of instructions that are expected to reach
+        # into earlier blocks.
+        floor = heights.entry[b]
+        stack_access = not (minimal and b in unproven)
+        for i in range(bb.start_index, bb.end_index):
+            inst = instructions[i]
+            offset = inst.offset
+            if offset != last_offset:
+                sources = jumps2offset.get(offset)
+                if sources is not None:
+                    sources = sorted(sources, reverse=True)
+                    if minimal:
+                        new_instructions.append(
+                            Token("COME_FROM", tuple(sources), offset, OP_COME_FROM)
+                        )
+                    else:
+                        for source in sources:
+                            new_instructions.append(
+                                Token("COME_FROM", source, offset, OP_COME_FROM)
+                            )
+                last_offset = offset
+
+            op = inst.op
+            if stack_access and op not in CONDITIONAL_POP:
+                depth = before[i] + STACK_POP[op]
+                # FIXME we need a more rigorous way to figure out if we should add STACK-ACCESS.
+                # The heuristic below is that if the stacked parameters are part of a call
+                # then parsing will pick up the parameters from instruction where the stacking occurs
+                # Testing on RETURN is kind of a hack.
+                if (depth < floor and not
+                    (inst.kind.startswith("CALL_") or inst.kind in
+                     ("DISCARD", "RETURN", "UNBIND"))):
+                    # Nothing below the bottom of the stack can be accessed.
+                    depth = max(depth, 0)
+                    for j in range(depth - floor, 0):
+                        new_instructions.append(
+                            Token("STACK-ACCESS", -j, offset, OP_STACK_ACCESS)
+                        )
+                    floor = depth
+            new_instructions.append(inst)
 
     if show_assembly and instructions != new_instructions:
         print("-" * 40)
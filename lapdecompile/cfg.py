@@ -1,36 +1,168 @@
-from operator import attrgetter
+from lapdecompile.analysis import AnalysisManager
 from lapdecompile.dominators import DominatorTree
-from lapdecompile.graph import DiGraph, jump_flags, BB_LOOP, BB_NOFOLLOW
+from lapdecompile.loops import LoopForest
+from lapdecompile.regions import Regions
+from lapdecompile.stack_height import StackHeights
+from lapdecompile.graph import (
+    CSRGraph,
+    DiGraph,
+    jump_flags,
+    BB_LOOP,
+    BB_NOFOLLOW,
+    EDGE_BACKWARD,
+    EDGE_EXIT,
+    EDGE_FALLTHROUGH,
+    EDGE_FOLLOW,
+    EDGE_FORWARD,
+    EDGE_FORWARD_SCOPE,
+    EDGE_NO_FALLTHROUGH,
+    EDGE_SELF_LOOP,
+)
 
 
 class ControlFlowGraph(object):
     """
     Performs the control-flow analysis on a ``Declaration`` object. It iterates
     over its bytecode and builds the basic block. The final representation
-    leverages the ``DiGraph`` structure, and contains an instance of the
-    ``DominatorTree``.
+    leverages the ``CSRGraph`` structure, with blocks numbered by their
+    position in ``blocks``, and contains an instance of the ``DominatorTree``.
   """
 
-    def __init__(self, blocks):
+    def __init__(self, blocks, instructions=None):
         self.blocks = blocks
-        self.block_offset_map = {}
-        self.block_nodes = {}
-        self.graph = None
+        # The instructions the blocks index into; needed for stack heights
+        self.instructions = instructions
+        self.block_offsets = {}
+        self._graph = None
+        self.csr = None
         self.entry_node = None
-        self.dom = None
-        self.cdg = None
+        self.analyses = AnalysisManager(self)
+        for name, analysis in ANALYSES.items():
+            self.analyses.register(name, analysis)
         self.analyze(blocks)
 
-    def dominators(self, blocks):
+    # The analyses below are computed the first time they are asked
+    # for, and kept until the graph is rebuilt.
+
+    def dominators(self, blocks=None):
         """
       Returns the ``DominatorTree`` that contains:
        - Dominator tree (dict of IDom)
        - Dominance frontier (dict of CFG node -> set CFG nodes)
-      This is lazily computed.
     """
-        if self.dom is None:
-            self.dom = DominatorTree(self)
-        return self.dom
+        return self.analyses.get("dominators")
+
+    def dominance_frontiers(self):
+        """
+      Returns the dominance frontier of each block, as a list of sets
+      of block numbers indexed by block number.
+    """
+        return self.analyses.get("dominance-frontiers")
+
+    def post_dominators(self):
+        """
+      Returns the post-dominator ``DominatorTree``: the dominator tree of
+      the reverse CFG, rooted at a virtual exit block numbered
+      len(self.blocks). Blocks with no successors, like those ending in a
+      return, lead to the exit. So that every block has a post-dominator,
+      blocks that can't reach the exit, such as the ones of an infinite
+      loop, are given an edge to it too.
+    """
+        return self.analyses.get("post-dominators")
+
+    def control_dependence(self):
+        """
+      Returns the control-dependence graph as a ``CSRGraph`` on block
+      numbers. It has an edge from block a to block b when taking some
+      edge out of a makes b sure to run, but b needn't run after a. The
+      edge has the kind of that CFG edge, so it tells which way a
+      branches for b to run. Blocks that run whenever the function does
+      depend on no block.
+    """
+        return self.analyses.get("control-dependence")
+
+    def loops(self):
+        """
+      Returns the ``LoopForest`` of the CFG. Computing it marks loop
+      headers, latches and exits in the blocks' flags.
+    """
+        return self.analyses.get("loops")
+
+    def regions(self):
+        """
+      Returns the ``Regions``: the single-entry single-exit regions of
+      the CFG. Computing them sets each block's "region".
+    """
+        return self.analyses.get("regions")
+
+    def stack_heights(self):
+        """
+      Returns the ``StackHeights`` of the instructions given to the
+      constructor.
+    """
+        return self.analyses.get("stack-heights")
+
+    def reachable(self):
+        """
+      Returns a bytearray indexed by block number that is 1 for the
+      blocks reachable from the entry block.
+    """
+        return self.analyses.get("reachability")
+
+    def build_post_dominators(self):
+        graph, exit = self.reverse_flowgraph()
+        return DominatorTree(self, graph=graph, root=exit)
+
+    def build_control_dependence(self):
+        pdom = self.post_dominators()
+        ipdom = pdom.idom
+        edges = []
+        for a, b, kind in self.csr.edges():
+            if pdom.strictly_dominates(b, a):
+                continue
+            # b and its post-dominators up to, but not including,
+            # the post-dominator of a depend on a.
+            stop = ipdom[a]
+            while b != stop:
+                edges.append((a, b, kind))
+                b = ipdom[b]
+        return CSRGraph(len(self.blocks), edges, self.blocks)
+
+    def build_reachability(self):
+        reachable = bytearray(len(self.blocks))
+        for b in self.csr.dfs_preorder(self.entry_node.number):
+            reachable[b] = 1
+        return reachable
+
+    def reverse_flowgraph(self):
+        """Returns the reverse of the CFG with a virtual exit node added,
+        and the exit node's number. See post_dominators()."""
+        csr = self.csr
+        n = csr.n
+        exit = n
+        edges = [(dest, source, kind) for source, dest, kind in csr.edges()]
+
+        # Walk back from each block given an exit edge, marking the
+        # blocks that reach it. Blocks with no successors come first;
+        # after that, take the last block that isn't marked yet.
+        reaches_exit = bytearray(n)
+        succ_start, pred, pred_start = csr.succ_start, csr.pred, csr.pred_start
+        starts = [b for b in range(n) if succ_start[b] == succ_start[b + 1]]
+        starts.extend(range(n - 1, -1, -1))
+        for b in starts:
+            if reaches_exit[b]:
+                continue
+            edges.append((exit, b, EDGE_EXIT))
+            reaches_exit[b] = 1
+            stack = [b]
+            while stack:
+                v = stack.pop()
+                for i in range(pred_start[v], pred_start[v + 1]):
+                    p = pred[i]
+                    if not reaches_exit[p]:
+                        reaches_exit[p] = 1
+                        stack.append(p)
+        return CSRGraph(n + 1, edges), exit
 
     def analyze(self, blocks):
         """
@@ -39,81 +171,99 @@ class ControlFlowGraph(object):
       """
         self.entry = blocks[0]
         self.build_flowgraph(blocks)
+        self.analyses.invalidate()
 
     def build_flowgraph(self, blocks):
-        g = DiGraph()
+        """Number the blocks by their position in "blocks" and build
+        the CSRGraph of control flow between them in self.csr. Blocks
+        with no predecessors other than themselves are marked
+        unreachable."""
+        assert len(blocks) > 0
+        self.block_offsets = block_offsets = {}
+        for i, block in enumerate(blocks):
+            block.number = i
+            block_offsets[block.start_offset] = block
+        self.entry_node = blocks[0]
 
-        self.block_offsets = {}
-        self.block_nodes = {}
-
-        # Add nodes
-        for block in self.blocks:
-            self.block_offsets[block.start_offset] = block
-            block_node = g.make_add_node(block)
-            self.block_nodes[block] = block_node
-
-        # Compute a block's immediate predecessors and successors
-        for block in self.blocks:
-            for jump_offset in block.jump_offsets:
-                try:
-                    assert jump_offset in self.block_offsets
-                except:
-                    from trepan.api import debug
-
-                    debug()
-                    x = 1
-                successor_block = self.block_offsets[jump_offset]
-                successor_block.predecessors.add(block)
-                block.successors.add(successor_block)
+        edges = []
+        for block in blocks:
+            b = block.number
+            for jump_offset in sorted(block.jump_offsets):
+                assert jump_offset in block_offsets
+                target = block_offsets[jump_offset].number
+                if target == b:
+                    kind = EDGE_SELF_LOOP
+                elif jump_offset > block.start_offset:
+                    if BB_LOOP in block.flags:
+                        kind = EDGE_FORWARD_SCOPE
+                    else:
+                        kind = EDGE_FORWARD
+                else:
+                    kind = EDGE_BACKWARD
+                edges.append((b, target, kind))
             if block.follow_offset and (
                 not (jump_flags & block.flags or (BB_NOFOLLOW in block.flags))
             ):
-                assert block.follow_offset in self.block_offsets
-                successor_block = self.block_offsets[block.follow_offset]
-                successor_block.predecessors.add(block)
-                block.successors.add(successor_block)
-
-        assert len(self.blocks) > 0
-        self.entry_node = self.blocks[0]
+                assert block.follow_offset in block_offsets
+                edges.append(
+                    (b, block_offsets[block.follow_offset].number, EDGE_FALLTHROUGH)
+                )
 
-        sorted_blocks = sorted(self.blocks, key=attrgetter("index"))
-        for i, block in enumerate(sorted_blocks):
+        self.csr = csr = CSRGraph(len(blocks), edges, blocks)
 
-            # Is this this dead code? (Remove self loops in calculation)
-            # Entry node, blocks[0] is never unreachable
-            if not block.predecessors - set([block]) and block != blocks[0]:
+        # Is this this dead code? (Remove self loops in calculation)
+        # Entry node, blocks[0] is never unreachable
+        for block in blocks[1:]:
+            b = block.number
+            for p in csr.predecessors(b):
+                if p != b:
+                    break
+            else:
                 block.unreachable = True
+        return
 
-            block = sorted_blocks[i]
-            if block.follow_offset:
-                if BB_NOFOLLOW in block.flags:
-                    kind = "no fallthrough"
-                else:
-                    kind = "fallthrough"
-                g.make_add_edge(
-                    self.block_nodes[block],
-                    self.block_nodes[self.block_offsets[block.follow_offset]],
-                    kind,
-                )
-            # Connect the current block to its jump targets
-            for jump_index in block.jump_offsets:
-                target_block = self.block_offsets[jump_index]
-                if jump_index > block.start_offset:
-                    if BB_LOOP in block.flags:
-                        edge_type = "forward_scope"
+    @property
+    def graph(self):
+        """A DiGraph of Node and Edge objects for the blocks. Besides
+        control-flow edges it has "follow" and "no fallthrough" edges to
+        the next block, which are used in laying out a drawing of it.
+        It is built the first time it is asked for."""
+        if self._graph is None:
+            g = DiGraph()
+            blocks = self.blocks
+            nodes = [g.make_add_node(block) for block in blocks]
+            csr, block_offsets = self.csr, self.block_offsets
+            for block in blocks:
+                b = block.number
+                if block.follow_offset:
+                    if BB_NOFOLLOW in block.flags:
+                        kind = EDGE_NO_FALLTHROUGH
+                    elif jump_flags & block.flags:
+                        kind = EDGE_FOLLOW
                     else:
-                        edge_type = "forward"
-                else:
-                    edge_type = "backward"
+                        kind = None
+                    if kind is not None:
+                        follow_block = block_offsets[block.follow_offset]
+                        g.make_add_edge(nodes[b], nodes[follow_block.number], kind)
+                for i in range(csr.succ_start[b], csr.succ_start[b + 1]):
+                    kind = csr.succ_kind[i]
+                    if kind == EDGE_FORWARD and BB_LOOP in block.flags:
+                        # Loop headers may have been found since the
+                        # CSR graph was built.
+                        kind = EDGE_FORWARD_SCOPE
+                    g.make_add_edge(nodes[b], nodes[csr.succ[i]], kind)
+            self._graph = g
+        return self._graph
 
-                if self.block_nodes[target_block] == self.block_nodes[block]:
-                    edge_type = "self-loop"
 
-                g.make_add_edge(
-                    self.block_nodes[block], self.block_nodes[target_block], edge_type
-                )
-                pass
-            pass
-
-        self.graph = g
-        return
+# The analyses every ControlFlowGraph starts with
+ANALYSES = {
+    "dominators": DominatorTree,
+    "dominance-frontiers": lambda cfg: cfg.dominators().frontiers(),
+    "post-dominators": ControlFlowGraph.build_post_dominators,
+    "control-dependence": ControlFlowGraph.build_control_dependence,
+    "loops": LoopForest,
+    "regions": Regions,
+    "stack-heights": lambda cfg: StackHeights(cfg, cfg.instructions),
+    "reachability": ControlFlowGraph.build_reachability,
+}
@@ -6,91 +6,270 @@
   Copyright (c) 2014 by Romain Gaucher (@rgaucher)
 """
 
-from lapdecompile.graph import TreeGraph, BB_ENTRY
-from lapdecompile.traversals import dfs_postorder_nodes
+from array import array
+
+from lapdecompile.graph import TreeGraph, BB_ENTRY, EDGE_DOM
+from lapdecompile.traversals import dfs_tree
+
+
+def iterative_dominators(graph, entry):
+    """
+      Immediate dominators by the iterative algorithm of:
+        http://www.cs.rice.edu/~keith/Embed/dom.pdf
+
+      "graph" is a CSRGraph and "entry" a node number in it. The
+      immediate dominators are returned as an array indexed by node
+      number. The entry is its own immediate dominator, and -1 is
+      used for nodes that aren't reachable from "entry".
+    """
+    doms = array("i", [-1]) * graph.n
+    doms[entry] = entry
+    post_order = graph.dfs_postorder(entry)
+    reverse_post_order = graph.reverse_postorder(entry)
+
+    post_order_number = array("i", [-1]) * graph.n
+    for i, n in enumerate(post_order):
+        post_order_number[n] = i
+
+    def intersec(finger1, finger2):
+        while finger1 != finger2:
+            while post_order_number[finger1] < post_order_number[finger2]:
+                finger1 = doms[finger1]
+            while post_order_number[finger2] < post_order_number[finger1]:
+                finger2 = doms[finger2]
+        return finger1
+
+    pred, pred_start = graph.pred, graph.pred_start
+    changed = True
+    while changed:
+        changed = False
+        for b in reverse_post_order:
+            if b == entry:
+                continue
+            # Only predecessors that have been processed count; the
+            # first one found starts the intersection.
+            new_idom = -1
+            for i in range(pred_start[b], pred_start[b + 1]):
+                p = pred[i]
+                if doms[p] < 0:
+                    continue
+                if new_idom < 0:
+                    new_idom = p
+                elif p != new_idom:
+                    new_idom = intersec(p, new_idom)
+            if doms[b] != new_idom:
+                doms[b] = new_idom
+                changed = True
+    return doms
+
+
+def semi_nca_dominators(graph, entry):
+    """
+      Immediate dominators by the Semi-NCA algorithm of Georgiadis,
+      "Linear-Time Algorithms for Dominators and Related Problems"
+      (Princeton, 2005): semidominators are found as in Lengauer and
+      Tarjan, "A Fast Algorithm for Finding Dominators in a
+      Flowgraph", and immediate dominators are then found as nearest
+      common ancestors in the DFS tree.
+
+      This takes near-linear time however the graph is shaped,
+      while iterative_dominators() can need many passes over
+      irreducible graphs. The arguments and result are the same as
+      for iterative_dominators().
+    """
+    # Number the nodes in DFS preorder, remembering each one's DFS
+    # tree parent. From here on nodes are referred to by that number.
+    vertex, parent = dfs_tree(graph, entry)
+    number = array("i", [-1]) * graph.n
+    for i, node in enumerate(vertex):
+        number[node] = i
+
+    n = len(vertex)
+    semi = array("i", range(n))
+    label = array("i", range(n))
+    # The forest built by linking processed nodes to their DFS parents.
+    ancestor = array("i", [-1]) * n
+    idom = array("i", parent)
+
+    def evaluate(v):
+        # The node with the smallest semidominator on the forest path
+        # from v up to, but not including, its root. Nodes on the
+        # path are relinked closer to the root on the way.
+        if ancestor[v] < 0:
+            return v
+        path = []
+        u = v
+        while ancestor[ancestor[u]] >= 0:
+            path.append(u)
+            u = ancestor[u]
+        while path:
+            u = path.pop()
+            a = ancestor[u]
+            if semi[label[a]] < semi[label[u]]:
+                label[u] = label[a]
+            ancestor[u] = ancestor[a]
+        return label[v]
+
+    pred, pred_start = graph.pred, graph.pred_start
+    for w in range(n - 1, 0, -1):
+        node = vertex[w]
+        for i in range(pred_start[node], pred_start[node + 1]):
+            v = number[pred[i]]
+            if v < 0:
+                # Not reachable from the entry
+                continue
+            u = evaluate(v)
+            if semi[u] < semi[w]:
+                semi[w] = semi[u]
+        ancestor[w] = parent[w]
+
+    for w in range(1, n):
+        d = idom[w]
+        while d > semi[w]:
+            d = idom[d]
+        idom[w] = d
+
+    doms = array("i", [-1]) * graph.n
+    doms[entry] = entry
+    for w in range(1, n):
+        doms[vertex[w]] = vertex[idom[w]]
+    return doms
+
+
+ENGINES = {
+    "iterative": iterative_dominators,
+    "semi-nca": semi_nca_dominators,
+}
 
 
 class DominatorTree(object):
     """
       Handles the dominator trees (dominator/post-dominator), and the
       computation of the dominance/post-dominance frontier.
+
+      "engine" names the algorithm used to find immediate dominators;
+      it is a key of ENGINES.
     """
 
-    def __init__(self, cfg):
+    def __init__(self, cfg, engine="semi-nca", graph=None, root=None):
         self.cfg = cfg
+        self.engine = engine
+        # The CSRGraph whose dominators these are, and the node they are
+        # found from: the CFG and its entry block unless told otherwise.
+        # For post-dominators these are the reverse CFG and its exit.
+        self.graph = cfg.csr if graph is None else graph
+        self.root = cfg.entry_node.number if root is None else root
         self.doms = {}
-        self.df = {}
+        self.df = None
         self.build()
 
     def build(self):
-        graph = self.cfg.graph
-        self.entry = self.cfg.entry_node
-        self.build_dominators(graph, self.entry)
+        cfg, graph, root = self.cfg, self.graph, self.root
+        blocks = cfg.blocks
+        self.entry = blocks[root] if root < len(blocks) else None
+        self.idom = idom = self.build_dominators(graph, root)
+        # self.doms maps blocks to their immediate dominator, entry first
+        # and then in the order the blocks were visited. Nodes that
+        # aren't blocks, like a virtual exit, are left out.
+        doms = self.doms
+        for b in graph.reverse_postorder(root):
+            if b < len(blocks) and idom[b] < len(blocks):
+                doms[blocks[b]] = blocks[idom[b]]
+        self.number_intervals()
 
-    def build_dominators(self, graph, entry):
+    def number_intervals(self):
+        """Number the dominator tree in preorder. The nodes a node
+        dominates are then those numbered from its pre number up to
+        its pre_end number. Unreachable nodes get an empty interval
+        past all the others, so they dominate nothing and nothing
+        dominates them."""
+        idom = self.idom
+        n = len(idom)
+        entry = self.root
+        children = [[] for _ in range(n)]
+        for b in range(n):
+            if idom[b] >= 0 and b != entry:
+                children[idom[b]].append(b)
+        self.children = children
+
+        self.pre = pre = array("i", [n]) * n
+        self.pre_end = pre_end = array("i", [-1]) * n
+        # The nodes in dominator-tree preorder
+        self.preorder = preorder = array("i")
+        stack = [entry]
+        while stack:
+            b = stack.pop()
+            pre[b] = len(preorder)
+            preorder.append(b)
+            stack.extend(reversed(children[b]))
+        for b in reversed(preorder):
+            end = pre[b]
+            for c in children[b]:
+                if pre_end[c] > end:
+                    end = pre_end[c]
+            pre_end[b] = end
+
+    def frontiers(self):
         """
-          Builds the dominator tree based on:
+          Returns the dominance frontier of each node as a list of sets
+          of node numbers, indexed by node number. It is computed the
+          first time it is asked for, by the method in:
             http://www.cs.rice.edu/~keith/Embed/dom.pdf
-
-          Also used to build the post-dominator tree.
         """
-        doms = self.doms
-        doms[entry] = entry
-        post_order = dfs_postorder_nodes(graph, entry)
-
-        post_order_number = {}
-        i = 0
-        for n in post_order:
-            post_order_number[n] = i
-            i += 1
-
-        def intersec(b1, b2):
-            finger1 = b1
-            finger2 = b2
-            po_finger1 = post_order_number[finger1]
-
-            if finger2 in post_order_number.keys():
-                po_finger2 = post_order_number[finger2]
-            else:
-                po_finger2 = None
-
-            while po_finger1 != po_finger2:
-                no_solution = False
-                while po_finger1 < po_finger2:
-                    finger1 = doms.get(finger1, None)
-                    if finger1 is None:
-                        no_solution = True
-                        break
-                    po_finger1 = post_order_number[finger1]
-                while po_finger2 < po_finger1:
-                    finger2 = doms.get(finger2, None)
-                    if finger2 is None:
-                        no_solution = True
-                        break
-                    po_finger2 = post_order_number[finger2]
-                if no_solution:
-                    break
-            return finger1
-
-        changed = True
-        while changed:
-            changed = False
-            for b in reversed(post_order):
-                if b == entry:
+        if self.df is None:
+            graph, idom, root = self.graph, self.idom, self.root
+            df = [set() for _ in range(graph.n)]
+            pred, pred_start = graph.pred, graph.pred_start
+            for b in range(graph.n):
+                start, end = pred_start[b], pred_start[b + 1]
+                # Only joins can be in a frontier. The root counts as one
+                # when it has any predecessor, since it is also entered
+                # from outside.
+                if idom[b] < 0 or (end - start < 2 and b != root):
                     continue
-                predecessors = b.predecessors
-                new_idom = next(iter(predecessors))
-                for p in predecessors:
-                    if p == new_idom:
+                stop = idom[b] if b != root else -1
+                for i in range(start, end):
+                    runner = pred[i]
+                    if idom[runner] < 0:
                         continue
-                    if p in doms:
-                        new_idom = intersec(p, new_idom)
-                if b not in doms or doms[b] != new_idom:
-                    doms[b] = new_idom
-                    changed = True
-                    pass
-                pass
-        return
+                    while runner != stop:
+                        df[runner].add(b)
+                        runner = idom[runner] if runner != root else -1
+            self.df = df
+        return self.df
+
+    def dominates(self, a, b):
+        """Does node number "a" dominate node number "b"? Each node
+        dominates itself. Node numbers are block numbers, plus the
+        virtual exit for post-dominators."""
+        return self.pre[a] <= self.pre[b] <= self.pre_end[a]
+
+    def strictly_dominates(self, a, b):
+        return a != b and self.pre[a] <= self.pre[b] <= self.pre_end[a]
+
+    def dominators(self, b):
+        """The set of node numbers that dominate node number "b" """
+        idom = self.idom
+        result = set()
+        if idom[b] < 0:
+            return result
+        while b not in result:
+            result.add(b)
+            b = idom[b]
+        return result
+
+    def dominated(self, b):
+        """The set of node numbers that node number "b" dominates"""
+        return set(self.preorder[self.pre[b] : self.pre_end[b] + 1])
+
+    def build_dominators(self, graph, entry):
+        """
+          Returns the immediate dominators of the nodes of CSRGraph
+          "graph" found by our engine, starting at node "entry".
+
+          Also used to build the post-dominator tree.
+        """
+        return ENGINES[self.engine](graph, entry)
 
     def tree(self):
         """Makes a the dominator tree"""
@@ -111,7 +290,7 @@ class DominatorTree(object):
                     parent_node = t.make_add_node(parent)
                     t_nodes[parent] = parent_node
                 parent_node = t_nodes[parent]
-                t.make_add_edge(parent_node, cur_node, "dom-edge")
+                t.make_add_edge(parent_node, cur_node, EDGE_DOM)
                 pass
             pass
         return t
@@ -120,40 +299,30 @@ class DominatorTree(object):
 # Note: this has to be done after calling tree
 def build_df(t):
     """
-    Builds data flow graph using Depth-First search.
+    Sets the reach_offset of each node of dominator tree "t", and of
+    its basic block, to the largest end offset of the blocks it
+    dominates.
     """
-
-    def dfs(seen, node):
-        if node in seen:
-            return
-        seen.add(node)
-        if BB_ENTRY in node.flags:
-            t.root = node
-        node.bb.doms = node.doms = set([node])
-        node.bb.reach_offset = node.reach_offset = node.bb.end_offset
-        for i, n in enumerate(node.children):
-
-            if isinstance(node.bb.cumulative_stack_effect, int):
-                cum_stack_effect = node.bb.cumulative_stack_effect
-            else:
-                cum_stack_effect = node.bb.cumulative_stack_effect[-(i + 1)]
-
-            if isinstance(n.bb.stack_effect, int):
-                n.bb.cumulative_stack_effect += cum_stack_effect
-            else:
-                n.bb.cumulative_stack_effect = [
-                    j + cum_stack_effect for j in n.bb.cumulative_stack_effect
-                ]
-            dfs(seen, n)
-            node.doms |= node.doms
-            node.bb.doms |= node.doms
-            if node.reach_offset < n.reach_offset:
-                node.bb.reach_offset = node.reach_offset = n.reach_offset
-        # print("node %d has children %s" %
-        #       (node.number, [n.number for n in node.children]))
-
     seen = set([])
-    for node in sorted(list(t.nodes), key=lambda n: n.number):
-        if node not in seen:
-            dfs(seen, node)
+    for root in sorted(list(t.nodes), key=lambda n: n.number):
+        if root in seen:
+            continue
+        # Nodes in depth-first preorder, so that in reverse every
+        # node comes after the nodes it dominates.
+        order = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            order.append(node)
+            if BB_ENTRY in node.flags:
+                t.root = node
+            node.bb.reach_offset = node.reach_offset = node.bb.end_offset
+            stack.extend(node.children)
+        for node in reversed(order):
+            for n in node.children:
+                if node.reach_offset < n.reach_offset:
+                    node.bb.reach_offset = node.reach_offset = n.reach_offset
     return t
@@ -7,10 +7,19 @@
 """
 
 from lapdecompile.graph import (
+    CSRGraph,
     DiGraph,
     BB_ENTRY,
     BB_NOFOLLOW,
     BB_JUMP_UNCONDITIONAL,
+    EDGE_DOM,
+    EDGE_EXIT,
+    EDGE_FALLTHROUGH,
+    EDGE_FOLLOW,
+    EDGE_FORWARD_SCOPE,
+    EDGE_NO_FALLTHROUGH,
+    EDGE_PDOM,
+    EDGE_SELF_LOOP,
     format_flags,
 )
 
@@ -46,10 +55,30 @@ class DotConverter(object):
 
             for edge in self.g.edges:
                 self.add_edge(edge)
+        elif isinstance(self.g, CSRGraph):
+            # Nodes are numbered and their data are basic blocks.
+            blocks = self.g.data
+            has_predecessors = self.g.pred_start
+            for block in blocks:
+                self.add_block(
+                    block.number,
+                    block,
+                    has_predecessors[block.number]
+                    < has_predecessors[block.number + 1],
+                )
+            for source, dest, kind in self.g.edges():
+                self.write_edge(
+                    "node_%d" % source, "node_%d" % dest, kind, blocks[source]
+                )
 
         self.buffer += "}\n"
 
     def add_edge(self, edge):
+        self.write_edge(
+            self.node_ids[edge.source], self.node_ids[edge.dest], edge.kind, edge.source.bb
+        )
+
+    def write_edge(self, nid1, nid2, kind, source_bb):
         # labels = ''
         # if edge.flags is not None:
         #   bb = '' if edge.bb is None else str(edge.bb)
@@ -61,41 +90,38 @@ class DotConverter(object):
         dest_port = ""
         weight = 1
 
-        if edge.kind in (
-            "fallthrough",
-            "no fallthrough",
-            "follow",
-            "exit edge",
-            "dom-edge",
-            "pdom-edge",
+        if kind in (
+            EDGE_FALLTHROUGH,
+            EDGE_NO_FALLTHROUGH,
+            EDGE_FOLLOW,
+            EDGE_EXIT,
+            EDGE_DOM,
+            EDGE_PDOM,
         ):
-            if edge.kind == "follow":
+            if kind == EDGE_FOLLOW:
                 style = '[style="invis"]'
                 pass
-            if edge.kind != "exit edge":
+            if kind != EDGE_EXIT:
                 weight = 10
         else:
-            if edge.kind == "forward_scope":
+            if kind == EDGE_FORWARD_SCOPE:
                 style = '[style="dotted"]'
-            if edge.kind == "self-loop":
+            if kind == EDGE_SELF_LOOP:
                 edge_port = "[headport=ne] [tailport=se]"
             weight = 1
 
-        if BB_NOFOLLOW in edge.source.flags:
+        if BB_NOFOLLOW in source_bb.flags:
             style = '[style="dashed"] [arrowhead="none"]'
             weight = 10
 
-        if style == "" and edge.source.bb.unreachable:
+        if style == "" and source_bb.unreachable:
             style = '[style="dashed"] [arrowhead="empty"]'
 
-        if edge.kind == "fallthrough" and BB_JUMP_UNCONDITIONAL in edge.source.flags:
+        if kind == EDGE_FALLTHROUGH and BB_JUMP_UNCONDITIONAL in source_bb.flags:
             # style = '[color="black:invis:black"]'
             # style = '[style="dotted"] [arrowhead="empty"]'
             style = '[style="invis"]'
 
-        nid1 = self.node_ids[edge.source]
-        nid2 = self.node_ids[edge.dest]
-
         self.buffer += "%s -> %s [weight=%d]%s%s;\n" % (
             nid1,
             nid2,
@@ -120,26 +146,30 @@ class DotConverter(object):
         else:
             reach_offset_text = ""
 
-        str = "offsets: %d..%d%s%s%s\lstack_effect: %s\lcum stack_effect %s" % (
+        str = "offsets: %d..%d%s%s%s\lstack_effect: %s\lstack depth: %s..%s" % (
             node.start_offset,
             node.end_offset,
             flag_text,
             jump_text,
             reach_offset_text,
             node.stack_effect,
-            node.cumulative_stack_effect,
+            node.entry_depth,
+            node.exit_depth,
         )
         return str
 
     def add_node(self, node):
+        self.add_block(node.number, node.bb, not node.bb.unreachable)
+
+    def add_block(self, number, bb, has_predecessors):
         label = ""
         style = ""
-        if BB_ENTRY in node.bb.flags:
+        if BB_ENTRY in bb.flags:
             style = '[shape = "oval"]'
-        elif not node.bb.predecessors:
+        elif not has_predecessors:
             style = '[style = "dashed"]'
         label = '[label="Basic Block %d\l%s\l"]' % (
-            node.number,
-            self.node_repr(node.bb),
+            number,
+            self.node_repr(bb),
         )
-        self.buffer += "node_%d %s%s;\n" % (node.number, style, label)
+        self.buffer += "node_%d %s%s;\n" % (number, style, label)
@@ -0,0 +1,825 @@
+"""Reader for Emacs Lisp bytecode (.elc) files
+
+Instead of having Emacs disassemble a bytecode file into LAP text with
+elisp/dedis.el and then scanning that text, we read the .elc file
+directly: each byte-code object's bytestring and constants vector is
+decoded into the same Func records and Token lists that LapScanner
+produces.
+"""
+import math
+import re
+
+from lapdecompile.scanner import Func, add_instruction
+from lapdecompile.stack_effect import OP_CONSTANT, OP_LABEL, OpcodeError
+from lapdecompile.tok import Token
+
+
+class Symbol(object):
+    """An interned Lisp symbol"""
+
+    obarray = {}
+
+    def __new__(cls, name):
+        sym = cls.obarray.get(name)
+        if sym is None:
+            sym = object.__new__(cls)
+            sym.name = name
+            cls.obarray[name] = sym
+        return sym
+
+    def __repr__(self):
+        return "Symbol(%r)" % self.name
+
+
+NIL = Symbol("nil")
+QUOTE = Symbol("quote")
+FUNCTION = Symbol("function")
+MACRO = Symbol("macro")
+
+
+class DottedList(list):
+    """A list whose last cdr isn't nil, e.g. (a b . c)"""
+
+    def __init__(self, items, tail):
+        super(DottedList, self).__init__(items)
+        self.tail = tail
+
+
+class Vector(list):
+    pass
+
+
+class Record(list):
+    """#s(...) objects, such as hash tables"""
+
+    pass
+
+
+class LoadFileName(object):
+    """What #$ reads as: the name of the file being loaded"""
+
+    pass
+
+
+class ByteCode(object):
+    """A compiled function, #[arglist bytestring constants depth ...]"""
+
+    def __init__(self, slots):
+        slots = list(slots) + [None] * (6 - len(slots))
+        self.arglist, self.code, self.constants, self.depth = slots[:4]
+        self.doc, self.interactive = slots[4:6]
+
+
+class ElcError(Exception):
+    pass
+
+
+SYMBOL_DELIMITERS = frozenset(b" \t\n\r\f()[]\";'`,")
+SYMBOL_DELIMITER_BYTES = frozenset(bytes([c]) for c in SYMBOL_DELIMITERS)
+OCTAL_DIGITS = frozenset(bytes([c]) for c in b"01234567")
+
+# Integers and floats, as Emacs reads them. Anything else made
+# up of symbol characters is a symbol.
+NUMBER = re.compile(rb"^[-+]?(?:\d+\.?|\d*\.\d+(?:e[-+]?\d+)?|\d+e[-+]?\d+|\d\.\d+e\+(?:INF|NaN))$")
+
+INTEGER = re.compile(rb"^[-+]?\d+\.?$")
+DOC_MARKER = re.compile(rb"#@(\d+)")
+HEX_DIGITS = re.compile(rb"[0-9a-fA-F]*")
+BOOL_VECTOR = re.compile(rb"#&(\d+)")
+RADIX_INTEGER = re.compile(rb"#.([-+]?[0-9a-zA-Z]+)")
+READ_LABEL = re.compile(rb"#(\d+)([=#])")
+
+STRING_ESCAPES = {
+    ord("a"): 7,
+    ord("b"): 8,
+    ord("d"): 127,
+    ord("e"): 27,
+    ord("f"): 12,
+    ord("n"): 10,
+    ord("r"): 13,
+    ord("s"): 32,
+    ord("t"): 9,
+    ord("v"): 11,
+}
+
+
+class LispReader(object):
+    """A reader for the subset of Lisp printed syntax that shows up in
+    byte-compiled files."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.labels = {}
+
+    def error(self, msg):
+        raise ElcError("%s at byte offset %d" % (msg, self.pos))
+
+    def skip_blanks(self):
+        data, n = self.data, len(self.data)
+        while self.pos < n:
+            c = data[self.pos]
+            if c in b" \t\n\r\f":
+                self.pos += 1
+            elif c == ord(";"):
+                end = data.find(b"\n", self.pos)
+                self.pos = n if end < 0 else end + 1
+            elif data.startswith(b"#@", self.pos):
+                self.skip_docstring()
+            else:
+                break
+
+    def skip_docstring(self):
+        # #@NUMBER<space> is followed by NUMBER bytes of dynamic
+        # docstrings; #@00 skips to the end of the file.
+        m = DOC_MARKER.match(self.data, self.pos)
+        if m is None:
+            self.error("bad #@ syntax")
+        if m.group(1) == b"00":
+            self.pos = len(self.data)
+        else:
+            self.pos = m.end() + int(m.group(1))
+
+    def read(self):
+        """Read and return the next Lisp object. Raise EOFError when there
+        are no more."""
+        self.skip_blanks()
+        data = self.data
+        if self.pos >= len(data):
+            raise EOFError
+        c = chr(data[self.pos])
+        if c == "(":
+            self.pos += 1
+            return self.read_list(")")
+        elif c == "[":
+            self.pos += 1
+            return Vector(self.read_list("]"))
+        elif c in ")]":
+            self.error("unexpected '%s'" % c)
+        elif c == '"':
+            self.pos += 1
+            return self.read_string()
+        elif c == "?":
+            self.pos += 1
+            return self.read_char()
+        elif c == "'":
+            self.pos += 1
+            return [QUOTE, self.read()]
+        elif c == "`":
+            self.pos += 1
+            return [Symbol("`"), self.read()]
+        elif c == ",":
+            self.pos += 1
+            if data.startswith(b"@", self.pos):
+                self.pos += 1
+                return [Symbol(",@"), self.read()]
+            return [Symbol(","), self.read()]
+        elif c == "#":
+            return self.read_hash()
+        return self.read_atom()
+
+    def read_list(self, close):
+        items = []
+        while True:
+            self.skip_blanks()
+            if self.pos >= len(self.data):
+                self.error("end of file inside a list")
+            c = chr(self.data[self.pos])
+            if c == close:
+                self.pos += 1
+                return items
+            if (
+                c == "."
+                and close == ")"
+                and items
+                and self.data[self.pos + 1 : self.pos + 2] in SYMBOL_DELIMITER_BYTES
+            ):
+                self.pos += 1
+                tail = self.read()
+                self.skip_blanks()
+                if self.data[self.pos : self.pos + 1] != b")":
+                    self.error("bad dotted list")
+                self.pos += 1
+                if tail is NIL:
+                    return items
+                if isinstance(tail, list) and not isinstance(tail, (Vector, Record)):
+                    if isinstance(tail, DottedList):
+                        return DottedList(items + tail, tail.tail)
+                    return items + tail
+                return DottedList(items, tail)
+            items.append(self.read())
+
+    def read_escape(self, in_string):
+        """Read the character after a backslash. Return None for escapes
+        that stand for nothing in strings."""
+        data = self.data
+        c = data[self.pos]
+        self.pos += 1
+        if c in b"01234567":
+            end = self.pos
+            while end < self.pos + 2 and data[end : end + 1] in OCTAL_DIGITS:
+                end += 1
+            value = int(data[self.pos - 1 : end], 8)
+            self.pos = end
+            return value
+        if c == ord("x"):
+            m = HEX_DIGITS.match(data, self.pos)
+            self.pos = m.end()
+            return int(m.group(0) or b"0", 16)
+        if c in (ord("u"), ord("U")):
+            n = 4 if c == ord("u") else 8
+            value = int(data[self.pos : self.pos + n], 16)
+            self.pos += n
+            return value
+        if c == ord("^") or (c == ord("C") and data[self.pos : self.pos + 1] == b"-"):
+            if c == ord("C"):
+                self.pos += 1
+            value = self.read_char_body(in_string)
+            if value == ord("?"):
+                return 127
+            return value & 0x1F if value < 128 else value | 0x4000000
+        if c == ord("M") and data[self.pos : self.pos + 1] == b"-":
+            self.pos += 1
+            value = self.read_char_body(in_string)
+            return value | 0x80 if in_string else value | 0x8000000
+        if in_string and c in b"\n ":
+            return None
+        return STRING_ESCAPES.get(c, c)
+
+    def read_char_body(self, in_string):
+        c = self.data[self.pos]
+        self.pos += 1
+        if c == ord("\\"):
+            return self.read_escape(in_string)
+        return c
+
+    def read_string(self):
+        data = self.data
+        chars = bytearray()
+        while True:
+            if self.pos >= len(data):
+                self.error("end of file inside a string")
+            c = data[self.pos]
+            self.pos += 1
+            if c == ord('"'):
+                return bytes(chars)
+            if c == ord("\\"):
+                value = self.read_escape(in_string=True)
+                if value is None:
+                    continue
+                if value < 256:
+                    chars.append(value)
+                else:
+                    chars.extend(chr(value).encode("utf-8", errors="surrogatepass"))
+            else:
+                chars.append(c)
+
+    def read_char(self):
+        data = self.data
+        c = data[self.pos]
+        if c == ord("\\"):
+            self.pos += 1
+            return self.read_escape(in_string=False)
+        # A character may be a multi-byte UTF-8 sequence.
+        n = 1
+        if c >= 0xF0:
+            n = 4
+        elif c >= 0xE0:
+            n = 3
+        elif c >= 0xC0:
+            n = 2
+        text = data[self.pos : self.pos + n].decode("utf-8", errors="replace")
+        self.pos += n
+        return ord(text[0])
+
+    def read_hash(self):
+        data = self.data
+        nxt = data[self.pos + 1 : self.pos + 2]
+        if nxt == b"[":
+            self.pos += 2
+            return ByteCode(self.read_list("]"))
+        elif nxt == b"'":
+            self.pos += 2
+            return [FUNCTION, self.read()]
+        elif nxt == b"$":
+            self.pos += 2
+            return LoadFileName()
+        elif nxt == b"s":
+            self.pos += 2
+            if data[self.pos : self.pos + 1] != b"(":
+                self.error("bad #s syntax")
+            self.pos += 1
+            return Record(self.read_list(")"))
+        elif nxt == b":":
+            self.pos += 2
+            return self.read_atom()
+        elif nxt == b"#":
+            self.pos += 2
+            return Symbol("")
+        elif nxt == b"&":
+            # Bool vector #&N"bits"
+            m = BOOL_VECTOR.match(data, self.pos)
+            self.pos = m.end() + 1
+            return Record([Symbol("bool-vector"), int(m.group(1)), self.read_string()])
+        elif nxt in (b"x", b"X", b"o", b"O", b"b", b"B"):
+            m = RADIX_INTEGER.match(data, self.pos)
+            self.pos = m.end()
+            radix = {b"x": 16, b"o": 8, b"b": 2}[nxt.lower()]
+            return int(m.group(1), radix)
+        m = READ_LABEL.match(data, self.pos)
+        if m:
+            self.pos = m.end()
+            label = int(m.group(1))
+            if m.group(2) == b"#":
+                return self.labels[label]
+            value = self.labels[label] = self.read()
+            return value
+        self.error("unsupported # syntax")
+
+    def read_atom(self):
+        data, n = self.data, len(self.data)
+        start = self.pos
+        chars = bytearray()
+        escaped = False
+        while self.pos < n:
+            c = data[self.pos]
+            if c in SYMBOL_DELIMITERS:
+                break
+            if c == ord("\\"):
+                escaped = True
+                self.pos += 1
+                c = data[self.pos]
+            chars.append(c)
+            self.pos += 1
+        if start == self.pos:
+            self.error("unexpected character")
+        text = bytes(chars)
+        if not escaped and NUMBER.match(text):
+            if text.endswith(b"INF"):
+                return -math.inf if text.startswith(b"-") else math.inf
+            elif text.endswith(b"NaN"):
+                return math.nan
+            elif INTEGER.match(text):
+                return int(text.rstrip(b"."))
+            return float(text)
+        return Symbol(text.decode("utf-8", errors="replace"))
+
+# Characters that prin1 escapes in symbol names. Note that "?" isn't
+# here: LapScanner removes the backslash Emacs puts before it.
+SYMBOL_ESCAPES = frozenset(" \t\n\r\f()[]\";'`,#\\.")
+
+
+def lisp_string(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return value
+
+
+def prin1(obj):
+    """Return the printed representation of "obj" as Emacs's prin1 would
+    give it, with newlines escaped"""
+    if isinstance(obj, Symbol):
+        name = obj.name
+        if not name:
+            return "##"
+        text = "".join("\\" + c if c in SYMBOL_ESCAPES else c for c in name)
+        if NUMBER.match(name.encode("utf-8", errors="replace")):
+            text = "\\" + text
+        return text
+    elif isinstance(obj, bytes):
+        text = lisp_string(obj)
+        text = text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return '"%s"' % text
+    elif isinstance(obj, int):
+        return str(obj)
+    elif isinstance(obj, float):
+        if math.isnan(obj):
+            return "0.0e+NaN"
+        elif math.isinf(obj):
+            return "-1.0e+INF" if obj < 0 else "1.0e+INF"
+        return repr(obj)
+    elif isinstance(obj, ByteCode):
+        slots = [obj.arglist, obj.code, obj.constants, obj.depth, obj.doc, obj.interactive]
+        while slots and slots[-1] is None:
+            slots.pop()
+        return "#[%s]" % " ".join(prin1(s) for s in slots)
+    elif isinstance(obj, Vector):
+        return "[%s]" % " ".join(prin1(o) for o in obj)
+    elif isinstance(obj, Record):
+        return "#s(%s)" % " ".join(prin1(o) for o in obj)
+    elif isinstance(obj, LoadFileName):
+        return "#$"
+    elif isinstance(obj, list):
+        if not obj:
+            return "nil"
+        if (
+            len(obj) == 2
+            and not isinstance(obj, DottedList)
+            and obj[0] in (QUOTE, FUNCTION)
+        ):
+            return ("'" if obj[0] is QUOTE else "#'") + prin1(obj[1])
+        text = " ".join(prin1(o) for o in obj)
+        if isinstance(obj, DottedList):
+            text += " . " + prin1(obj.tail)
+        return "(%s)" % text
+    elif obj is None:
+        return "nil"
+    raise ElcError("Can't print %r" % (obj,))
+
+
+# Emacs bytecode opcodes from src/bytecode.c, with the names the
+# disassembler gives them. The operand encoding is one of:
+#   None:    no operand
+#   "index": the operand is the low 3 bits of the opcode for values 0..5;
+#            6 means it is in the next byte and 7 in the next 2 bytes
+#   "byte":  the operand is the next byte
+#   "word":  the operand is the next 2 bytes
+#   "jump":  like "word", but the operand is a bytecode offset
+BYTE_OPS = {}
+for base, opname in (
+    (0o00, "stack-ref"),
+    (0o10, "varref"),
+    (0o20, "varset"),
+    (0o30, "varbind"),
+    (0o40, "call"),
+    (0o50, "unbind"),
+):
+    for i in range(8):
+        BYTE_OPS[base + i] = (opname, "index")
+
+for opcode, opname, operand in (
+    (0o60, "pophandler", None),
+    (0o61, "pushconditioncase", "jump"),
+    (0o62, "pushcatch", "jump"),
+    (0o70, "nth", None),
+    (0o71, "symbolp", None),
+    (0o72, "consp", None),
+    (0o73, "stringp", None),
+    (0o74, "listp", None),
+    (0o75, "eq", None),
+    (0o76, "memq", None),
+    (0o77, "not", None),
+    (0o100, "car", None),
+    (0o101, "cdr", None),
+    (0o102, "cons", None),
+    (0o103, "list1", None),
+    (0o104, "list2", None),
+    (0o105, "list3", None),
+    (0o106, "list4", None),
+    (0o107, "length", None),
+    (0o110, "aref", None),
+    (0o111, "aset", None),
+    (0o112, "symbol-value", None),
+    (0o113, "symbol-function", None),
+    (0o114, "set", None),
+    (0o115, "fset", None),
+    (0o116, "get", None),
+    (0o117, "substring", None),
+    (0o120, "concat2", None),
+    (0o121, "concat3", None),
+    (0o122, "concat4", None),
+    (0o123, "sub1", None),
+    (0o124, "add1", None),
+    (0o125, "eqlsign", None),
+    (0o126, "gtr", None),
+    (0o127, "lss", None),
+    (0o130, "leq", None),
+    (0o131, "geq", None),
+    (0o132, "diff", None),
+    (0o133, "negate", None),
+    (0o134, "plus", None),
+    (0o135, "max", None),
+    (0o136, "min", None),
+    (0o137, "mult", None),
+    (0o140, "point", None),
+    (0o141, "save-current-buffer", None),  # Obsolete encoding
+    (0o142, "goto-char", None),
+    (0o143, "insert", None),
+    (0o144, "point-max", None),
+    (0o145, "point-min", None),
+    (0o146, "char-after", None),
+    (0o147, "following-char", None),
+    (0o150, "preceding-char", None),
+    (0o151, "current-column", None),
+    (0o152, "indent-to", None),
+    (0o153, "scan-buffer", None),  # Obsolete
+    (0o154, "eolp", None),
+    (0o155, "eobp", None),
+    (0o156, "bolp", None),
+    (0o157, "bobp", None),
+    (0o160, "current-buffer", None),
+    (0o161, "set-buffer", None),
+    (0o162, "save-current-buffer", None),
+    (0o163, "set-mark", None),  # Obsolete
+    (0o164, "interactive-p", None),
+    (0o165, "forward-char", None),
+    (0o166, "forward-word", None),
+    (0o167, "skip-chars-forward", None),
+    (0o170, "skip-chars-backward", None),
+    (0o171, "forward-line", None),
+    (0o172, "char-syntax", None),
+    (0o173, "buffer-substring", None),
+    (0o174, "delete-region", None),
+    (0o175, "narrow-to-region", None),
+    (0o176, "widen", None),
+    (0o177, "end-of-line", None),
+    (0o201, "constant", "word"),
+    (0o202, "goto", "jump"),
+    (0o203, "goto-if-nil", "jump"),
+    (0o204, "goto-if-not-nil", "jump"),
+    (0o205, "goto-if-nil-else-pop", "jump"),
+    (0o206, "goto-if-not-nil-else-pop", "jump"),
+    (0o207, "return", None),
+    (0o210, "discard", None),
+    (0o211, "dup", None),
+    (0o212, "save-excursion", None),
+    (0o213, "save-window-excursion", None),
+    (0o214, "save-restriction", None),
+    (0o215, "catch", None),
+    (0o216, "unwind-protect", None),
+    (0o217, "condition-case", None),
+    (0o220, "temp-output-buffer-setup", None),
+    (0o221, "temp-output-buffer-show", None),
+    (0o222, "unbind-all", None),  # Obsolete
+    (0o223, "set-marker", None),
+    (0o224, "match-beginning", None),
+    (0o225, "match-end", None),
+    (0o226, "upcase", None),
+    (0o227, "downcase", None),
+    (0o230, "string=", None),
+    (0o231, "string<", None),
+    (0o232, "equal", None),
+    (0o233, "nthcdr", None),
+    (0o234, "elt", None),
+    (0o235, "member", None),
+    (0o236, "assq", None),
+    (0o237, "nreverse", None),
+    (0o240, "setcar", None),
+    (0o241, "setcdr", None),
+    (0o242, "car-safe", None),
+    (0o243, "cdr-safe", None),
+    (0o244, "nconc", None),
+    (0o245, "quo", None),
+    (0o246, "rem", None),
+    (0o247, "numberp", None),
+    (0o250, "integerp", None),
+    (0o257, "listN", "byte"),
+    (0o260, "concatN", "byte"),
+    (0o261, "insertN", "byte"),
+    (0o262, "stack-set", "byte"),
+    (0o263, "stack-set", "word"),
+    (0o266, "discardN", "byte"),
+    (0o267, "switch", None),
+):
+    BYTE_OPS[opcode] = (opname, operand)
+
+for i in range(0o300, 0o400):
+    BYTE_OPS[i] = ("constant", None)
+
+
+def decode_bytecode(code):
+    """Decode the bytestring "code" into a list of (offset, opname, operand)
+    tuples. Operands are integers: a constants-vector index for
+    "constant" and the var ops, a bytecode offset for jumps and a count
+    otherwise."""
+    instructions = []
+    pc, n = 0, len(code)
+    while pc < n:
+        opcode = code[pc]
+        if opcode not in BYTE_OPS:
+            raise ElcError("unknown opcode %o at bytecode offset %d" % (opcode, pc))
+        opname, encoding = BYTE_OPS[opcode]
+        size = 1
+        operand = None
+        if encoding == "index":
+            operand = opcode & 7
+            if operand == 6:
+                operand, size = code[pc + 1], 2
+            elif operand == 7:
+                operand, size = code[pc + 1] | (code[pc + 2] << 8), 3
+        elif encoding == "byte":
+            operand, size = code[pc + 1], 2
+        elif encoding in ("word", "jump"):
+            operand, size = code[pc + 1] | (code[pc + 2] << 8), 3
+        elif opname == "constant":
+            operand = opcode - 0o300
+
+        if opname == "discardN" and operand & 0x80:
+            opname, operand = "discardN-preserve-tos", operand & 0x7F
+        instructions.append((pc, opname, operand))
+        pc += size
+    return instructions
+
+
+JUMP_OPNAMES = frozenset(
+    opname for opname, encoding in BYTE_OPS.values() if encoding == "jump"
+)
+
+# Instructions whose operand indexes the constants vector
+CONSTANT_OPNAMES = frozenset(["constant", "varref", "varset", "varbind"])
+
+
+def format_arglist(arglist):
+    """Format an argument list the way the "args:" line of LAP shows it"""
+    if isinstance(arglist, int):
+        # Lexical binding: the mandatory and optional argument counts
+        # and a &rest flag are packed into an integer, and the names are gone.
+        mandatory = arglist & 127
+        nonrest = arglist >> 8
+        names = ["arg%d" % (i + 1) for i in range(mandatory)]
+        if nonrest > mandatory:
+            names.append("&optional")
+            names += ["arg%d" % (i + 1) for i in range(mandatory, nonrest)]
+        if arglist & 128:
+            names += ["&rest", "rest"]
+        arglist = [Symbol(name) for name in names]
+    if not arglist or arglist is NIL:
+        return "()"
+    return prin1(arglist)
+
+
+class ElcReader(object):
+    """Reads a byte-compiled .elc file and produces the Func records that
+    LapScanner produces for the LAP disassembly of that file.
+
+    Top-level (defalias 'NAME #[...]) forms give functions, or macros if
+    the definition is (macro . #[...]); top-level (byte-code ...) forms
+    give "file" functions. Other top-level forms aren't compiled and are
+    skipped. Compiled functions in a constants vector are produced before
+    the function that contains them, just as LapScanner does.
+    """
+
+    def __init__(self, fp, show_assembly=False, lazy=False):
+        self.last_compiled_function = 0
+        self.show_assembly = show_assembly
+        self.fp = fp
+        self.data = fp.read()
+        if isinstance(self.data, str):
+            self.data = self.data.encode("utf-8", errors="surrogateescape")
+        self.reader = LispReader(self.data)
+        self.fns = {}
+        # The number of functions that couldn't be decoded and were
+        # skipped
+        self.errors = 0
+
+        if not lazy:
+            for fn in self.fn_scanner():
+                self.fns[fn.name] = fn
+
+    def fn_scanner(self):
+        """Generator yielding a Func for each compiled function in the file"""
+        anonymous_count = 0
+        while True:
+            try:
+                form = self.reader.read()
+            except EOFError:
+                break
+            if not isinstance(form, list) or not form:
+                continue
+            head = form[0]
+            if head is Symbol("defalias") and len(form) >= 3:
+                name, definition = form[1], form[2]
+                if isinstance(name, list) and len(name) == 2 and name[0] is QUOTE:
+                    name = name[1]
+                fn_type = "defun"
+                if isinstance(definition, list) and definition:
+                    if definition[0] is QUOTE:
+                        definition = definition[1]
+                    elif definition[0] is Symbol("cons") and len(definition) == 3:
+                        # (cons 'macro #[...])
+                        definition = DottedList([MACRO], definition[2])
+                if isinstance(definition, DottedList) and definition[0] is MACRO:
+                    fn_type = "defmacro"
+                    definition = definition.tail
+                if isinstance(definition, list) and definition and definition[0] is FUNCTION:
+                    definition = definition[1]
+                if isinstance(name, Symbol) and isinstance(definition, ByteCode):
+                    yield from self.fn_decode(prin1(name), fn_type, definition)
+            elif head is Symbol("byte-code") and len(form) >= 3:
+                name = "anonymous%d" % anonymous_count
+                anonymous_count += 1
+                yield from self.fn_decode(name, "file", ByteCode([NIL] + form[1:]))
+        return
+
+    def docstring(self, doc):
+        if isinstance(doc, DottedList) and isinstance(doc[0], LoadFileName):
+            # A dynamic docstring (#$ . POSITION) stored in this file
+            # after a #@ marker, and ended by ^_.
+            position = doc.tail
+            if not isinstance(position, int):
+                return ""
+            position = abs(position)
+            end = self.data.find(b"\037", position)
+            doc = self.data[position : end if end >= 0 else len(self.data)]
+        if not isinstance(doc, bytes):
+            return ""
+        return '\n  "%s"' % lisp_string(doc)
+
+    def cant_handle(self, name, error):
+        """Report that function "name" is skipped because of "error" """
+        print("Can't handle function %s, %s" % (name, error))
+        self.errors += 1
+
+    def fn_decode(self, name, fn_type, bytecode):
+        """Generator decoding the ByteCode object "bytecode" into a
+        Func, yielding first any compiled functions in its constants.
+        A function whose bytecode can't be decoded is reported and
+        skipped."""
+        tokens = []
+        customize = {}
+        labels = {}
+
+        constants = bytecode.constants or []
+        code = bytecode.code
+        if not isinstance(code, bytes):
+            self.cant_handle(name, "bytecode is not a string")
+            return
+
+        try:
+            instructions = decode_bytecode(code)
+        except ElcError as e:
+            self.cant_handle(name, e)
+            return
+
+        # Labels are numbered in order of the offsets jumped to, as
+        # the disassembler does.
+        targets = sorted(
+            set(operand for _, opname, operand in instructions if opname in JUMP_OPNAMES)
+        )
+        offset2label = {offset: i + 1 for i, offset in enumerate(targets)}
+        starts = set(offset for offset, _, _ in instructions)
+        for offset in targets:
+            if offset not in starts:
+                self.cant_handle(name, "jump to bytecode offset %d, which "
+                                 "isn't the start of an instruction" % offset)
+                return
+
+        for offset, opname, operand in instructions:
+            label = offset2label.get(offset)
+            if label is not None:
+                labels[label] = len(tokens)
+                tokens.append(Token("LABEL", label, offset, OP_LABEL))
+
+            if opname in CONSTANT_OPNAMES and not 0 <= operand < len(constants):
+                self.cant_handle(name, "at bytecode offset %d: %s %d, but there "
+                                 "are %d constants" % (offset, opname, operand,
+                                                       len(constants)))
+                return
+
+            if opname == "constant":
+                value = constants[operand]
+                if isinstance(value, ByteCode):
+                    fn_name = "compiled-function-%d" % self.last_compiled_function
+                    self.last_compiled_function += 1
+                    attr = None
+                    for attr in self.fn_decode(fn_name, "defun", value):
+                        yield attr
+                    # The nested function comes last, unless it was
+                    # skipped.
+                    if attr is None or attr.name != fn_name:
+                        self.cant_handle(name, "can't decode %s" % fn_name)
+                        return
+                else:
+                    attr = prin1(value)
+                tokens.append(Token("CONSTANT", attr, offset, OP_CONSTANT, label=label))
+                continue
+
+            if opname in ("varref", "varset", "varbind"):
+                operand = prin1(constants[operand])
+            elif opname in JUMP_OPNAMES:
+                operand = str(offset2label[operand])
+            elif operand is not None:
+                operand = str(operand)
+            try:
+                handled = add_instruction(tokens, customize, offset, opname,
+                                          operand, label)
+            except OpcodeError as e:
+                self.cant_handle(name, e)
+                return
+            if not handled:
+                self.cant_handle(name, "at bytecode offset %d: %s %s"
+                                 % (offset, opname, operand))
+                return
+
+        args = format_arglist(bytecode.arglist)
+        interactive = bytecode.interactive
+        if interactive is not None:
+            if isinstance(interactive, Vector) and interactive:
+                interactive = interactive[0]
+            interactive = prin1(interactive)
+
+        if self.show_assembly:
+            print(f"\n{name}{args}")
+            print("\n".join([str(t) for t in tokens]))
+
+        yield Func(name, args, None, self.docstring(bytecode.doc), interactive,
+                   fn_type, tokens, customize, labels)
+
+
+if __name__ == "__main__":
+    import sys
+
+    elc_file = sys.argv[1]
+    with open(elc_file, "rb") as fp:
+        reader = ElcReader(fp, show_assembly=True)
+    pass
@@ -6,10 +6,14 @@
   :copyright: (c) 2014 by Romain Gaucher (@rgaucher)
 """
 
+from array import array
+
 # Does this need to be a set?
 BB_ENTRY = 0
 BB_NOFOLLOW = 1
 BB_LOOP = 2
+BB_LOOP_LATCH = 3
+BB_LOOP_EXIT = 4
 BB_JUMP_UNCONDITIONAL = 6
 
 
@@ -17,6 +21,8 @@ FLAG2NAME = {
     BB_ENTRY: "entry",
     BB_NOFOLLOW: "no fallthrough",
     BB_LOOP: "loop",
+    BB_LOOP_LATCH: "loop latch",
+    BB_LOOP_EXIT: "loop exit",
     BB_JUMP_UNCONDITIONAL: "unconditional",
 }
 
@@ -25,6 +31,32 @@ jump_flags = set([BB_JUMP_UNCONDITIONAL])
 nofollow_flags = set([BB_NOFOLLOW])
 
 
+# Edge kinds
+EDGE_FALLTHROUGH = 0
+EDGE_NO_FALLTHROUGH = 1
+EDGE_FOLLOW = 2
+EDGE_FORWARD = 3
+EDGE_FORWARD_SCOPE = 4
+EDGE_BACKWARD = 5
+EDGE_SELF_LOOP = 6
+EDGE_EXIT = 7
+EDGE_DOM = 8
+EDGE_PDOM = 9
+
+EDGE2NAME = {
+    EDGE_FALLTHROUGH: "fallthrough",
+    EDGE_NO_FALLTHROUGH: "no fallthrough",
+    EDGE_FOLLOW: "follow",
+    EDGE_FORWARD: "forward",
+    EDGE_FORWARD_SCOPE: "forward_scope",
+    EDGE_BACKWARD: "backward",
+    EDGE_SELF_LOOP: "self-loop",
+    EDGE_EXIT: "exit edge",
+    EDGE_DOM: "dom-edge",
+    EDGE_PDOM: "pdom-edge",
+}
+
+
 def format_flags(flags):
     return ", ".join([FLAG2NAME[flag] for flag in FLAG2NAME if flag in flags])
 
@@ -35,12 +67,10 @@ class Node(object):
     def __init__(self, bb):
         Node.GLOBAL_COUNTER += 1
         if bb.number is None:
-            self.number = Node.GLOBAL_COUNTER
-        else:
-            self.number = bb.number
+            bb.number = Node.GLOBAL_COUNTER
+        self.number = bb.number
         self.flags = bb.flags
         self.bb = bb
-        bb.number = Node.GLOBAL_COUNTER
 
     @classmethod
     def reset(self):
@@ -53,7 +83,7 @@ class Node(object):
         return isinstance(obj, Node) and obj.number == self.number
 
     def __hash__(self):
-        return hash("node-" + str(self.number))
+        return self.number
 
     def __repr__(self):
         return "Node%d(flags=%s, bb=%s)" % (
@@ -85,14 +115,14 @@ class Edge(object):
         return isinstance(obj, Edge) and obj.id == self.id
 
     def __hash__(self):
-        return hash("edge-" + str(self.id))
+        return self.id
 
     def __repr__(self):
         return "Edge%d(source=%s, dest=%s, kind=%s, data=%s)" % (
             self.id,
             self.source,
             self.dest,
-            repr(self.kind),
+            EDGE2NAME.get(self.kind, repr(self.kind)),
             repr(self.data),
         )
 
@@ -150,6 +180,11 @@ class TreeGraph(DiGraph):
       A simple tree structure for basic blocks.
     """
 
+    def __init__(self):
+        DiGraph.__init__(self)
+        # Basic blocks in the tree, and their nodes
+        self.bb_nodes = {}
+
     def add_edge(self, edge):
         if edge in self.edges:
             raise Exception("Edge already present")
@@ -158,11 +193,104 @@ class TreeGraph(DiGraph):
         self.add_node(source_node)
         self.add_node(dest_node)
         self.edges.add(edge)
-        source_node.children |= set([dest_node])
+        source_node.children.add(dest_node)
         dest_node.parent = set([source_node])
 
     def add_node(self, node):
-        if not node.bb in [n.bb for n in self.nodes]:
+        if node.bb not in self.bb_nodes:
+            self.bb_nodes[node.bb] = node
             node.children = set([])
             node.parent = None
             self.nodes.add(node)
+
+
+class CSRGraph(object):
+    """
+      A compact directed graph whose nodes are the numbers 0..n-1.
+
+      Edges are (source, dest, kind) triples with an int kind, such as
+      EDGE_FALLTHROUGH. They are kept in compressed sparse row form:
+      the successors of node v are succ[succ_start[v]:succ_start[v+1]],
+      and the kinds of those edges are the same slice of succ_kind.
+      Predecessors are kept the same way in pred_start, pred and
+      pred_kind. "data" is an optional list of the objects the nodes
+      stand for, such as basic blocks.
+    """
+
+    def __init__(self, n, edges, data=None):
+        self.n = n
+        self.data = data
+        # Traversal orders already computed, keyed by (name, root)
+        self.orders = {}
+        self.succ_start, self.succ, self.succ_kind = self.compress(n, edges, 0, 1)
+        self.pred_start, self.pred, self.pred_kind = self.compress(n, edges, 1, 0)
+
+    @staticmethod
+    def compress(n, edges, key, value):
+        """Bucket "edges" by their "key" end (0 for source, 1 for
+        dest) and return the start, node and kind arrays for the
+        "value" ends. Edges keep their relative order within a bucket."""
+        start = array("i", [0]) * (n + 1)
+        for edge in edges:
+            start[edge[key] + 1] += 1
+        for v in range(n):
+            start[v + 1] += start[v]
+        fill = start[:n]
+        nodes = array("i", [0]) * len(edges)
+        kinds = array("b", [0]) * len(edges)
+        for edge in edges:
+            v = edge[key]
+            i = fill[v]
+            nodes[i] = edge[value]
+            kinds[i] = edge[2]
+            fill[v] = i + 1
+        return start, nodes, kinds
+
+    def successors(self, v):
+        return self.succ[self.succ_start[v] : self.succ_start[v + 1]]
+
+    def predecessors(self, v):
+        return self.pred[self.pred_start[v] : self.pred_start[v + 1]]
+
+    def edges(self):
+        """Yield the (source, dest, kind) triples of the graph."""
+        succ, succ_kind, succ_start = self.succ, self.succ_kind, self.succ_start
+        for v in range(self.n):
+            for i in range(succ_start[v], succ_start[v + 1]):
+                yield v, succ[i], succ_kind[i]
+
+    def to_dot(self):
+        from lapdecompile.dotio import DotConverter
+
+        return DotConverter.process(self)
+
+    # Traversals from node "root". The graph doesn't change once it
+    # has been built, so each is computed once and the same array is
+    # returned after that; don't modify it.
+
+    def dfs_preorder(self, root):
+        return self.cached("dfs", root)[0]
+
+    def dfs_postorder(self, root):
+        return self.cached("dfs", root)[1]
+
+    def reverse_postorder(self, root):
+        return self.cached("reverse_postorder", root)
+
+    def bfs(self, root):
+        return self.cached("bfs", root)
+
+    def cached(self, name, root):
+        key = (name, root)
+        order = self.orders.get(key)
+        if order is None:
+            from lapdecompile.traversals import bfs_nodes, dfs_nodes
+
+            if name == "dfs":
+                order = dfs_nodes(self, root)
+            elif name == "reverse_postorder":
+                order = self.dfs_postorder(root)[::-1]
+            else:
+                order = bfs_nodes(self, root)
+            self.orders[key] = order
+        return order
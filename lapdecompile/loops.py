@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+  Loop-nesting forest
+
+  Finds the loops of a control-flow graph, how they nest, and which
+  blocks are their headers, latches and exits, using the algorithm of
+  Havlak, "Nesting of Reducible and Irreducible Loops" (TOPLAS 1997),
+  which also handles loops with more than one entry.
+"""
+
+from array import array
+
+from lapdecompile.graph import BB_LOOP, BB_LOOP_EXIT, BB_LOOP_LATCH
+from lapdecompile.traversals import dfs_tree
+
+loop_flags = set([BB_LOOP, BB_LOOP_EXIT, BB_LOOP_LATCH])
+
+
+class Loop(object):
+    """
+      A loop of the control-flow graph. Blocks are referred to by
+      number. "blocks" holds all of the loop's blocks, including those
+      of loops nested in it; "latches" are the blocks in the loop that
+      jump back to the header, and "exits" the blocks in the loop with
+      a successor outside it. The outermost loops have depth 1.
+      An irreducible loop can be entered other than through its header.
+    """
+
+    def __init__(self, header, irreducible):
+        self.header = header
+        self.irreducible = irreducible
+        self.parent = None
+        self.children = []
+        self.depth = 1
+        self.blocks = set([header])
+        self.latches = set()
+        self.exits = set()
+
+    def __repr__(self):
+        return "Loop(header=%d, depth=%d, blocks=%s%s)" % (
+            self.header,
+            self.depth,
+            sorted(self.blocks),
+            ", irreducible" if self.irreducible else "",
+        )
+
+
+class LoopForest(object):
+    """
+      The loops of ControlFlowGraph "cfg", outermost first in "loops".
+      loop_of[b] is the index in "loops" of the innermost loop
+      containing block number b, or -1.
+
+      The result is also recorded on the blocks: headers get BB_LOOP
+      in their flags, latches BB_LOOP_LATCH and exits BB_LOOP_EXIT.
+      Each block's loop_header is the number of the header of its
+      innermost loop, or None, and its loop_depth the number of loops
+      it is in.
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.loops = []
+        self.loop_of = array("i", [-1]) * len(cfg.blocks)
+        self.find_loops()
+        self.mark_blocks()
+
+    def contains(self, loop, b):
+        """Is block number "b" in loops[loop]?"""
+        i = self.loop_of[b]
+        if i < 0:
+            return False
+        return self.pre[loop] <= self.pre[i] <= self.pre_end[loop]
+
+    def find_loops(self):
+        csr = self.cfg.csr
+        n = csr.n
+        entry = self.cfg.entry_node.number
+        succ, succ_start = csr.succ, csr.succ_start
+        pred, pred_start = csr.pred, csr.pred_start
+
+        # Number the blocks in DFS preorder. From here to the end of
+        # this function, nodes are referred to by that number; "last"
+        # is the largest number among a node's DFS descendants.
+        preorder, parent = dfs_tree(csr, entry)
+        count = len(preorder)
+        number = array("i", [-1]) * n
+        for i, b in enumerate(preorder):
+            number[b] = i
+        last = array("i", range(count))
+        for w in range(count - 1, 0, -1):
+            if last[w] > last[parent[w]]:
+                last[parent[w]] = last[w]
+
+        def is_ancestor(w, v):
+            return w <= v <= last[w]
+
+        back_preds = [[] for _ in range(count)]
+        non_back_preds = [set() for _ in range(count)]
+        for w in range(count):
+            b = preorder[w]
+            for i in range(pred_start[b], pred_start[b + 1]):
+                v = number[pred[i]]
+                if v < 0:
+                    continue
+                if is_ancestor(w, v):
+                    back_preds[w].append(v)
+                else:
+                    non_back_preds[w].add(v)
+
+        # Union-find over nodes; a node is merged into the header of
+        # the loop it ends up in.
+        union = array("i", range(count))
+
+        def find(v):
+            root = v
+            while union[root] != root:
+                root = union[root]
+            while union[v] != root:
+                union[v], v = root, union[v]
+            return root
+
+        header = array("i", [-1]) * count
+        loop_at = {}
+        in_pool = bytearray(count)
+        for w in range(count - 1, -1, -1):
+            pool = []
+            self_loop = False
+            for v in back_preds[w]:
+                if v == w:
+                    self_loop = True
+                else:
+                    v = find(v)
+                    if not in_pool[v]:
+                        in_pool[v] = 1
+                        pool.append(v)
+            irreducible = False
+            worklist = list(pool)
+            while worklist:
+                x = worklist.pop()
+                for y in non_back_preds[x]:
+                    y = find(y)
+                    if not is_ancestor(w, y):
+                        # Entered from outside other than through w
+                        irreducible = True
+                        non_back_preds[w].add(y)
+                    elif y != w and not in_pool[y]:
+                        in_pool[y] = 1
+                        pool.append(y)
+                        worklist.append(y)
+            if not (pool or self_loop):
+                continue
+            loop = Loop(preorder[w], irreducible)
+            loop_at[w] = loop
+            for x in pool:
+                in_pool[x] = 0
+                header[x] = w
+                union[x] = w
+                if x in loop_at:
+                    loop_at[x].parent = loop
+                    loop.children.append(loop_at[x])
+
+        # Number the loops outermost first, and find each block's
+        # innermost loop.
+        loops = self.loops
+        stack = [l for w, l in sorted(loop_at.items(), reverse=True) if not l.parent]
+        while stack:
+            loop = stack.pop()
+            loop.index = len(loops)
+            loops.append(loop)
+            if loop.parent:
+                loop.depth = loop.parent.depth + 1
+            stack.extend(reversed(loop.children))
+        loop_of = self.loop_of
+        for w in range(count):
+            if w in loop_at:
+                loop_of[preorder[w]] = loop_at[w].index
+            elif header[w] >= 0:
+                loop_of[preorder[w]] = loop_at[header[w]].index
+
+        # Interval numbers for contains(), as for dominators
+        self.pre = pre = array("i", range(len(loops)))
+        self.pre_end = pre_end = array("i", range(len(loops)))
+        for loop in reversed(loops):
+            if loop.parent and pre_end[loop.index] > pre_end[loop.parent.index]:
+                pre_end[loop.parent.index] = pre_end[loop.index]
+
+    def mark_blocks(self):
+        blocks, loops, loop_of = self.cfg.blocks, self.loops, self.loop_of
+        csr = self.cfg.csr
+        for block in blocks:
+            block.flags -= loop_flags
+            block.loop_header = None
+            block.loop_depth = 0
+        for loop in loops:
+            blocks[loop.header].flags.add(BB_LOOP)
+
+        for b, block in enumerate(blocks):
+            i = loop_of[b]
+            if i < 0:
+                continue
+            innermost = loops[i]
+            block.loop_header = innermost.header
+            block.loop_depth = innermost.depth
+            loop = innermost
+            while loop:
+                loop.blocks.add(b)
+                loop = loop.parent
+            for j in range(csr.succ_start[b], csr.succ_start[b + 1]):
+                s = csr.succ[j]
+                # Is this an edge back to the header of a loop, or out
+                # of loops?
+                loop = innermost
+                while loop and not self.contains(loop.index, s):
+                    loop.exits.add(b)
+                    block.flags.add(BB_LOOP_EXIT)
+                    loop = loop.parent
+                if BB_LOOP in blocks[s].flags:
+                    target = loops[loop_of[s]]
+                    if self.contains(target.index, b):
+                        target.latches.add(b)
+                        block.flags.add(BB_LOOP_LATCH)
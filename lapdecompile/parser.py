@@ -2,8 +2,13 @@
 """
 
 import re
+from collections import OrderedDict
 from spark_parser import GenericASTBuilder, DEFAULT_DEBUG as PARSER_DEFAULT_DEBUG
-from lapdecompile.bb import compute_stack_change
+from lapdecompile.bb import stack_change_prefix
+from lapdecompile.stack_effect import STACK_EFFECT
+from lapdecompile.graph import BB_LOOP_LATCH
+from lapdecompile.regions import Regions
+from lapdecompile.simplify import HANDLER_INSTRUCTIONS
 
 nop_func = lambda self, args: None
 
@@ -16,14 +21,174 @@ class ParserError(Exception):
         return "Parse error at or near `%r' instruction at offset %s\n" % \
                (self.token, self.offset)
 
+# Control constructs, which should match single-entry single-exit
+# regions of the control-flow graph rather than straddle them.
+REGION_CHECKS = frozenset("""
+and_form cond_form if_else_form if_form or_form when_macro
+while_form1 while_form2
+""".split())
+
 class ElispParser(GenericASTBuilder):
-    def __init__(self, AST, tokens, start='fn_body', debug=PARSER_DEFAULT_DEBUG):
+    def __init__(self, AST, tokens, start='fn_body', debug=PARSER_DEFAULT_DEBUG,
+                 use_regions=False):
         self.tokens = tokens
+        self.start = start
+        # Reject control constructs that cross a region; the tokens'
+        # blocks must have been marked by regions.Regions.
+        self.use_regions = use_regions
         super(ElispParser, self).__init__(AST, start, debug)
         self.collect = frozenset(["exprs", "varlist", "opt_exprs", "labeled_clauses"])
         self.new_rules = set()
+        self.stack_prefix = None
+        self.reduce_memo = {}
+        # Are the parser states shared with other parsers? See copy().
+        self.shared_tables = False
+        # Don't report parse errors, just raise ParserError
+        self.quiet = False
+        # For a parser with a reduced grammar, a parser with the full
+        # grammar for the same tokens, which reports errors. See reduced().
+        self.full = None
+        # If not set, parse errors raise ParserError without a report
+        self.report_errors = True
+        # For a parser of a segment of a function's tokens, the tokens
+        # of the whole function, the index of the segment's first one,
+        # and their stack_change_prefix(), so that reductions are
+        # checked against the tokens around the segment as well.
+        # See parse_segments().
+        self.context = None
+
+    def prepare(self):
+        """Compute the tables parse() needs for the rules as they are
+        now, as parse() itself would. Copies made by copy() afterwards
+        share them until rules are added to the copy."""
+        if self.ruleschanged:
+            self.computeNull()
+            self.newrules = {}
+            self.new2old = {}
+            self.makeNewRules()
+            self.ruleschanged = False
+            self.edges, self.cores = {}, {}
+            self.states = {0: self.makeState0()}
+            self.makeState(0, self._BOF)
+
+    def reduced(self, kinds):
+        """Return a copy of this parser without the rules that can't
+        take part in a parse of tokens whose kinds are in "kinds": those
+        with a terminal not in "kinds", then those with a nonterminal
+        that can't derive anything any more, and finally those for
+        nonterminals not reachable from the start symbol. Parses with
+        the copy are the same as with this parser, but the copy
+        predicts fewer rules."""
+        p = self.copy([], self.use_regions)
+        rules = self.rules
+        kinds = kinds | set([self._BOF])
+        keep = {}
+        for lhs, lhs_rules in rules.items():
+            kept = [
+                rule for rule in lhs_rules
+                if all(sym in rules or sym in kinds for sym in rule[1])
+            ]
+            if kept:
+                keep[lhs] = kept
+
+        changes = True
+        while changes:
+            changes = False
+            for lhs in list(keep):
+                kept = [
+                    rule for rule in keep[lhs]
+                    if all(sym in keep or sym not in rules for sym in rule[1])
+                ]
+                if len(kept) != len(keep[lhs]):
+                    changes = True
+                    if kept:
+                        keep[lhs] = kept
+                    else:
+                        del keep[lhs]
+
+        reachable = set([self._START])
+        stack = [self._START]
+        while stack:
+            for rule in keep.get(stack.pop(), ()):
+                for sym in rule[1]:
+                    if sym in keep and sym not in reachable:
+                        reachable.add(sym)
+                        stack.append(sym)
+        p.rules = {lhs: keep[lhs] for lhs in keep if lhs in reachable}
+        p.ruleschanged = True
+        p.shared_tables = False
+        return p
+
+    def copy(self, tokens, use_regions=False):
+        """Return a parser for "tokens" with the grammar of this one.
+
+        The copy has its own rules, so add_custom_rules() can be called
+        on it without changing this parser. The tables computed from
+        the rules and the parser states found while parsing are shared
+        with this parser and its other copies, until rules are added.
+        The actions of the rules this parser has only build trees, so
+        they serve the copy as well."""
+        # Not copy.copy(): spark's pickling support would read the
+        # grammar again.
+        p = self.__class__.__new__(self.__class__)
+        p.__dict__.update(self.__dict__)
+        p.tokens = tokens
+        p.use_regions = use_regions
+        p.rules = {lhs: list(rules) for lhs, rules in self.rules.items()}
+        p.rule2func = dict(self.rule2func)
+        p.rule2name = dict(self.rule2name)
+        p.list_like_nt = set(self.list_like_nt)
+        p.optional_nt = set(self.optional_nt)
+        p.check_reduce = dict(self.check_reduce)
+        p.new_rules = set(self.new_rules)
+        p.reduce_memo = {}
+        p.shared_tables = True
+        return p
+
+    def parse(self, tokens, debug=None):
+        # The net stack change of tokens[first:last] is
+        # stack_prefix[last] - stack_prefix[first].
+        if self.context is None:
+            self.stack_prefix = stack_change_prefix(tokens)
+        else:
+            self.stack_prefix = self.context[2]
+        self.reduce_memo = {}
+        if self.full is not None and debug and debug.get("reduce"):
+            # Show reductions as they are with the full grammar
+            return self.full.parse(tokens, debug)
+        if debug and debug.get("reduce"):
+            # Build tables of our own, so that what is shown is as it
+            # would be for a parser that didn't share them.
+            self.shared_tables = False
+            self.ruleschanged = True
+        if self.report_errors and (self.ruleschanged or not self.shared_tables):
+            return super(ElispParser, self).parse(tokens, debug)
+
+        # The states shown on a parse error would include those other
+        # parsers sharing the tables found. So parse quietly, and on
+        # an error parse again with tables of our own to report it.
+        self.quiet = True
+        try:
+            return super(ElispParser, self).parse(tokens, debug)
+        except ParserError:
+            if not self.report_errors:
+                raise
+        finally:
+            self.quiet = False
+        if self.full is not None:
+            return self.full.parse(tokens, debug)
+        self.shared_tables = False
+        self.ruleschanged = True
+        self.reduce_memo = {}
+        return super(ElispParser, self).parse(tokens, debug)
+
+    def errorstack(self, tokens, i, full=False):
+        if not self.quiet:
+            super(ElispParser, self).errorstack(tokens, i, full)
 
     def error(self, tokens, index):
+        if self.quiet:
+            raise ParserError(tokens[index], tokens[index].offset)
         # Find the last label
         start, finish = -1, -1
         n = len(tokens)
@@ -51,6 +216,17 @@ class ElispParser(GenericASTBuilder):
         raise ParserError(err_token, err_token.offset)
         return
 
+    def typestring(self, token):
+        # Lets the parser look up terminal transitions by kind directly
+        # rather than comparing the token against each terminal in a state.
+        return token.kind
+
+    def terminal(self, token):
+        # An EXPR token carries the tree of the expression it stands for
+        if token.kind == "EXPR":
+            return token.tree
+        return token
+
     def nonterminal(self, nt, args):
         if nt in self.collect and len(args) > 1:
             #
@@ -104,6 +280,9 @@ class ElispParser(GenericASTBuilder):
         expr  ::= STACK-REF
         expr  ::= VARREF
 
+        # An expression already built by lapdecompile.prereduce
+        expr  ::= EXPR
+
         # Function related
         expr  ::= binary_expr
         expr  ::= binary_expr_stacked
@@ -489,7 +668,10 @@ class ElispParser(GenericASTBuilder):
                 self.add_unique_rule(rule, opname_base)
             pass
         # self.check_reduce['progn'] = 'AST'
+        self.check_reduce['while_form1'] = 'tokens'
         self.check_reduce['while_form2'] = 'AST'
+        self.check_reduce['dolist_macro'] = 'tokens'
+        self.check_reduce['dolist_macro_result'] = 'tokens'
         self.check_reduce['clause'] = 'AST'
         self.check_reduce['cond_form'] = 'AST'
         self.check_reduce['if_form'] = 'AST'
@@ -504,6 +686,9 @@ class ElispParser(GenericASTBuilder):
         self.check_reduce['save_current_buffer_form'] = 'tokens'
         self.check_reduce['setq_form'] = 'tokens'
         self.check_reduce['unary_expr_stacked'] = 'tokens'
+        if self.use_regions:
+            for lhs in REGION_CHECKS:
+                self.check_reduce.setdefault(lhs, 'tokens')
         return
 
     def debug_reduce(self, rule, tokens, parent, last_token_pos):
@@ -514,9 +699,9 @@ class ElispParser(GenericASTBuilder):
         if parent and tokens:
             p_token = tokens[parent]
             if hasattr(p_token, 'offset'):
-                prefix += "%3s" % p_token.offset
+                prefix += "%3s" % p_token.format_offset()
                 if len(rule[1]) > 1:
-                    prefix += '-%-5s ' % tokens[last_token_pos-1].offset
+                    prefix += '-%-5s ' % tokens[last_token_pos-1].format_offset()
                 else:
                     prefix += '       '
         else:
@@ -525,7 +710,63 @@ class ElispParser(GenericASTBuilder):
         print("%s%s ::= %s (%d)" % (prefix, rule[0], ' '.join(rule[1]), last_token_pos))
 
     def reduce_is_invalid(self, rule, ast, tokens, first, last):
+        # The parser asks about the same rule and span of tokens
+        # many times over, from different states. Checks of type 'AST'
+        # look at the tree, which can differ between derivations of
+        # the same span, so only the answers of 'tokens' checks are
+        # remembered.
+        key = None
+        if self.check_reduce[rule[0]] != 'AST':
+            key = (rule, first, last)
+            invalid = self.reduce_memo.get(key)
+            if invalid is not None:
+                return invalid
+        if self.context is not None:
+            tokens, start = self.context[:2]
+            first += start
+            last += start
+        invalid = self.reduce_check(rule, ast, tokens, first, last)
+        if key is not None:
+            self.reduce_memo[key] = invalid
+        return invalid
+
+    @staticmethod
+    def is_latch(token):
+        """Is "token" in a block that jumps back to the top of a loop,
+        going by control-flow analysis? Tokens without a basic block,
+        as when parsing without control-flow analysis, are given the
+        benefit of the doubt."""
+        bb = token.bb
+        return bb is None or BB_LOOP_LATCH in bb.flags
+
+    def while_latch(self, tokens, last):
+        """Does the GOTO before the final "come_froms LABEL" of a while
+        loop ending at tokens[last-1] jump back to the top of the loop?"""
+        i = last - 2
+        while tokens[i] == "COME_FROM":
+            i -= 1
+        return self.is_latch(tokens[i])
+
+    @staticmethod
+    def crosses_region(tokens, first, last):
+        """Do tokens[first:last] start or end part way into a region?
+        A final LABEL belongs to the code that follows, so it isn't
+        counted, and neither are tokens without a basic block."""
+        if last > first and tokens[last - 1] == "LABEL":
+            last -= 1
+        while first < last and tokens[first].bb is None:
+            first += 1
+        while last > first and tokens[last - 1].bb is None:
+            last -= 1
+        if first == last:
+            return False
+        return Regions.crosses(tokens[first].bb, tokens[last - 1].bb)
+
+    def reduce_check(self, rule, ast, tokens, first, last):
         lhs = rule[0]
+        if (self.use_regions and lhs in REGION_CHECKS
+                and self.crosses_region(tokens, first, last)):
+            return True
         if lhs == 'clause' and len(ast) == 3 and ast[0] != 'opt_label':
             # Check that either:
             #   if we have a condition there is a COME_FROM in the end_clause or
@@ -549,11 +790,29 @@ class ElispParser(GenericASTBuilder):
             if rule[1][1].startswith("GOTO"):
                 if last >= len(tokens) - 1:
                     return True
-                if ast[1].offset != str(tokens[last+1].attr):
+                if ast[1].offset not in tokens[last+1].jump_sources():
                     return True
                 pass
             # "name_expr" isn't a valid "expr" for the "then" part of an "if_form"
             return False  # ast[0] == "expr" and ast[0][0] == "name_expr"
+        elif lhs in ("while_form1", "while_form2") and not self.while_latch(tokens, last):
+            return True
+        elif lhs == "dolist_macro":
+            # The GOTO-IF-NOT-NIL before "[CONSTANT] COME_FROM LABEL UNBIND"
+            # should jump back to the top of the loop.
+            i = last - 3
+            while tokens[i] in ("COME_FROM", "CONSTANT"):
+                i -= 1
+            return not self.is_latch(tokens[i])
+        elif lhs == "dolist_macro_result":
+            # Same as above but the GOTO-IF-NOT-NIL is followed by
+            # "COME_FROM LABEL CONSTANT VARSET expr UNBIND"
+            i = last - 2
+            while i > first and not (
+                tokens[i] == "GOTO-IF-NOT-NIL" and tokens[i + 1] == "COME_FROM"
+            ):
+                i -= 1
+            return not self.is_latch(tokens[i])
         elif lhs == "while_form2":
             # Check that "expr" isn't a stacked expression.
             # Otherwise it should be handled by while_expr1
@@ -562,7 +821,7 @@ class ElispParser(GenericASTBuilder):
                 expr = expr[0]
             return expr.kind.endswith("stacked")
         elif lhs == "expr_stmt":
-            stack_change = compute_stack_change(tokens[first:last])
+            stack_change = self.stack_prefix[last] - self.stack_prefix[first]
             # Below, the various instructions test for instructions marking the
             # end of a basic block.
             # FIXME: should we do something more precise?
@@ -615,3 +874,197 @@ class ElispParser(GenericASTBuilder):
                 pass
         return False
     pass
+
+
+# The parser each new_parser() copies, by AST class and start symbol
+prototypes = {}
+
+class ReducedParsers(object):
+    """
+      The parsers with reduced grammars that new_parser() has made, for
+      reuse. A parser reduced for a set of token kinds and custom rules
+      parses any tokens with only some of those kinds and rules the
+      same as the full grammar does, so a lookup takes the smallest
+      one kept that covers what is asked for. At most "size" parsers
+      are kept; the least recently used one goes first. "hits" and
+      "misses" count lookups.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        # (AST, start, use_regions, kinds, new_rules) -> parser, or
+        # False if nothing can be parsed with those kinds
+        self.parsers = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, AST, start, use_regions, kinds, new_rules):
+        """Return a kept parser for tokens of kinds "kinds" with custom
+        rules "new_rules", False if no such tokens can be parsed, or
+        None if there is none"""
+        parsers = self.parsers
+        key = (AST, start, use_regions, kinds, new_rules)
+        if key not in parsers:
+            key = None
+            for k in parsers:
+                if (
+                    k[:3] == (AST, start, use_regions)
+                    and kinds <= k[3] and new_rules <= k[4]
+                    and (key is None or len(k[3]) < len(key[3]))
+                ):
+                    key = k
+            if key is None:
+                self.misses += 1
+                return None
+        self.hits += 1
+        parsers.move_to_end(key)
+        return parsers[key]
+
+    def add(self, AST, start, use_regions, kinds, new_rules, parser):
+        parsers = self.parsers
+        parsers[AST, start, use_regions, kinds, new_rules] = parser
+        while len(parsers) > self.size:
+            parsers.popitem(last=False)
+
+
+# How many parsers with reduced grammars new_parser() keeps. Each
+# holds the parser states built for the parses it has done.
+REDUCED_PARSERS = 32
+
+reduced_parsers = ReducedParsers(REDUCED_PARSERS)
+
+
+def new_parser(AST, tokens, use_regions=False, customize=None, start="fn_body"):
+    """Return an ElispParser for "tokens". The grammar is read and its
+    tables are built once per process, and then copied for each
+    function.
+
+    If "customize" is given, the custom rules for it are added, and
+    the parser returned has only the rules that can match "tokens".
+    The last REDUCED_PARSERS parsers with reduced grammars are kept
+    for reuse with tokens of the same kinds or fewer; see
+    ReducedParsers."""
+    prototype = prototypes.get((AST, start))
+    if prototype is None:
+        prototype = prototypes[AST, start] = ElispParser(AST, [], start)
+        prototype.prepare()
+    p = prototype.copy(tokens, use_regions)
+    if customize is None:
+        return p
+
+    p.add_custom_rules(tokens, customize)
+    kinds = frozenset(token.kind for token in tokens)
+    new_rules = frozenset(p.new_rules)
+    reduced = reduced_parsers.get(AST, start, use_regions, kinds, new_rules)
+    if reduced is None:
+        reduced = p.reduced(kinds)
+        if p._START in reduced.rules:
+            reduced.prepare()
+        else:
+            # Nothing can be parsed; the full grammar reports that.
+            reduced = False
+        reduced_parsers.add(AST, start, use_regions, kinds, new_rules, reduced)
+    if reduced is False:
+        return p
+    q = reduced.copy(tokens, use_regions)
+    q.full = p
+    return q
+
+
+# Parse segments of at least this many tokens; see parse_segments().
+SEGMENT_SIZE = 200
+
+# Instructions that start a dynamic binding or other scope that UNBIND
+# ends, and handlers that POPHANDLER ends.
+SCOPE_INSTRUCTIONS = frozenset(
+    """
+VARBIND SAVE-EXCURSION SAVE-CURRENT-BUFFER SAVE-RESTRICTION UNWIND-PROTECT
+""".split()
+)
+
+
+def segment_cuts(tokens, size=SEGMENT_SIZE):
+    """Return indexes at which "tokens" can be cut into runs of whole
+    top-level statements, each at least "size" tokens long. At a cut
+    the stack is as deep as it was at the start, no jump or handler
+    label is on the other side of it, and no binding or handler is in
+    effect."""
+    n = len(tokens)
+    labels = {}
+    for i, token in enumerate(tokens):
+        if token.kind == "LABEL":
+            labels[token.attr] = i
+
+    # covered[i] counts the jumps from one side of a cut before
+    # tokens[i] to the other.
+    covered = [0] * (n + 1)
+    for i, token in enumerate(tokens):
+        kind = token.kind
+        if kind.startswith("GOTO") or kind in HANDLER_INSTRUCTIONS:
+            target = labels.get(token.attr)
+            if target is None:
+                return []
+            lo, hi = min(i, target), max(i, target)
+            # The COME_FROMs before the label go with it.
+            while lo > 0 and tokens[lo - 1] == "COME_FROM":
+                lo -= 1
+            covered[lo + 1] += 1
+            covered[hi + 1] -= 1
+
+    cuts = []
+    depth = crossing = scopes = 0
+    last = 0
+    for i, token in enumerate(tokens):
+        crossing += covered[i]
+        if (
+            depth == 0 and crossing == 0 and scopes == 0
+            and i - last >= size and n - i >= size
+        ):
+            cuts.append(i)
+            last = i
+        depth += STACK_EFFECT[token.op]
+        kind = token.kind
+        if kind in SCOPE_INSTRUCTIONS or kind in HANDLER_INSTRUCTIONS:
+            scopes += 1
+        elif kind == "UNBIND":
+            scopes -= int(token.attr)
+        elif kind == "POPHANDLER":
+            scopes -= 1
+    return cuts
+
+
+def parse_segments(AST, tokens, customize, use_regions=False, debug=None,
+                   size=SEGMENT_SIZE):
+    """Parse "tokens" as a function body, like new_parser(...).parse(),
+    but in segments cut by segment_cuts(). The segments before the
+    last are parsed as "body", and their statements are put in front
+    of those of the last one's. If a segment doesn't parse on its own,
+    the whole of "tokens" is parsed at once."""
+    cuts = segment_cuts(tokens, size)
+    prefix = stack_change_prefix(tokens)
+
+    def parse_segment(first, last, start):
+        segment = tokens[first:last]
+        p = new_parser(AST, segment, use_regions, customize, start)
+        for q in (p, p.full):
+            if q is not None:
+                q.report_errors = False
+                q.context = (tokens, first, prefix)
+        return p.parse(segment, debug)
+
+    if cuts:
+        bodies = []
+        first = 0
+        try:
+            for cut in cuts:
+                bodies.append(parse_segment(first, cut, "body"))
+                first = cut
+            ast = parse_segment(first, len(tokens), "fn_body")
+        except ParserError:
+            pass
+        else:
+            # fn_body ::= body ..., and body ::= exprs
+            exprs = ast[0][0]
+            exprs[:0] = [stmt for body in bodies for stmt in body[0]]
+            return ast
+    p = new_parser(AST, tokens, use_regions, customize)
+    return p.parse(tokens, debug)
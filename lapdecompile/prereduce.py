@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+  Pre-reduction of simple expressions
+
+  Most of a function's tokens are simple expressions in postfix form,
+  such as "constant f; varref x; car; call 1" for (f (car x)). There is
+  only one way to parse these, yet the Earley parser goes through
+  prediction and completion for each token of them. An optional linear
+  pass, run after the tokens are ingested and before they are parsed,
+  replaces each run of tokens that makes up such an expression with
+  one EXPR token carrying the tree the parser would have built; the
+  grammar has "expr ::= EXPR". The parser is left with the control
+  flow and statement structure.
+
+  Which tokens start, end and combine expressions is read off the
+  grammar rules rather than listed here; see Prereducer.
+"""
+
+from lapdecompile.bb import JUMP_INSTRUCTIONS
+from lapdecompile.parser import new_parser
+from lapdecompile.stack_effect import OP_EXPR
+from lapdecompile.tok import Token
+
+# The setq_form reduction check looks at whether the token before it
+# is one of these, so they have to stay tokens.
+CHECKED_KINDS = frozenset(["STRING="])
+
+
+class ExprToken(Token):
+    """
+      A run of tokens that make up an expression, as a single token of
+      kind EXPR. "tree" is the tree of the expression, which goes below
+      an "expr" node. Offset, label and basic block are those of the
+      first token of the run; the attr is the kind of the tree.
+    """
+
+    __slots__ = ("tree",)
+
+    def __init__(self, tree, first):
+        super(ExprToken, self).__init__(
+            "EXPR", tree.kind, first.offset, OP_EXPR, first.label
+        )
+        self.bb = first.bb
+        self.tree = tree
+
+
+class Prereducer(object):
+    """
+      Tables for prereduce(), read off the rules of ElispParser
+      "parser".
+
+      An operand is a symbol that an expression fills: "expr" itself,
+      a nonterminal with a rule "X ::= expr", or a nonterminal X with
+      "expr ::= X", which is filled by an expression built as X.
+
+      "reductions" maps each token kind that ends an expression to the
+      rule it is reduced by: a rule "L ::= operand ... T" or "L ::=
+      operand ... C" where C has only rules "C ::= T", and either L is
+      "expr" or there is a rule "expr ::= L". Kinds that end more than
+      one such rule are left out, as are rules whose reductions are
+      checked, since those depend on what is around them, and jumps,
+      which the parser needs to see.
+
+      "sequences" are the runs of two or more terminals in the
+      grammar's rules, such as "VARREF CAR VARSET". Tokens in such a
+      run are parsed as written, so they are left alone.
+    """
+
+    def __init__(self, parser):
+        rules = parser.rules
+        self.AST = parser.AST
+        expr_rules = set(rhs[0] for lhs, rhs in rules.get("expr", []) if len(rhs) == 1)
+
+        # Operand symbol -> how to get it from an "expr" tree. None
+        # means wrap the tree, a string means take the tree's child of
+        # that kind.
+        self.operands = {"expr": False}
+        for lhs, lhs_rules in rules.items():
+            for _, rhs in lhs_rules:
+                if rhs == ("expr",):
+                    self.operands[lhs] = None
+        for nt in expr_rules:
+            if nt in rules and nt not in self.operands:
+                self.operands[nt] = nt
+
+        # Nonterminals standing for any of a class of terminals, such
+        # as binary_op
+        classes = {}
+        for lhs, lhs_rules in rules.items():
+            if all(len(rhs) == 1 and rhs[0] not in rules for _, rhs in lhs_rules):
+                classes[lhs] = [rhs[0] for _, rhs in lhs_rules]
+
+        candidates = {}
+        self.sequences = set()
+        for lhs, lhs_rules in rules.items():
+            for rule in lhs_rules:
+                rhs = rule[1]
+                run = []
+                for sym in rhs + (None,):
+                    if sym is not None and sym not in rules:
+                        run.append(sym)
+                        continue
+                    if len(run) > 1:
+                        self.sequences.add(tuple(run))
+                    run = []
+                if not rhs or not all(sym in self.operands for sym in rhs[:-1]):
+                    continue
+                last = rhs[-1]
+                if len(rhs) == 1 and last in self.operands:
+                    # A rule like "expr ::= name_expr"; name_expr's own
+                    # rules are what reduce.
+                    continue
+                if lhs in classes and lhs not in expr_rules:
+                    # A rule like "binary_op ::= PLUS", which is part of
+                    # the rules it is the class in.
+                    continue
+                if last in classes:
+                    kinds = classes[last]
+                elif last not in rules:
+                    kinds = [last]
+                else:
+                    continue
+                for kind in kinds:
+                    candidates.setdefault(kind, []).append(rule)
+
+        self.reductions = {}
+        for kind, kind_rules in candidates.items():
+            unchecked = [r for r in kind_rules if r[0] not in parser.check_reduce]
+            if (len(unchecked) != 1 or kind in CHECKED_KINDS
+                    or kind in JUMP_INSTRUCTIONS):
+                continue
+            lhs, rhs = rule = unchecked[0]
+            if (lhs == "expr" or lhs in expr_rules) and lhs not in parser.check_reduce:
+                self.reductions[kind] = rule
+
+        self.sequence_starts = {}
+        for sequence in self.sequences:
+            self.sequence_starts.setdefault(sequence[0], []).append(sequence)
+
+    def operand(self, sym, tree):
+        """Return "tree", an "expr", as operand "sym", or None if it
+        can't be one."""
+        how = self.operands[sym]
+        if how is False:
+            return tree
+        if how is None:
+            return self.AST(sym, [tree])
+        if tree[0] == how:
+            return tree[0]
+        return None
+
+    def in_sequences(self, tokens):
+        """Mark the tokens that are part of one of "sequences" """
+        marked = bytearray(len(tokens))
+        for i, token in enumerate(tokens):
+            for sequence in self.sequence_starts.get(token.kind, ()):
+                end = i + len(sequence)
+                if end <= len(tokens) and all(
+                    tokens[j] == kind for j, kind in zip(range(i, end), sequence)
+                ):
+                    marked[i:end] = b"\1" * len(sequence)
+        return marked
+
+    def reduce(self, tokens):
+        """Return "tokens" with the runs that make up an expression of
+        more than one token replaced by ExprTokens. This is shift-reduce
+        parsing of postfix code: a token in "reductions" whose operands
+        are the expressions just before it replaces them with one."""
+        AST = self.AST
+        marked = self.in_sequences(tokens)
+        result = []
+        # The expressions that end at the current token, innermost
+        # last, as (tree, index of first token, number of tokens)
+        stack = []
+
+        def flush():
+            for tree, first, count in stack:
+                if count == 1:
+                    result.append(tokens[first])
+                else:
+                    result.append(ExprToken(tree[0], tokens[first]))
+            del stack[:]
+
+        for i, token in enumerate(tokens):
+            rule = None if marked[i] else self.reductions.get(token.kind)
+            if rule is not None:
+                lhs, rhs = rule
+                arity = len(rhs) - 1
+                args = None
+                if arity <= len(stack):
+                    args = []
+                    for sym, (tree, _, _) in zip(rhs, stack[len(stack) - arity:]):
+                        arg = self.operand(sym, tree)
+                        if arg is None:
+                            args = None
+                            break
+                        args.append(arg)
+                if args is not None:
+                    last = rhs[-1]
+                    args.append(token if last == token.kind else AST(last, [token]))
+                    tree = AST(lhs, args)
+                    if lhs != "expr":
+                        tree = AST("expr", [tree])
+                    first, count = i, 1
+                    if arity:
+                        first = stack[-arity][1]
+                        count += sum(c for _, _, c in stack[-arity:])
+                        del stack[-arity:]
+                    stack.append((tree, first, count))
+                    continue
+            flush()
+            result.append(token)
+        flush()
+        return result
+
+
+# Prereducer by AST class
+prereducers = {}
+
+
+def prereduce(AST, tokens):
+    """Return "tokens" with each run of tokens making up a simple
+    expression replaced by an ExprToken for it"""
+    prereducer = prereducers.get(AST)
+    if prereducer is None:
+        parser = new_parser(AST, [])
+        # The reduction checks are set up along with the custom rules
+        parser.add_custom_rules([], {})
+        prereducer = prereducers[AST] = Prereducer(parser)
+    return prereducer.reduce(tokens)
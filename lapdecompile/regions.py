@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+  Single-entry single-exit regions
+
+  Structured code, such as the code Emacs compiles an "if", "cond" or
+  "while" to, takes up a run of consecutive blocks that control enters
+  only at the first block and leaves only to the block just after the
+  last one. Finding these regions up front tells the parser where a
+  control construct can begin and end.
+
+  The regions only prune: the parser still builds every construct
+  from the flat token stream, and rejects a reduction that crosses a
+  region boundary. They aren't turned into subtrees ahead of parsing.
+"""
+
+from array import array
+
+# Candidate regions up to this many blocks long are checked block by
+# block rather than with range tables.
+SCAN_LIMIT = 64
+
+
+class Region(object):
+    """
+      Blocks "first" through "last", by number. Control enters the
+      region only at block "first" and leaves it only to block last + 1,
+      which post-dominates "first", or by returning. "parent" is the
+      smallest region containing this one, or None.
+    """
+
+    def __init__(self, first, last):
+        self.first = first
+        self.last = last
+        self.parent = None
+
+    def __repr__(self):
+        return "Region(%d..%d)" % (self.first, self.last)
+
+
+def range_table(values, pick):
+    """Sparse table of "values" for range queries of "pick", which
+    is min or max. table[k][i] is "pick" of values[i : i + 2**k]."""
+    table = [values]
+    n = len(values)
+    k = 1
+    while 2 * k <= n:
+        row = table[-1]
+        m = n - 2 * k + 1
+        table.append(array("i", map(pick, row[:m], row[k : k + m])))
+        k *= 2
+    return table
+
+
+def range_query(table, pick, lo, hi):
+    """"pick" of the values from index "lo" through "hi" """
+    k = (hi - lo + 1).bit_length() - 1
+    row = table[k]
+    return pick(row[lo], row[hi - (1 << k) + 1])
+
+
+class Regions(object):
+    """
+      The single-entry single-exit regions of ControlFlowGraph "cfg",
+      in "regions", ordered by first block and then outermost first.
+
+      For each block a, the candidate region runs from a up to its
+      immediate post-dominator; it is kept if no block after a in it
+      has a predecessor outside it, and no block in it has a successor
+      outside it other than the post-dominator. Candidates that
+      overlap a region already kept without nesting in it are dropped,
+      so that the regions form a tree. Each block's "region" is set to
+      the smallest region containing it, or None.
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.regions = []
+        self.find_regions()
+        self.mark_blocks()
+
+    def find_regions(self):
+        csr = self.cfg.csr
+        n = csr.n
+        if n < 2:
+            return
+        ipdom = self.cfg.post_dominators().idom
+
+        # The lowest and highest numbered predecessor and successor of
+        # each block.
+        min_pred, max_pred = array("i", [n]) * n, array("i", [-1]) * n
+        min_succ, max_succ = array("i", [n]) * n, array("i", [-1]) * n
+        for a, b, kind in csr.edges():
+            min_pred[b] = min(min_pred[b], a)
+            max_pred[b] = max(max_pred[b], a)
+            min_succ[a] = min(min_succ[a], b)
+            max_succ[a] = max(max_succ[a], b)
+
+        # Most candidates are a few blocks long and are checked by
+        # looking at each block. Range tables, which take n log n time
+        # to build, are built only once a long candidate turns up.
+        tables = None
+        candidates = []
+        for first in range(n):
+            exit = ipdom[first]
+            # Regions of one block tell the parser nothing
+            if exit <= first + 1:
+                continue
+            last = exit - 1
+            if exit - first <= SCAN_LIMIT:
+                single_entry_exit = (
+                    min(min_pred[first + 1 : exit]) >= first
+                    and max(max_pred[first + 1 : exit]) <= last
+                    and min(min_succ[first:exit]) >= first
+                    and max(max_succ[first:exit]) <= exit
+                )
+            else:
+                if tables is None:
+                    tables = (
+                        range_table(min_pred, min),
+                        range_table(max_pred, max),
+                        range_table(min_succ, min),
+                        range_table(max_succ, max),
+                    )
+                single_entry_exit = (
+                    range_query(tables[0], min, first + 1, last) >= first
+                    and range_query(tables[1], max, first + 1, last) <= last
+                    and range_query(tables[2], min, first, last) >= first
+                    and range_query(tables[3], max, first, last) <= exit
+                )
+            if single_entry_exit:
+                candidates.append(Region(first, last))
+
+        # Keep the regions that nest, as a stack of open regions.
+        candidates.sort(key=lambda r: (r.first, -r.last))
+        stack = []
+        for region in candidates:
+            while stack and stack[-1].last < region.first:
+                stack.pop()
+            if stack:
+                if region.last > stack[-1].last:
+                    continue
+                region.parent = stack[-1]
+            self.regions.append(region)
+            stack.append(region)
+
+    def mark_blocks(self):
+        blocks = self.cfg.blocks
+        for block in blocks:
+            block.region = None
+        # Inner regions come later, so they win.
+        for region in self.regions:
+            for b in range(region.first, region.last + 1):
+                blocks[b].region = region
+
+    @staticmethod
+    def crosses(first, last):
+        """Do blocks "first" through "last" overlap a region without
+        either containing the other? "first" and "last" are basic
+        blocks whose regions have been marked."""
+        sb, eb = first.number, last.number
+        region = first.region
+        while region:
+            if sb > region.first and eb > region.last:
+                return True
+            region = region.parent
+        region = last.region
+        while region:
+            if sb < region.first and eb < region.last:
+                return True
+            region = region.parent
+        return False
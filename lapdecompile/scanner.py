@@ -2,174 +2,360 @@
 
 We take input from ELISP disassembly
 """
+import mmap
 import re
 from lapdecompile.tok import Token
+from lapdecompile.stack_effect import OP_CONSTANT, OP_LABEL, OpcodeError, opcode
 from collections import namedtuple
 
+# An instruction line looks like:
+#    <offset>[:<label>]  <opname>  [<operand>]
+# Nested functions are indented, and the label can be joined to the opname
+# with no intervening space.
+INSTRUCTION = re.compile(r"^\s*(\d+)(?::(\d+))?\s*([^\s\d]\S*)\s*(.*?)\s*$")
+
+FN_HEADER = re.compile(r"^byte code(?: for (?:(macro) )?(\S+))?:$")
+DOC = re.compile(r"\s+doc:(.*)")
+DOC_START = re.compile(r"^\s+doc-start (\d+):  (.*)$")
+ARGS = re.compile(r"^\s+args: (?:(\([^)]*\))|nil)")
+INTERACTIVE = re.compile(r"^\s+interactive:\s+(.*)$")
+
+# Map an opname to its token kind and argument count. A count of -1
+# means that the count is the instruction operand and gets appended to
+# the kind, e.g. "call 2" is CALL_2. A count of None means the
+# instruction doesn't take a count. Opnames not listed here get added
+# the first time they are seen.
+OPNAME2KIND = {
+    "call": ("CALL", -1),
+    "concatN": ("CONCATN", -1),
+    "discardN": ("DISCARDN", -1),
+    "discardN-preserve-tos": ("DISCARDN-PRESERVE-TOS", -1),
+    "insertN": ("INSERTN", -1),
+    "listN": ("LISTN", -1),
+}
+for i in range(1, 5):
+    OPNAME2KIND["list%d" % i] = ("LIST_%d" % i, i)
+for i in range(2, 5):
+    OPNAME2KIND["concat%d" % i] = ("CONCAT_%d" % i, i)
+
+# Instructions whose operand is a label number
+JUMP_OPNAMES = frozenset(
+    """
+goto goto-if-nil goto-if-not-nil goto-if-nil-else-pop goto-if-not-nil-else-pop
+pushcatch pushconditioncase
+""".split()
+)
+
+def add_instruction(tokens, customize, offset, opname, operand, label=None):
+    """Append to "tokens" the Token for a non-constant instruction,
+    recording in "customize" the counts of CALL, LIST, and CONCAT
+    instructions. "offset" and "label" are ints; "operand" is a
+    string as it appears in LAP text. The operand of a jump becomes
+    the int label number. Return False if the operand can't be handled,
+    and raise OpcodeError if "opname" isn't a known instruction.
+    """
+    opinfo = OPNAME2KIND.get(opname)
+    if opinfo is None:
+        opinfo = OPNAME2KIND[opname] = (opname.upper(), None)
+    kind, count = opinfo
+    if count == -1:
+        count = int(operand)
+        kind = "%s_%d" % (kind, count)
+    if count is not None:
+        tokens.append(Token(kind, count, offset, opcode(kind), label=label))
+        customize[kind] = count
+    elif not operand:
+        tokens.append(Token(kind, None, offset, opcode(kind), label=label))
+    elif opname in JUMP_OPNAMES:
+        tokens.append(Token(kind, int(operand), offset, opcode(kind), label=label))
+    elif " " not in operand and "\t" not in operand:
+        tokens.append(Token(kind, operand, offset, opcode(kind), label=label))
+    else:
+        return False
+    return True
+
+
+# "labels" maps each label number to the index in "tokens" of its
+# LABEL token.
 Func = namedtuple(
     "Func", ["name", "args", "opt_args", "docstring", "interactive", "fn_type",
-             "tokens", "customize"]
+             "tokens", "customize", "labels"]
 )
 
 
 class LapScanner:
-    def __init__(self, fp, show_assembly=False):
+    """Scans LAP text into Func records.
+
+    By default the whole file is scanned up front and the functions
+    are stored in the dictionary self.fns. When "lazy" is set,
+    nothing is read until fn_scanner() is iterated; each Func is then
+    yielded as soon as its "byte code for ...:" section ends and is
+    not retained by the scanner. That way memory stays bounded by the
+    largest single function rather than by the size of the file.
+    """
+
+    def __init__(self, fp, show_assembly=False, lazy=False):
         self.last_compiled_function = 0
-        self.lines = fp.readlines()
-        self.line_count = len(self.lines)
-        self.cur_index = 0
         self.show_assembly = show_assembly
         self.fp = fp
+        self.line_count = 0
+        self.pushed_back = None
         self.fns = {}
+        # The number of functions that couldn't be scanned and were
+        # skipped
+        self.errors = 0
 
-        self.fn_scanner()
+        if not lazy:
+            for fn in self.fn_scanner():
+                self.fns[fn.name] = fn
+
+    def next_line(self):
+        """Return the next line of input, or "" at end of file"""
+        if self.pushed_back is not None:
+            line = self.pushed_back
+            self.pushed_back = None
+        else:
+            line = self.fp.readline()
+        if line:
+            self.line_count += 1
+        return line
+
+    def push_back(self, line):
+        """Arrange for the next call to next_line() to return "line" again"""
+        self.pushed_back = line
+        if line:
+            self.line_count -= 1
+
+    def next_instruction(self):
+        """If the next line of input is an instruction, consume it and
+        return its (offset, label, opname, operand) fields. The offset
+        is an int and so is the label, if there is one; the others are
+        strings. Otherwise leave the line unread and return None."""
+        line = self.next_line()
+        m = INSTRUCTION.match(line)
+        if m is None:
+            self.push_back(line)
+            return None
+        offset, label, opname, operand = m.groups()
+        return int(offset), label and int(label), opname, operand
 
     def fn_scanner(self):
+        """Generator yielding a Func for each function in the input.
+        Nested compiled functions are yielded before the function that
+        contains them."""
         anonymous_count = 0
-        while self.cur_index < self.line_count:
-            line = self.lines[self.cur_index]
-            self.cur_index += 1
-            fn_type = "defun"
-            m = re.match("^byte code for macro (\S+):$", line)
+        while True:
+            line = self.next_line()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            m = FN_HEADER.match(line)
             if m:
-                fn_type = "defmacro"
-                name = m.group(1)
-            else:
-                m = re.match("^byte code for (\S+):$", line)
-                if m:
-                    name = m.group(1)
-                elif re.match("^byte code:$", line):
+                if m.group(2) is None:
                     fn_type = "file"
                     name = f"anonymous{anonymous_count}"
                     anonymous_count += 1
                 else:
-                    name = "unknown"
-                    pass
-                pass
+                    fn_type = "defmacro" if m.group(1) else "defun"
+                    name = m.group(2)
+            else:
+                fn_type = "defun"
+                name = "unknown"
 
             self.name = name
-            self.fn_scanner_internal(name, fn_type)
+            yield from self.fn_scanner_internal(name, fn_type)
             pass
         return
 
+    def cant_handle(self, name, error):
+        """Report that function "name" is skipped because of "error" """
+        print("Can't handle function %s, %s" % (name, error))
+        self.errors += 1
+
     def fn_scanner_internal(self, name, fn_type):
 
         tokens = []
         customize = {}
+        labels = {}
+        # Why the function is skipped, once its lines have been read
+        error = None
 
-        line = self.lines[self.cur_index]
-        m = re.match("\s+doc:(.*)", line)
+        line = self.next_line()
+        m = DOC.match(line)
         if m:
             docstring = '\n"%s"\n' % m.group(1).rstrip("\n")
-        elif re.match("\s+doc-start ", line):
-            m = re.match("^\s+doc-start (\d+):  (.*)$", line)
+        else:
+            m = DOC_START.match(line)
             if m:
                 tot_len = int(m.group(1))
                 docstring = '\n  "' + m.group(2) + "\n"
                 l = len(m.group(2))
                 while l < tot_len - 1:
-                    self.cur_index += 1
-                    line = self.lines[self.cur_index]
+                    line = self.next_line()
                     l += len(line)
                     docstring += line
                     pass
                 docstring = docstring.rstrip("\n")
                 docstring += '"'
-                pass
-        else:
-            docstring = ""
-            self.cur_index -= 1
+            else:
+                docstring = ""
+                self.push_back(line)
 
-        self.cur_index += 1
-        line = self.lines[self.cur_index]
-        m = re.match("^\s+args: (\([^)]*\))", line)
+        line = self.next_line()
+        m = ARGS.match(line)
         if m:
-            args = m.group(1)
-            self.cur_index += 1
-        elif re.match("^\s+args: nil", line):
-            args = "()"
-            self.cur_index += 1
+            args = m.group(1) or "()"
         else:
             args = "(?)"
+            self.push_back(line)
 
-        line = self.lines[self.cur_index]
+        line = self.next_line()
         interactive = None
-        m = re.match("^\s+interactive:\s+(.*)$", line)
+        m = INTERACTIVE.match(line)
         if m:
             interactive = m.group(1).rstrip("\n")
-            self.cur_index += 1
+        else:
+            self.push_back(line)
 
-        label = None
-        while self.cur_index < self.line_count:
-            line = self.lines[self.cur_index]
-            if re.match("^byte code:", line):
-                break
-            elif line.startswith("#"):
-                self.cur_index += 1
+        while True:
+            fields = self.next_instruction()
+            if fields is None:
+                line = self.next_line()
+                if not line:
+                    break
+                elif line.startswith("byte code"):
+                    self.push_back(line)
+                    break
+                elif line.startswith("#"):
+                    continue
+                elif not line.strip():
+                    break
+                print("Can't handle line %d:\n\t%s" % (self.line_count, line))
                 continue
-            fields = line.split()
-            if len(fields) == 0:
-                break
-            joined_field = re.match(r"(\d+:\d+)(\D.+)", fields[0])
-            if joined_field:
-                fields[0] = joined_field.group(1)
-                fields.insert(1, joined_field.group(2))
-            offset = fields[0]
-            colon_point = offset.find(":")
-            if colon_point >= 0:
-                label = offset[colon_point:]
-                offset = offset[:colon_point]
-                tokens.append(Token("LABEL", label, offset))
-            offset, opname = fields[:2]
+            offset, label, opname, operand = fields
+            if label is not None:
+                labels[label] = len(tokens)
+                tokens.append(Token("LABEL", label, offset, OP_LABEL))
             if opname == "constant":
-                attr = line[line.index("constant") + len("constant"):].strip()
-                attr = attr.replace("\?", "?")
+                attr = operand.replace("\\?", "?")
                 if attr == "<compiled-function>":
                     fn_name = "compiled-function-%d" % self.last_compiled_function
                     self.last_compiled_function += 1
-                    self.cur_index += 1
-                    self.fn_scanner_internal(fn_name, fn_type="defun")
-                    attr = self.fns[fn_name]
-                tokens.append(Token("CONSTANT", attr, offset.strip(), label=label))
-            elif opname[:-1] in ("list", "concat", "cal"):
-                if opname.startswith("call"):
-                    count = int(fields[2])
-                    opname = "%s_%d" % (opname, count)
-                elif opname[-1] == "N":
-                    count = int(fields[2])
-                    opname = "%s_%d" % (opname, count)
-                else:
-                    count = int(opname[-1])
-                    opname = "%s_%d" % (opname[:-1], count)
-                opname = opname.upper().strip()
-                tokens.append(Token(opname, count, offset.strip(), label=label))
-                customize[opname] = int(count)
-            elif len(fields) == 3:
-                offset, opname, attr = fields
-                tokens.append(
-                    Token(
-                        opname.upper().strip(),
-                        attr.strip(),
-                        offset.strip(),
-                        label=label,
-                    )
-                )
-            elif len(fields) == 2:
-                offset, opname = fields
-                tokens.append(Token(opname.upper().strip(), None, offset.strip()))
-                pass
+                    # The nested function is yielded before us; the last
+                    # Func it produces is the nested function itself.
+                    attr = None
+                    for attr in self.fn_scanner_internal(fn_name, fn_type="defun"):
+                        yield attr
+                    if attr is None or attr.name != fn_name:
+                        error = error or "can't scan %s" % fn_name
+                tokens.append(Token("CONSTANT", attr, offset, OP_CONSTANT, label=label))
             else:
-                print("Can't handle line %d:\n\t%s" % (self.cur_index, line))
-            label = None
-            self.cur_index += 1
+                try:
+                    handled = add_instruction(tokens, customize, offset, opname,
+                                              operand, label)
+                except OpcodeError as e:
+                    error = error or "line %d, %s" % (self.line_count, e)
+                    continue
+                if not handled:
+                    error = error or "line %d, operand of %s: %s" % (
+                        self.line_count, opname, operand)
             pass
 
+        if error is not None:
+            self.cant_handle(name, error)
+            return
+
         if self.show_assembly:
             print(f"\n{name}{args}")
             print("\n".join([str(t) for t in tokens]))
 
-        self.fns[name] = Func(name, args, None, docstring, interactive,
-                              fn_type, tokens, customize)
+        yield Func(name, args, None, docstring, interactive,
+                   fn_type, tokens, customize, labels)
+
+
+# The bytes counterpart of INSTRUCTION. Since it is matched directly
+# against the mapped file rather than a single line, it must not run
+# past the end of the line, which may be a CRLF. Trailing blanks in the
+# operand are stripped after matching.
+INSTRUCTION_BYTES = re.compile(
+    rb"[ \t]*(\d+)(?::(\d+))?[ \t]*([^\s\d]\S*)[ \t]*([^\r\n]*)(?:\r?\n|\Z)"
+)
+
+
+class MmapLapScanner(LapScanner):
+    """A LapScanner that memory-maps its input and works on bytes.
+
+    Instruction lines are matched in place in the mapped file, so no
+    string is built for the line as a whole; only the fields that end
+    up in a Token are decoded. Headers, docstrings and other lines
+    that are seldom seen go through next_line() as before.
+
+    The file is unmapped once fn_scanner() has been run through.
+    """
+
+    def __init__(self, fp, show_assembly=False, lazy=False):
+        try:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped.
+            self.mm = b""
+        self.pos = self.last_pos = 0
+
+        # Cache of opname bytes to str
+        self.opnames = {}
+        super(MmapLapScanner, self).__init__(fp, show_assembly, lazy)
+
+    def fn_scanner(self):
+        try:
+            yield from super(MmapLapScanner, self).fn_scanner()
+        finally:
+            self.close()
+
+    def close(self):
+        """Unmap the input file"""
+        if isinstance(self.mm, mmap.mmap):
+            self.mm.close()
+        self.mm = b""
+        self.pos = self.last_pos = 0
+
+    def next_line(self):
+        """Return the next line of input, or "" at end of file. As with
+        a file opened in text mode, a CRLF line ending comes back as
+        "\\n"."""
+        mm, pos = self.mm, self.pos
+        if pos >= len(mm):
+            return ""
+        end = mm.find(b"\n", pos)
+        end = len(mm) if end < 0 else end + 1
+        self.last_pos, self.pos = pos, end
+        line = mm[pos:end]
+        if line.endswith(b"\r\n"):
+            line = line[:-2] + b"\n"
+        self.line_count += 1
+        return line.decode("utf-8", errors="replace")
+
+    def push_back(self, line):
+        """Arrange for the next call to next_line() to return "line" again"""
+        self.pos = self.last_pos
+        self.line_count -= 1
+
+    def next_instruction(self):
+        m = INSTRUCTION_BYTES.match(self.mm, self.pos)
+        if m is None:
+            return None
+        self.last_pos, self.pos = self.pos, m.end()
+        self.line_count += 1
+        offset, label_num, opname, operand = m.groups()
+        opname_str = self.opnames.get(opname)
+        if opname_str is None:
+            opname_str = self.opnames[opname] = opname.decode("ascii")
+        return (
+            int(offset),
+            label_num and int(label_num),
+            opname_str,
+            operand.rstrip().decode("utf-8", errors="replace") if operand else "",
+        )
 
 
 if __name__ == "__main__":
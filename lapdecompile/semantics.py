@@ -650,7 +650,11 @@ class SourceWalker(GenericASTTraversal, object):
                     pass
                 arg += 1
             elif typ == "{":
-                d = node.__dict__
+                if isinstance(node, Token):
+                    # Tokens have __slots__ rather than a __dict__.
+                    d = {slot: getattr(node, slot) for slot in Token.__slots__}
+                else:
+                    d = node.__dict__
                 expr = m.group("expr")
                 try:
                     self.write(eval(expr, d, d))
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+  CFG simplification
+
+  An optional pass over the instructions of a function, run once its
+  control-flow graph is built and before the instructions are ingested
+  for the parser. It
+
+   - threads jumps: a jump to a block that does nothing but "goto"
+     somewhere else goes there directly,
+   - drops the blocks that can no longer be reached, and
+   - merges straight-line chains of blocks, by dropping each "goto"
+     to the instruction just after it and the labels that no jump
+     goes to any more.
+
+  Instructions keep their original offsets, so what is said about them
+  later still refers to the code as it was given. What the pass
+  changed is recorded in a Simplification.
+"""
+
+from lapdecompile.bb import JUMP_INSTRUCTIONS
+from lapdecompile.graph import EDGE_FALLTHROUGH
+from lapdecompile.tok import Token
+
+# Instructions that have a label operand but don't end a basic block:
+# they push a handler, which runs at the label.
+HANDLER_INSTRUCTIONS = frozenset(["PUSHCATCH", "PUSHCONDITIONCASE"])
+
+
+class Simplification(object):
+    """
+      What simplify() did to the instructions of a function.
+
+      "threaded" maps the offset of each jump that was threaded to the
+      label it originally went to. "removed" maps the offset of each
+      instruction that was dropped to the offset at which execution
+      continues instead, or to None if it couldn't be reached.
+      "dropped_labels" is the set of label numbers whose LABEL was
+      dropped.
+    """
+
+    def __init__(self):
+        self.threaded = {}
+        self.removed = {}
+        self.dropped_labels = set()
+
+    def __str__(self):
+        return "simplified: %d jumps threaded, %d instructions removed, " \
+            "%d labels dropped" % (
+                len(self.threaded),
+                len(self.removed),
+                len(self.dropped_labels),
+            )
+
+
+def label_indexes(instructions):
+    """Map label numbers to the index of their LABEL in "instructions" """
+    return {
+        inst.attr: i for i, inst in enumerate(instructions) if inst.kind == "LABEL"
+    }
+
+
+def simplify(cfg, instructions):
+    """Simplify "instructions", whose ControlFlowGraph is "cfg". Returns
+    the new list of instructions and a Simplification. Blocks and the
+    CFG have to be rebuilt from the new list."""
+    result = Simplification()
+    labels = label_indexes(instructions)
+    n = len(instructions)
+
+    def goto_target(label):
+        """If the code at "label" is a goto, return its label"""
+        i = labels[label] + 1
+        while i < n and instructions[i].kind == "LABEL":
+            i += 1
+        if i < n and instructions[i].kind == "GOTO":
+            return instructions[i].attr
+        return None
+
+    def thread(label):
+        """Follow gotos from "label", stopping at a goto loop"""
+        seen = set([label])
+        while True:
+            target = goto_target(label)
+            if target is None or target in seen:
+                return label
+            seen.add(target)
+            label = target
+
+    # Thread the jumps. Tokens are copied rather than changed, since
+    # the caller may still hold the original instructions.
+    threaded = list(instructions)
+    for i, inst in enumerate(instructions):
+        if inst.kind in JUMP_INSTRUCTIONS:
+            target = thread(inst.attr)
+            if target != inst.attr:
+                threaded[i] = Token(inst.kind, target, inst.offset, inst.op, inst.label)
+                result.threaded[inst.offset] = inst.attr
+
+    # Find the reachable blocks. Fallthrough edges are as in the CFG;
+    # a block's jump is its last instruction, possibly threaded now.
+    # Handlers aren't in the CFG, so they are taken to be reachable.
+    blocks, csr = cfg.blocks, cfg.csr
+
+    def block_of(label):
+        return instructions[labels[label]].bb.number
+
+    reachable = bytearray(len(blocks))
+    stack = [cfg.entry_node.number]
+    stack.extend(
+        block_of(inst.attr)
+        for inst in instructions
+        if inst.kind in HANDLER_INSTRUCTIONS
+    )
+    while stack:
+        b = stack.pop()
+        if reachable[b]:
+            continue
+        reachable[b] = 1
+        for i in range(csr.succ_start[b], csr.succ_start[b + 1]):
+            if csr.succ_kind[i] == EDGE_FALLTHROUGH:
+                stack.append(csr.succ[i])
+        last = threaded[blocks[b].end_index - 1]
+        if last.kind in JUMP_INSTRUCTIONS:
+            stack.append(block_of(last.attr))
+
+    kept = []
+    for b, block in enumerate(blocks):
+        if reachable[b]:
+            kept.extend(threaded[block.start_index : block.end_index])
+        else:
+            for inst in instructions[block.start_index : block.end_index]:
+                if inst.kind == "LABEL":
+                    result.dropped_labels.add(inst.attr)
+                else:
+                    result.removed[inst.offset] = None
+
+    # Drop gotos to the next instruction, then labels no longer used.
+    # Dropping either can't make anything unreachable.
+    simplified = []
+    for i, inst in enumerate(kept):
+        if inst.kind == "GOTO":
+            j = i + 1
+            following = set()
+            while j < len(kept) and kept[j].kind == "LABEL":
+                following.add(kept[j].attr)
+                j += 1
+            if inst.attr in following and j < len(kept):
+                result.removed[inst.offset] = kept[j].offset
+                continue
+        simplified.append(inst)
+
+    used = set(
+        inst.attr
+        for inst in simplified
+        if inst.kind in JUMP_INSTRUCTIONS or inst.kind in HANDLER_INSTRUCTIONS
+    )
+    instructions = []
+    for inst in simplified:
+        if inst.kind == "LABEL" and inst.attr not in used:
+            result.dropped_labels.add(inst.attr)
+        else:
+            instructions.append(inst)
+    return instructions, result
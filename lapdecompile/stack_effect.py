@@ -1,96 +1,127 @@
 """Compute eval stack effects in running bytecode instructions
+
+Each instruction kind gets a small integer opcode, which the scanner
+stores in Token.op. The tables STACK_POP, STACK_PUSH, STACK_EFFECT and
+JUMP_STACK_EFFECT are lists indexed by that opcode, so that passes
+over the instructions don't have to look the kind up by name.
 """
+import re
 
 STACK_EFFECTS = {
     'add1':           (-1, +1),
+    'aref':           (-2, +1),
     'aset':           (-3, +1),
-    'bobp':           (-2, +1),
+    'assq':           (-2, +1),
+    'bobp':           (-0, +1),
     'bolp':           ( 0, +1),
-
-    'call_0':         (-1, +1), # Generalize by preprocessing
-    'call_1':         (-2, +1),
-    'call_2':         (-3, +1),
-    'call_3':         (-4, +1),
-    'call_4':         (-5, +1),
-    'call_5':         (-6, +1),
-    'call_6':         (-7, +1),
-    'call_7':         (-8, +1),
-    'call_8':         (-9, +1),
-    'call_9':        (-10, +1),
+    'buffer-substring': (-2, +1),
     'car':            (-1, +1),
     'car-safe':       (-1, +1),
+    'catch':          (-2, +1),
     'cdr':            (-1, +1),
     'cdr-safe':       (-1, +1),
+    'char-after':     (-1, +1),
+    'char-syntax':    (-1, +1),
     'come_from':      (-0, +0), # A pseudo instruction
-    'concat_2':       (-2, +1), # Generalize by preprocessing
-    'concat_3':       (-2, +1),
-    'concat_4':       (-3, +1),
-    'concatn_5':      (-4, +1),
-    'concatn_6':      (-5, +1),
-    'concatn_7':      (-6, +1),
+    'condition-case': (-3, +1),
     'cons':           (-2, +1),
     'consp':          (-1, +1),
     'constant':       (-0, +1),
     'current-buffer': (-0, +1),
     'current-column': (-0, +1),
+    'delete-region':  (-2, +1),
     'diff':           (-2, +1),
     'discard':        (-1, +0),
+    'downcase':       (-1, +1),
     'dup':            (-0, +1),
     'elt':            (-2, +1),
-    'end-of-line':    (-1, +0),
+    'end-of-line':    (-1, +1),
     'eobp':           (-0, +1),
     'eolp':           (-0, +1),
     'eq':             (-2, +1),
     'equal':          (-2, +1),
     'eqlsign':        (-2, +1),
+    'expr':           (-0, +1), # A pseudo instruction
     'following-char': (-0, +1),
+    'forward-char':   (-1, +1),
+    'forward-line':   (-1, +1),
+    'forward-word':   (-1, +1),
+    'fset':           (-2, +1),
     'geq':            (-2, +1),
     'get':            (-2, +1),
     'goto':           (-0, +0),
     'goto-char':      (-1, +1),
     'goto-if-nil':    (-1, +0),
     'goto-if-nil-else-pop': ((-1, -1), (0, 1)),
-    'goto-if-not-nil-else-pop': ((-1, -1), (1, 0)),
+    'goto-if-not-nil-else-pop': ((-1, -1), (0, 1)),
     'goto-if-not-nil': (-1, +0),
     'gtr':            (-2, +1),
+    'indent-to':      (-1, +1),
     'insert':         (-1, +1),
     'integerp':       (-1, +1),
+    'interactive-p':  (-0, +1),
     'label':          (-0, +0), # A pseudo instruction
     'length':         (-1, +1),
     'leq':            (-2, +1),
-    'list_1':         (-1, +1), # Generalize by preprocessing
-    'list_2':         (-2, +1),
-    'list_3':         (-3, +1),
-    'list_4':         (-4, +1),
-    'listn_5':        (-5, +1),
+    'listp':          (-1, +1),
     'lss':            (-2, +1),
+    'match-beginning': (-1, +1),
+    'match-end':      (-1, +1),
     'max':            (-2, +1),
+    'member':         (-2, +1),
+    'memq':           (-2, +1),
     'min':            (-2, +1),
     'mult':           (-2, +1),
+    'narrow-to-region': (-2, +1),
     'nconc':          (-2, +1),
+    'negate':         (-1, +1),
     'not':            (-1, +1),
+    'nreverse':       (-1, +1),
+    'nth':            (-2, +1),
+    'nthcdr':         (-2, +1),
+    'numberp':        (-1, +1),
     'plus':           (-2, +1),
     'point':          (-0, +1),
     'point-max':      (-0, +1),
     'point-min':      (-0, +1),
+    'pophandler':     (-0, +0),
     'preceding-char': (-0, +1),
+    'pushcatch':      (-1, +0),
+    'pushconditioncase': (-1, +0),
     'quo':            (-2, +1),
     'rem':            (-2, +1),
     'return':         (-1, +0),
     'save-current-buffer': (-0, +0),
     'save-excursion':  (-0, +0),
-    'save-window-excursion': (-1, +0),
+    'save-restriction': (-0, +0),
+    'save-window-excursion': (-1, +1),
+    'scan-buffer':    (-3, +1), # Obsolete
     'set':            (-2, +1),
     'set-buffer':     (-1, +1),
+    'set-mark':       (-1, +1), # Obsolete
+    'set-marker':     (-3, +1),
+    'setcar':         (-2, +1),
+    'setcdr':         (-2, +1),
+    'skip-chars-backward': (-2, +1),
+    'skip-chars-forward': (-2, +1),
     'stack-ref':      (-0, +1),
     'stack-set':      (-1, +0),
     'stack-access':   (-0, +0), # A pseudo instruction
+    'string<':        (-2, +1),
     'string=':        (-2, +1),
     'stringp':        (-1, +1),
     'sub1':           (-1, +1),
     'substring':      (-3, +1),
+    'switch':         (-2, +0),
+    'symbol-function': (-1, +1),
+    'symbol-value':   (-1, +1),
+    'symbolp':        (-1, +1),
+    'temp-output-buffer-setup': (-1, +1),
+    'temp-output-buffer-show': (-2, +1),
     'unbind':         (-0, +0),
+    'unbind-all':     (-0, +0), # Obsolete
     'unwind-protect': (-1, +0),
+    'upcase':         (-1, +1),
     'varbind':        (-1, +0),
     'varref':         (-0, +1),
     'varset':         (-1, +0),
@@ -98,9 +129,94 @@ STACK_EFFECTS = {
 
 }
 
-STACK_EFFECT = {}
-for k, v in STACK_EFFECTS.items():
-    if isinstance(v[0], tuple):
-        STACK_EFFECT[k] = (v[0][0] + v[1][0], (v[0][1] + v[1][1]))
+# Instructions whose kind carries an argument count, e.g. CALL_12 or
+# LISTN_7, have the count folded into the kind by the scanner.
+# For those we have (extra pops, pushes): "call" pops its arguments
+# and the function, "discardN-preserve-tos" pops and then pushes back
+# the top of stack. Kinds not in STACK_EFFECTS are added from here
+# on first use.
+COUNTED_EFFECTS = {
+    'call':           (1, +1),
+    'concat':         (0, +1),
+    'concatn':        (0, +1),
+    'discardn':       (0, +0),
+    'discardn-preserve-tos': (1, +1),
+    'insertn':        (0, +1),
+    'list':           (0, +1),
+    'listn':          (0, +1),
+}
+COUNTED_KIND = re.compile(r"^(.+)_(\d+)$")
+
+
+class OpcodeError(Exception):
+    def __init__(self, kind):
+        self.kind = kind
+
+    def __str__(self):
+        return "unknown opcode %s" % self.kind
+
+
+# Indexed by opcode.
+OPNAMES = []
+STACK_POP = []
+STACK_PUSH = []
+
+# The stack effect when execution falls through to the next
+# instruction and when a jump is taken. These differ only for
+# CONDITIONAL_POP instructions.
+STACK_EFFECT = []
+JUMP_STACK_EFFECT = []
+
+# Token kind to opcode
+OPCODES = {}
+
+
+def add_opcode(kind, effects):
+    """Assign the next opcode to token kind "kind" whose STACK_EFFECTS
+    entry is "effects", filling in the tables for it."""
+    op = len(OPNAMES)
+    OPNAMES.append(kind)
+    if isinstance(effects[0], tuple):
+        STACK_POP.append(None)
+        STACK_PUSH.append(None)
+        STACK_EFFECT.append(effects[0][0] + effects[1][0])
+        JUMP_STACK_EFFECT.append(effects[0][1] + effects[1][1])
     else:
-        STACK_EFFECT[k] = v[0] + v[1]
+        STACK_POP.append(effects[0])
+        STACK_PUSH.append(effects[1])
+        STACK_EFFECT.append(effects[0] + effects[1])
+        JUMP_STACK_EFFECT.append(effects[0] + effects[1])
+    OPCODES[kind] = op
+    return op
+
+
+def opcode(kind):
+    """Return the opcode of token kind "kind", such as "VARREF" or
+    "CALL_2". Raise OpcodeError if we don't know its stack effect."""
+    op = OPCODES.get(kind)
+    if op is None:
+        m = COUNTED_KIND.match(kind.lower())
+        if m is None or m.group(1) not in COUNTED_EFFECTS:
+            raise OpcodeError(kind)
+        extra, push = COUNTED_EFFECTS[m.group(1)]
+        op = add_opcode(kind, (-(int(m.group(2)) + extra), push))
+    return op
+
+
+for k, v in STACK_EFFECTS.items():
+    add_opcode(k.upper(), v)
+
+OP_CONSTANT = OPCODES["CONSTANT"]
+OP_LABEL = OPCODES["LABEL"]
+
+# Opcodes of the pseudo instructions that control-flow analysis adds
+OP_COME_FROM = OPCODES["COME_FROM"]
+OP_STACK_ACCESS = OPCODES["STACK-ACCESS"]
+# ... and that lapdecompile.prereduce puts in place of an expression
+OP_EXPR = OPCODES["EXPR"]
+
+# Instructions that pop only when they don't jump. STACK_POP and
+# STACK_PUSH are None for these.
+CONDITIONAL_POP = frozenset(
+    [OPCODES["GOTO-IF-NIL-ELSE-POP"], OPCODES["GOTO-IF-NOT-NIL-ELSE-POP"]]
+)
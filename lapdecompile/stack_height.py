@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+  Eval stack heights
+
+  A worklist dataflow analysis over the control-flow graph which finds
+  how deep the evaluation stack is on entry to each basic block, on
+  leaving it, and just before each instruction runs.
+"""
+
+from array import array
+
+from lapdecompile.graph import EDGE_FALLTHROUGH
+from lapdecompile.stack_effect import JUMP_STACK_EFFECT, STACK_EFFECT
+
+
+class StackHeights(object):
+    """
+    Stack heights for the instructions of a ControlFlowGraph.
+
+    Blocks are referred to by their number in the CFG. For block
+    number b, entry[b] is the stack depth on entry and exit[b] the
+    depth when it falls through to the next block. For instruction
+    i, before[i] is the depth just before it runs. The jump taken by
+    a "goto-if-...-else-pop" leaves the stack one deeper than falling
+    through does; that is accounted for on the jump edge.
+
+    Blocks that can't be reached from the entry block are assumed to
+    start with an empty stack and are listed in "unreachable". If paths
+    reach a block with different depths, the first depth found is kept
+    and the block is listed in "conflicts".
+    """
+
+    def __init__(self, cfg, instructions):
+        self.cfg = cfg
+        self.instructions = instructions
+        blocks = cfg.blocks
+        n = len(blocks)
+        self.entry = array("i", [0]) * n
+        self.exit = array("i", [0]) * n
+        self.before = array("i", [0]) * len(instructions)
+        self.unreachable = set()
+        self.conflicts = set()
+        self.analyze()
+
+    def analyze(self):
+        blocks = self.cfg.blocks
+        known = bytearray(len(blocks))
+        for b in range(len(blocks)):
+            if known[b]:
+                continue
+            if b != 0:
+                self.unreachable.add(b)
+            known[b] = 1
+            worklist = [b]
+            while worklist:
+                b = worklist.pop()
+                for s, depth in self.transfer(b):
+                    if not known[s]:
+                        known[s] = 1
+                        self.entry[s] = depth
+                        worklist.append(s)
+                    elif self.entry[s] != depth:
+                        self.conflicts.add(s)
+        for b, block in enumerate(blocks):
+            block.entry_depth = self.entry[b]
+            block.exit_depth = self.exit[b]
+
+    def transfer(self, b):
+        """Compute the instruction depths of block number "b" from its
+        entry depth, and return (successor block number, depth) pairs
+        for the edges out of it."""
+        block = self.cfg.blocks[b]
+        instructions, before = self.instructions, self.before
+        depth = self.entry[b]
+        for i in range(block.start_index, block.end_index):
+            before[i] = depth
+            depth += STACK_EFFECT[instructions[i].op]
+        self.exit[b] = depth
+
+        csr = self.cfg.csr
+        last = block.end_index - 1
+        jump_depth = before[last] + JUMP_STACK_EFFECT[instructions[last].op]
+        edges = []
+        for i in range(csr.succ_start[b], csr.succ_start[b + 1]):
+            if csr.succ_kind[i] == EDGE_FALLTHROUGH:
+                edges.append((csr.succ[i], depth))
+            else:
+                edges.append((csr.succ[i], jump_depth))
+        return edges
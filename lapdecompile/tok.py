@@ -1,15 +1,28 @@
 """Elisp bytecode instruction class. The name "token" reflects our
 compiler-centric terminology.
 """
+from sys import intern
+
+
 class Token:
     """
     Class representing a byte-code instruction.
+
+    A function can have many thousands of these, so there is no
+    per-instance __dict__. Token kinds are interned, which makes the
+    parser's comparisons and hashing of kinds cheap.
     """
+    __slots__ = ("kind", "op", "attr", "offset", "label",
+                 "block_stack_effect", "bb")
+
     def __init__(self, opname, attr=None, offset=-1,
                  op=None, label=None):
-        self.kind = opname
+        self.kind = intern(opname)
         self.op = op
         self.attr = attr
+
+        # The bytecode offset, and the label number if the instruction
+        # is the target of a jump. Both are ints.
         self.offset = offset
         self.label = label
 
@@ -38,22 +51,44 @@ class Token:
     def __str__(self):
         return self.format(line_prefix='')
 
+    def format_offset(self):
+        """The offset as LAP shows it: "offset:label" for the target
+        of a jump"""
+        if self.label is None:
+            return self.offset
+        return "%s:%s" % (self.offset, self.label)
+
+    def jump_sources(self):
+        """The offsets of the jumps a COME_FROM is for. With minimal
+        markers, one COME_FROM stands for all of the jumps to its
+        target and its attr is the tuple of their offsets."""
+        if isinstance(self.attr, tuple):
+            return self.attr
+        return (self.attr,)
+
     def format(self, line_prefix='', sib_num=None):
         if sib_num:
             sib_num = "%d." % sib_num
         else:
             sib_num = ''
         prefix = ('%s%s' % (line_prefix, sib_num))
-        offset_opname = '%5s %-10s' % (self.offset, self.kind)
-        if not self.attr:
+        offset_opname = '%5s %-10s' % (self.format_offset(), self.kind)
+        if self.kind == "LABEL":
+            attr = ":%s" % self.attr
+        elif isinstance(self.attr, tuple):
+            # A COME_FROM for several jumps
+            attr = ", ".join(str(a) for a in self.attr)
+        else:
+            attr = self.attr
+        if not attr:
             if self.block_stack_effect is None:
                 return f"{prefix}{offset_opname}"
             else:
                 return f"{prefix}{offset_opname}\t[{self.block_stack_effect}]"
         if self.block_stack_effect is None:
-            return f"{prefix}{offset_opname} {self.attr}"
+            return f"{prefix}{offset_opname} {attr}"
         else:
-            return f"{prefix}{offset_opname} {self.attr}\t[{self.block_stack_effect}]"
+            return f"{prefix}{offset_opname} {attr}\t[{self.block_stack_effect}]"
 
     def __hash__(self):
         return hash(self.kind)
@@ -10,6 +10,9 @@
   :license: Apache 2, see LICENSE for more details.
 """
 
+from array import array
+from collections import deque
+
 from lapdecompile.graph import Edge
 
 
@@ -48,7 +51,7 @@ class Walker(object):
         self._visitor = value
 
     def traverse(self, root):
-        self.worklist = []
+        self.worklist = deque()
         self.__run(root)
 
     def __run(self, root=None):
@@ -56,7 +59,7 @@ class Walker(object):
         if root is not None:
             self.__process(root)
         while self.worklist:
-            current = self.worklist.pop(0)
+            current = self.worklist.popleft()
             if current in visited:
                 continue
             self.__process(current)
@@ -72,23 +75,106 @@ class Walker(object):
 
         list_edges = cur_node.successors
         for edge in list_edges:
-            self.worklist.insert(0, edge)
-
+            self.worklist.appendleft(edge)
+
+
+# The traversals below take a CSRGraph and a node number in it, and
+# return the nodes reachable from that node as an array of node
+# numbers. They are iterative and take time linear in the size of the
+# graph, so they handle CFGs of any depth. CSRGraph.dfs_preorder,
+# dfs_postorder, reverse_postorder and bfs cache their results.
+
+
+def dfs_nodes(graph, root):
+    """Return the preorder and the postorder of a depth-first search
+    from "root" that follows each node's successors in order."""
+    succ, succ_start = graph.succ, graph.succ_start
+    visited = bytearray(graph.n)
+    visited[root] = 1
+    preorder = array("i", [root])
+    postorder = array("i")
+    # The nodes on the current path, and for each the index in succ
+    # of its next edge to follow.
+    path = [root]
+    next_edge = [succ_start[root]]
+    while path:
+        node = path[-1]
+        i = next_edge[-1]
+        if i < succ_start[node + 1]:
+            next_edge[-1] = i + 1
+            dest_node = succ[i]
+            if not visited[dest_node]:
+                visited[dest_node] = 1
+                preorder.append(dest_node)
+                path.append(dest_node)
+                next_edge.append(succ_start[dest_node])
+        else:
+            postorder.append(node)
+            path.pop()
+            next_edge.pop()
+    return preorder, postorder
+
+
+def dfs_tree(graph, root):
+    """Return the preorder of a depth-first search from "root", and
+    the DFS tree parent of each node in it. Both are indexed by
+    preorder number, and parents are given by preorder number too;
+    the root is its own parent."""
+    succ, succ_start = graph.succ, graph.succ_start
+    number = array("i", [-1]) * graph.n
+    number[root] = 0
+    preorder = array("i", [root])
+    parent = array("i", [0])
+    path = [root]
+    next_edge = [succ_start[root]]
+    while path:
+        node = path[-1]
+        i = next_edge[-1]
+        if i < succ_start[node + 1]:
+            next_edge[-1] = i + 1
+            dest_node = succ[i]
+            if number[dest_node] < 0:
+                number[dest_node] = len(preorder)
+                parent.append(number[node])
+                preorder.append(dest_node)
+                path.append(dest_node)
+                next_edge.append(succ_start[dest_node])
+        else:
+            path.pop()
+            next_edge.pop()
+    return preorder, parent
 
-# Recursive version of the post-order DFS, should only be used
-# when computing dominators on smallish CFGs
-def dfs_postorder_nodes(graph, root):
-    import sys
 
-    sys.setrecursionlimit(5000)
-    visited = set()
+def dfs_preorder_nodes(graph, root):
+    return dfs_nodes(graph, root)[0]
 
-    def _dfs(node, _visited):
-        _visited.add(node)
-        for dest_node in node.successors:
-            if dest_node not in _visited:
-                for child in _dfs(dest_node, _visited):
-                    yield child
-        yield node
 
-    return [n for n in _dfs(root, visited)]
+def dfs_postorder_nodes(graph, root):
+    return dfs_nodes(graph, root)[1]
+
+
+def reverse_postorder_nodes(graph, root):
+    order = dfs_postorder_nodes(graph, root)
+    order.reverse()
+    return order
+
+
+def bfs_nodes(graph, root):
+    """Nodes in the order a breadth-first search from "root" reaches
+    them, following successors in order."""
+    succ, succ_start = graph.succ, graph.succ_start
+    visited = bytearray(graph.n)
+    visited[root] = 1
+    order = array("i", [root])
+    # "order" doubles as the queue: nodes before "head" have had
+    # their successors added.
+    head = 0
+    while head < len(order):
+        node = order[head]
+        head += 1
+        for i in range(succ_start[node], succ_start[node + 1]):
+            dest_node = succ[i]
+            if not visited[dest_node]:
+                visited[dest_node] = 1
+                order.append(dest_node)
+    return order
@@ -0,0 +1,39 @@
+"""What the benches share: the LAP files they run on by default,
+reading their functions, and the parser debug settings that keep the
+parser quiet."""
+import glob
+import os.path as osp
+
+from lapdecompile.__main__ import control_flow
+from lapdecompile.scanner import LapScanner
+
+TOP = osp.dirname(osp.dirname(osp.abspath(__file__)))
+
+PARSER_DEBUG = {
+    "rules": False,
+    "transition": False,
+    "reduce": False,
+    "errorstack": False,
+    "dups": False,
+}
+
+
+def corpus():
+    """Return the paths of the LAP files in test/lap and testdata"""
+    return sorted(
+        glob.glob(osp.join(TOP, "test", "lap", "*.lap"))
+        + glob.glob(osp.join(TOP, "testdata", "*.lap"))
+    )
+
+
+def corpus_functions(paths):
+    """Return (tokens, customize) for each function in the LAP files
+    "paths", with the tokens control_flow() gives the parser"""
+    fns = []
+    for path in paths:
+        with open(path) as fp:
+            for fn in LapScanner(fp).fns.values():
+                name = "%s:%s" % (osp.basename(path), fn.name)
+                tokens = control_flow(name, fn.tokens, False, False, fn.labels)
+                fns.append((tokens, fn.customize))
+    return fns
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""Measure control-flow analysis time on large generated functions.
+
+Builds LAP text for a function made of many consecutive
+"(when a (setq x N))" forms, so that it has a jump and a label per
+form, scans it and times control_flow() on the tokens. Parsing is
+not included.
+
+Usage: bench_control_flow.py [forms ...]
+"""
+import io
+import sys
+import time
+
+from lapdecompile.__main__ import control_flow
+from lapdecompile.scanner import LapScanner
+
+
+def generate_lap(forms):
+    """Return LAP text for a function with "forms" when forms"""
+    lines = ["byte code for bench-when:", "  args: (a)"]
+    offset = 0
+    for i in range(1, forms + 1):
+        label = "%d:%d" % (offset, i - 1) if i > 1 else "%d" % offset
+        lines.append("%s\tvarref\t  a" % label)
+        lines.append("%d\tgoto-if-nil %d" % (offset + 1, i))
+        lines.append("%d\tconstant  %d" % (offset + 4, i))
+        lines.append("%d\tvarset\t  x" % (offset + 5))
+        offset += 6
+    lines.append("%d:%d\tconstant  nil" % (offset, forms))
+    lines.append("%d\treturn\t  " % (offset + 1))
+    return "\n".join(lines) + "\n"
+
+
+def main(sizes):
+    for forms in sizes:
+        fp = io.StringIO(generate_lap(forms))
+        fn = next(iter(LapScanner(fp).fns.values()))
+        start = time.perf_counter()
+        tokens = control_flow(fn.name, fn.tokens, False, False, fn.labels)
+        elapsed = time.perf_counter() - start
+        print(
+            "%7d forms %8d tokens in %8d tokens out %9.3fs"
+            % (forms, len(fn.tokens), len(tokens), elapsed)
+        )
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [100, 1000, 3000])
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Compare the dominator engines on large synthetic control-flow graphs.
+
+For each size, builds a CSRGraph of that many blocks shaped like
+byte-compiled code: a chain of blocks with forward conditional
+branches, loops jumping back, and a sprinkling of gotos into the
+middle of loops, which make the graph irreducible. Each engine in
+dominators.ENGINES is timed on it, and the immediate dominators they
+find are checked to be identical.
+
+Usage: bench_dominators.py [blocks ...]
+"""
+import random
+import sys
+import time
+
+from lapdecompile.dominators import ENGINES
+from lapdecompile.graph import (
+    CSRGraph,
+    EDGE_BACKWARD,
+    EDGE_FALLTHROUGH,
+    EDGE_FORWARD,
+)
+
+
+def synthetic_cfg(blocks, seed=0):
+    """Return a CSRGraph of "blocks" blocks with entry block 0"""
+    rand = random.Random(seed)
+    edges = []
+    for b in range(blocks - 1):
+        edges.append((b, b + 1, EDGE_FALLTHROUGH))
+        r = rand.random()
+        if r < 0.3:
+            # if/when/and/or: skip ahead a little
+            target = min(blocks - 1, b + rand.randint(2, 8))
+            edges.append((b, target, EDGE_FORWARD))
+        elif r < 0.4:
+            # while/dolist: loop back a little
+            target = max(0, b - rand.randint(1, 20))
+            edges.append((b, target, EDGE_BACKWARD))
+        elif r < 0.42:
+            # goto into the middle of some earlier or later code
+            target = rand.randrange(1, blocks)
+            kind = EDGE_FORWARD if target > b else EDGE_BACKWARD
+            edges.append((b, target, kind))
+    return CSRGraph(blocks, edges)
+
+
+def main(sizes):
+    names = sorted(ENGINES)
+    print("%8s %8s " % ("blocks", "edges") + " ".join("%12s" % n for n in names))
+    for blocks in sizes:
+        graph = synthetic_cfg(blocks)
+        times = []
+        idoms = []
+        for name in names:
+            start = time.perf_counter()
+            idoms.append(ENGINES[name](graph, 0))
+            times.append(time.perf_counter() - start)
+        print(
+            "%8d %8d " % (blocks, len(graph.succ))
+            + " ".join("%11.3fs" % t for t in times)
+        )
+        for name, idom in zip(names[1:], idoms[1:]):
+            if idom != idoms[0]:
+                print("%s and %s disagree" % (names[0], name))
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(
+        [int(arg) for arg in sys.argv[1:]] or [10, 100, 1000, 10000, 100000]
+    )
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Compare the tokens ingest() emits, and the time taken to parse them,
+with and without minimal markers.
+
+Each function in the LAP files given, by default those in test/lap and
+testdata, is run through control_flow() both ways and then parsed.
+The totals of tokens, parse time and parse errors are printed for each
+way, along with the functions that parse in one way but not the other.
+
+Usage: bench_ingest.py [lap-file ...]
+"""
+import contextlib
+import io
+import os.path as osp
+import sys
+import time
+
+from bench_common import PARSER_DEBUG, corpus
+
+from spark_parser.ast import AST
+
+from lapdecompile.__main__ import control_flow
+from lapdecompile.parser import ParserError, new_parser
+from lapdecompile.scanner import LapScanner
+
+
+def parse_time(tokens, customize):
+    """Return the time taken to parse "tokens", or None on a parse error"""
+    p = new_parser(AST, tokens, customize=customize)
+    start = time.perf_counter()
+    try:
+        # The parser prints where it went wrong
+        with contextlib.redirect_stdout(io.StringIO()):
+            p.parse(tokens, debug=PARSER_DEBUG)
+    except ParserError:
+        return None
+    return time.perf_counter() - start
+
+
+def main(paths):
+    totals = {False: [0, 0.0, 0], True: [0, 0.0, 0]}
+    differ = []
+    for path in paths:
+        with open(path) as fp:
+            fns = list(LapScanner(fp).fns.values())
+        for fn in fns:
+            name = "%s:%s" % (osp.basename(path), fn.name)
+            parsed = {}
+            for minimal in (False, True):
+                tokens = control_flow(
+                    name, list(fn.tokens), False, False, None,
+                    minimal_markers=minimal,
+                )
+                elapsed = parse_time(tokens, fn.customize)
+                total = totals[minimal]
+                total[0] += len(tokens)
+                if elapsed is None:
+                    total[2] += 1
+                else:
+                    total[1] += elapsed
+                parsed[minimal] = elapsed is not None
+            if parsed[False] != parsed[True]:
+                differ.append((name, parsed[True]))
+
+    print("%-8s %8s %10s %7s" % ("markers", "tokens", "parse", "errors"))
+    for minimal in (False, True):
+        tokens, elapsed, errors = totals[minimal]
+        print(
+            "%-8s %8d %9.3fs %7d"
+            % ("minimal" if minimal else "all", tokens, elapsed, errors)
+        )
+    for name, parses in differ:
+        print("%s only parses %s minimal markers" % (name, "with" if parses else "without"))
+
+
+if __name__ == "__main__":
+    main(
+        sys.argv[1:] or corpus()
+    )
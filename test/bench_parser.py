@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Measure how long it takes to get a parser for each function, and to
+parse it.
+
+Runs control_flow() on every function in the LAP files given, by
+default those in test/lap and testdata, and then gets a parser for
+each function the given number of times, as when decompiling a file
+of many small functions. The time spent constructing parsers and the
+time spent parsing are printed separately, along with how often a
+parser with a reduced grammar was reused.
+
+Usage: bench_parser.py [rounds [lap-file ...]]
+"""
+import contextlib
+import io
+import sys
+import time
+
+from bench_common import PARSER_DEBUG, corpus, corpus_functions
+
+from spark_parser.ast import AST
+
+from lapdecompile.parser import ParserError, new_parser, reduced_parsers
+
+
+def main(rounds, paths):
+    fns = corpus_functions(paths)
+
+    construct = parse = 0.0
+    for _ in range(rounds):
+        for tokens, customize in fns:
+            start = time.perf_counter()
+            p = new_parser(AST, tokens, customize=customize)
+            construct += time.perf_counter() - start
+            start = time.perf_counter()
+            try:
+                # The parser prints where it went wrong
+                with contextlib.redirect_stdout(io.StringIO()):
+                    p.parse(tokens, debug=PARSER_DEBUG)
+            except ParserError:
+                pass
+            parse += time.perf_counter() - start
+    print(
+        "%d functions x %d rounds: construct %.3fs, parse %.3fs"
+        % (len(fns), rounds, construct, parse)
+    )
+    print(
+        "reduced grammars: %d hits, %d misses, %d kept"
+        % (reduced_parsers.hits, reduced_parsers.misses, len(reduced_parsers.parsers))
+    )
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 10,
+        sys.argv[2:] or corpus(),
+    )
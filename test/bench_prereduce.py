@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Measure what pre-reducing simple expressions saves the parser.
+
+Runs control_flow() on every function in the LAP files given, by
+default those in test/lap and testdata, and then parses each function
+the given number of times, as is and after prereduce(). The number of
+tokens the parser sees and the time spent are printed for both, with
+the time prereduce() itself takes counted in. The trees are checked
+to be the same.
+
+Usage: bench_prereduce.py [rounds [lap-file ...]]
+"""
+import contextlib
+import io
+import sys
+import time
+
+from bench_common import PARSER_DEBUG, corpus, corpus_functions
+
+from spark_parser.ast import AST
+
+from lapdecompile.parser import ParserError, new_parser
+from lapdecompile.prereduce import prereduce
+
+
+def parse(tokens, customize):
+    p = new_parser(AST, tokens, customize=customize)
+    try:
+        # The parser prints where it went wrong
+        with contextlib.redirect_stdout(io.StringIO()):
+            return str(p.parse(tokens, debug=PARSER_DEBUG))
+    except ParserError:
+        return None
+
+
+def main(rounds, paths):
+    fns = corpus_functions(paths)
+
+    counts = [0, 0]
+    times = [0.0, 0.0]
+    differ = 0
+    for _ in range(rounds):
+        for tokens, customize in fns:
+            start = time.perf_counter()
+            tree = parse(tokens, customize)
+            times[0] += time.perf_counter() - start
+            start = time.perf_counter()
+            reduced = prereduce(AST, tokens)
+            reduced_tree = parse(reduced, customize)
+            times[1] += time.perf_counter() - start
+            counts[0] += len(tokens)
+            counts[1] += len(reduced)
+            differ += tree != reduced_tree
+    print("%d functions x %d rounds" % (len(fns), rounds))
+    print("as is:       %8d tokens %8.3fs" % (counts[0], times[0]))
+    print("prereduced:  %8d tokens %8.3fs" % (counts[1], times[1]))
+    if differ:
+        print("%d trees differ" % differ)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 10,
+        sys.argv[2:] or corpus(),
+    )
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Measure what rejecting control constructs that cross a region saves
+the parser.
+
+Runs control_flow() on every function in the LAP files given, by
+default those in test/lap and testdata, with and without regions, and
+parses each function the given number of times both ways, alternating
+which goes first. The time spent parsing and the number of reductions
+rejected for crossing a region are printed. The trees are checked to
+be the same.
+
+Usage: bench_regions.py [rounds [lap-file ...]]
+"""
+import contextlib
+import io
+import os.path as osp
+import sys
+import time
+
+from bench_common import PARSER_DEBUG, corpus
+
+from spark_parser.ast import AST
+
+from lapdecompile.__main__ import control_flow
+from lapdecompile.parser import ElispParser, ParserError, new_parser
+from lapdecompile.scanner import LapScanner
+
+
+def parse(tokens, customize, use_regions):
+    p = new_parser(AST, tokens, use_regions, customize)
+    try:
+        # The parser prints where it went wrong
+        with contextlib.redirect_stdout(io.StringIO()):
+            return str(p.parse(tokens, debug=PARSER_DEBUG))
+    except ParserError:
+        return None
+
+
+def main(rounds, paths):
+    fns = []
+    for path in paths:
+        with open(path) as fp:
+            for fn in LapScanner(fp).fns.values():
+                name = "%s:%s" % (osp.basename(path), fn.name)
+                tokens = [
+                    control_flow(
+                        name, list(fn.tokens), False, False, fn.labels,
+                        use_regions=use_regions,
+                    )
+                    for use_regions in (False, True)
+                ]
+                fns.append((tokens, fn.customize))
+
+    crosses_region = ElispParser.crosses_region
+    rejected = [0]
+
+    def counted(tokens, first, last):
+        crosses = crosses_region(tokens, first, last)
+        rejected[0] += crosses
+        return crosses
+
+    ElispParser.crosses_region = staticmethod(counted)
+
+    times = [0.0, 0.0]
+    differ = 0
+    for i in range(rounds):
+        for tokens, customize in fns:
+            trees = [None, None]
+            for use_regions in (i % 2, 1 - i % 2):
+                start = time.perf_counter()
+                trees[use_regions] = parse(tokens[use_regions], customize, use_regions)
+                times[use_regions] += time.perf_counter() - start
+            differ += trees[0] != trees[1]
+    print("%d functions x %d rounds" % (len(fns), rounds))
+    print("without regions  %8.3fs" % times[0])
+    print("with regions     %8.3fs, %d reductions rejected" % (times[1], rejected[0]))
+    if differ:
+        print("%d trees differ" % differ)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 10,
+        sys.argv[2:] or corpus(),
+    )
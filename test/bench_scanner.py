@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Measure LapScanner throughput.
+
+Reports lines/second and tokens/second over the LAP files in test/lap
+and over a large synthetic file made by concatenating those files
+many times, for both the line-based and the memory-mapped scanner.
+
+Usage: bench_scanner.py [copies]
+"""
+import os
+import os.path as osp
+import sys
+import tempfile
+import time
+
+from lapdecompile.scanner import LapScanner, MmapLapScanner
+
+lapdir = osp.join(osp.dirname(os.path.realpath(__file__)), "lap")
+
+
+def scan(scanner_class, path, repeat=1):
+    """Scan "path" "repeat" times and return the best time along
+    with the number of lines and tokens seen in one scan."""
+    best = None
+    for _ in range(repeat):
+        tokens = 0
+        start = time.perf_counter()
+        with open(path, "r") as fp:
+            scanner = scanner_class(fp, lazy=True)
+            for fn in scanner.fn_scanner():
+                tokens += len(fn.tokens)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, scanner.line_count, tokens
+
+
+def report(title, elapsed, lines, tokens):
+    print(
+        "%-40s %8d lines %8d tokens %8.3fs %10.0f lines/s %10.0f tokens/s"
+        % (title, lines, tokens, elapsed, lines / elapsed, tokens / elapsed)
+    )
+
+
+def main(copies):
+    lap_files = sorted(
+        osp.join(lapdir, f) for f in os.listdir(lapdir) if f.endswith(".lap")
+    )
+
+    for scanner_class in (LapScanner, MmapLapScanner):
+        tot_time = tot_lines = tot_tokens = 0
+        for path in lap_files:
+            elapsed, lines, tokens = scan(scanner_class, path, repeat=5)
+            tot_time += elapsed
+            tot_lines += lines
+            tot_tokens += tokens
+        report(
+            "%s test/lap (%d files)" % (scanner_class.__name__, len(lap_files)),
+            tot_time,
+            tot_lines,
+            tot_tokens,
+        )
+
+    fd, synthetic = tempfile.mkstemp(prefix="lap-bench-", suffix=".lap")
+    try:
+        with os.fdopen(fd, "w") as out:
+            for _ in range(copies):
+                for path in lap_files:
+                    with open(path, "r") as fp:
+                        text = fp.read()
+                    out.write(text if text.endswith("\n") else text + "\n")
+        for scanner_class in (LapScanner, MmapLapScanner):
+            elapsed, lines, tokens = scan(scanner_class, synthetic)
+            report(
+                "%s synthetic (%d copies)" % (scanner_class.__name__, copies),
+                elapsed,
+                lines,
+                tokens,
+            )
+    finally:
+        os.unlink(synthetic)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
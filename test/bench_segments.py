@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Compare parsing a long function body at once and in segments.
+
+For each size, writes the LAP of a top-level body of that many
+statements, like those of a large init file: calls to global-set-key,
+setqs, and now and then a "when". The body is parsed whole, and with
+parse_segments(), and the time each takes is printed. The two trees
+are checked to be the same.
+
+Usage: bench_segments.py [statements ...]
+"""
+import contextlib
+import io
+import sys
+import time
+
+from bench_common import PARSER_DEBUG
+
+from spark_parser.ast import AST
+
+from lapdecompile.__main__ import control_flow
+from lapdecompile.parser import new_parser, parse_segments
+from lapdecompile.scanner import LapScanner
+
+
+def synthetic_lap(statements):
+    """Return LAP text for a body of "statements" statements"""
+    lines = ["byte code:", "  args: nil"]
+    offset = label = 0
+
+    def emit(op, arg=None):
+        nonlocal offset
+        lines.append("%d\t%s\t  %s" % (offset, op, "" if arg is None else arg))
+        offset += 1
+
+    for i in range(statements):
+        if i % 10 == 9:
+            # (when flag-i (setq var-i i))
+            label += 1
+            emit("varref", "flag-%d" % i)
+            emit("goto-if-nil", label)
+            emit("constant", i)
+            emit("varset", "var-%d" % i)
+            lines.append("%d:%d\tconstant  nil" % (offset, label))
+            offset += 1
+            emit("discard")
+        elif i % 2:
+            emit("constant", i)
+            emit("varset", "var-%d" % i)
+        else:
+            emit("constant", "global-set-key")
+            emit("constant", '"key-%d"' % i)
+            emit("constant", "command-%d" % i)
+            emit("call", 2)
+            emit("discard")
+    emit("constant", "nil")
+    emit("return")
+    return "\n".join(lines) + "\n"
+
+
+def main(sizes):
+    print("%10s %8s %10s %10s" % ("statements", "tokens", "whole", "segments"))
+    for statements in sizes:
+        fn = next(iter(LapScanner(io.StringIO(synthetic_lap(statements))).fns.values()))
+        tokens = control_flow(fn.name, fn.tokens, False, False, fn.labels)
+        times = []
+        trees = []
+        for segmented in (False, True):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                if segmented:
+                    ast = parse_segments(AST, tokens, fn.customize, debug=PARSER_DEBUG)
+                else:
+                    p = new_parser(AST, tokens, customize=fn.customize)
+                    ast = p.parse(tokens, debug=PARSER_DEBUG)
+            times.append(time.perf_counter() - start)
+            trees.append(str(ast))
+        print(
+            "%10d %8d %9.3fs %9.3fs" % (statements, len(tokens), times[0], times[1])
+        )
+        if trees[0] != trees[1]:
+            print("the trees differ")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [50, 100, 200, 300])
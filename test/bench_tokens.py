@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Measure the memory used per Token on the test corpus.
+
+Scans every LAP file in test/lap and testdata, runs control-flow
+analysis on each function (which adds COME_FROM and STACK-ACCESS
+tokens), and reports the number of tokens and the bytes allocated per
+token while they are alive. The figures include what the tokens
+refer to, such as attribute strings and, after control-flow analysis,
+basic blocks.
+
+Usage: bench_tokens.py [copies]
+"""
+import sys
+import tracemalloc
+
+from bench_common import corpus, corpus_functions
+
+from lapdecompile.scanner import LapScanner
+from lapdecompile.tok import Token
+
+
+def scanned_tokens(path):
+    with open(path, "r") as fp:
+        scanner = LapScanner(fp)
+    return [fn.tokens for fn in scanner.fns.values()]
+
+
+def ingested_tokens(path):
+    return [tokens for tokens, _ in corpus_functions([path])]
+
+
+def measure(title, files, copies, get_streams):
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    streams = []
+    for _ in range(copies):
+        for path in files:
+            streams.extend(get_streams(path))
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    token_count = sum(len(tokens) for tokens in streams)
+    print(
+        "%-16s %7d tokens %7.1f bytes/token"
+        % (title, token_count, (used - base) / token_count)
+    )
+
+
+def main(copies):
+    files = corpus()
+    print("%d files x %d copies" % (len(files), copies))
+    measure("scanned", files, copies, scanned_tokens)
+    measure("after ingest", files, copies, ingested_tokens)
+    print("sizeof(Token): %d bytes" % sys.getsizeof(Token("VARREF", "x", 0)))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""Check the CFG analyses built on dominators against brute force.
+
+Builds ControlFlowGraphs from random basic blocks, which jump anywhere
+and may or may not fall through, and checks against computations from
+the definitions:
+
+- the dominance frontier of a is the set of blocks b with a
+  predecessor that a dominates, which a doesn't strictly dominate;
+- a block is post-dominated by the blocks whose removal keeps it from
+  reaching the virtual exit of reverse_flowgraph(), and every block
+  has a post-dominator;
+- for each edge a -> s, the blocks that post-dominate s but don't
+  strictly post-dominate a are control dependent on a, through an
+  edge of the same kind.
+
+Usage: check_cfg.py [graphs [seed]]
+"""
+import random
+import sys
+
+from check_dominators import brute_force_idom, dominator_sets
+
+from lapdecompile.bb import BasicBlock
+from lapdecompile.cfg import ControlFlowGraph
+from lapdecompile.graph import BB_NOFOLLOW
+
+
+def random_cfg(rand):
+    """Return a ControlFlowGraph of random BasicBlocks"""
+    n = rand.randint(1, 30)
+    blocks = []
+    for b in range(n):
+        jumps = set(rand.randrange(n) * 2 for _ in range(rand.choice([0, 0, 1, 1, 2])))
+        flags = set()
+        if b == n - 1:
+            follow_offset = None
+        else:
+            follow_offset = (b + 1) * 2
+            if jumps and rand.random() < 0.5:
+                flags.add(BB_NOFOLLOW)
+        blocks.append(
+            BasicBlock(b * 2, b * 2 + 1, follow_offset, 0, flags, jumps)
+        )
+    return ControlFlowGraph(blocks)
+
+
+def check(cfg):
+    """Return a list of the ways the analyses of "cfg" are wrong"""
+    errors = []
+    csr = cfg.csr
+    n = csr.n
+    entry = cfg.entry_node.number
+
+    doms = dominator_sets(csr, entry)
+    df = cfg.dominance_frontiers()
+    for a in range(n):
+        expected = set()
+        if a in doms:
+            for b in doms:
+                if a in doms[b] and a != b:
+                    continue
+                if any(p in doms and a in doms[p] for p in csr.predecessors(b)):
+                    expected.add(b)
+        if df[a] != expected:
+            errors.append("DF(%d) is %s, expected %s" % (a, sorted(df[a]), sorted(expected)))
+
+    reverse, exit = cfg.reverse_flowgraph()
+    pdom = cfg.post_dominators()
+    expected = brute_force_idom(reverse, exit)
+    if list(pdom.idom) != expected:
+        errors.append("ipdom is %s, expected %s" % (list(pdom.idom), expected))
+    if -1 in pdom.idom:
+        errors.append("some block has no post-dominator: %s" % list(pdom.idom))
+
+    pdoms = dominator_sets(reverse, exit)
+    expected = []
+    for a, s, kind in csr.edges():
+        for b in range(n):
+            if s in pdoms and b in pdoms[s] and not (b != a and b in pdoms[a]):
+                expected.append((a, b, kind))
+    cdg = sorted(cfg.control_dependence().edges())
+    if cdg != sorted(expected):
+        errors.append("CDG is %s, expected %s" % (cdg, sorted(expected)))
+    return errors
+
+
+def main(graphs, seed):
+    rand = random.Random(seed)
+    failures = 0
+    for i in range(graphs):
+        cfg = random_cfg(rand)
+        errors = check(cfg)
+        if errors:
+            failures += 1
+            print("graph %d, edges %s:" % (i, list(cfg.csr.edges())))
+            for error in errors:
+                print("  " + error)
+    print("%d graphs, %d failures" % (graphs, failures))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 0,
+    )
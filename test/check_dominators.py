@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Check the dominator engines against a brute-force computation.
+
+Builds random CSRGraphs of a few to a few dozen nodes, with arbitrary
+edges, self loops and nodes unreachable from the entry, and checks
+that each engine in dominators.ENGINES finds the immediate dominators
+given by the definition: d dominates v if v can't be reached from the
+entry once d is taken out, and v's immediate dominator is the one of
+its strict dominators that the others dominate.
+
+Usage: check_dominators.py [graphs [seed]]
+"""
+import random
+import sys
+
+from lapdecompile.dominators import ENGINES
+from lapdecompile.graph import CSRGraph, EDGE_BACKWARD, EDGE_FORWARD
+
+
+def random_graph(rand):
+    """Return a random CSRGraph and its entry node"""
+    n = rand.randint(1, 40)
+    edges = []
+    for _ in range(rand.randint(0, 3 * n)):
+        a, b = rand.randrange(n), rand.randrange(n)
+        edges.append((a, b, EDGE_FORWARD if b > a else EDGE_BACKWARD))
+    return CSRGraph(n, edges), rand.randrange(n)
+
+
+def reached(graph, entry, removed=None):
+    """Return the set of nodes reached from "entry" without going
+    through "removed" """
+    if entry == removed:
+        return set()
+    seen = set([entry])
+    stack = [entry]
+    while stack:
+        v = stack.pop()
+        for s in graph.successors(v):
+            if s != removed and s not in seen:
+                seen.add(s)
+                stack.append(s)
+    return seen
+
+
+def dominator_sets(graph, entry):
+    """Return a dict of the dominators of each node reachable from
+    "entry", by the definition"""
+    reachable = reached(graph, entry)
+    doms = dict((v, set([v])) for v in reachable)
+    for d in reachable:
+        cut = reached(graph, entry, d)
+        for v in reachable - cut:
+            doms[v].add(d)
+    return doms
+
+
+def brute_force_idom(graph, entry):
+    """Return the immediate dominators of "graph" as the engines do:
+    a list with the entry's own number for the entry, and -1 for
+    unreachable nodes"""
+    idom = [-1] * graph.n
+    doms = dominator_sets(graph, entry)
+    for v in doms:
+        if v == entry:
+            idom[v] = v
+            continue
+        # Dominators of a node are a chain; the closest one has the
+        # most dominators of its own.
+        idom[v] = max(doms[v] - set([v]), key=lambda d: len(doms[d]))
+    return idom
+
+
+def main(graphs, seed):
+    rand = random.Random(seed)
+    failures = 0
+    for i in range(graphs):
+        graph, entry = random_graph(rand)
+        expected = brute_force_idom(graph, entry)
+        for name, engine in sorted(ENGINES.items()):
+            idom = list(engine(graph, entry))
+            if idom != expected:
+                failures += 1
+                print("graph %d: %s got %s, expected %s" % (i, name, idom, expected))
+                print("  entry %d, edges %s" % (entry, list(graph.edges())))
+    print("%d graphs, %d engines, %d failures" % (graphs, len(ENGINES), failures))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 0,
+    )
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""Check the loop-nesting forest against brute force.
+
+Builds ControlFlowGraphs from random basic blocks, as check_cfg.py
+does, and checks that in cfg.loops():
+
+- every loop is strongly connected;
+- a loop is irreducible exactly when it can be entered other than
+  through its header, and the header of a reducible loop dominates
+  its blocks;
+- the latches of a loop are its blocks with an edge to the header,
+  and its exits are its blocks with an edge out of it;
+- every back edge, an edge to a block that dominates its source,
+  goes from a latch of a loop to that loop's header;
+- a reachable block is in a loop exactly when it is on a cycle;
+- loops nest: a loop's blocks are in its parent, one deeper, and
+  loop_of[b] is the innermost loop with b.
+
+Usage: check_loops.py [graphs [seed]]
+"""
+import random
+import sys
+
+from check_cfg import random_cfg
+from check_dominators import dominator_sets, reached
+
+from lapdecompile.graph import BB_LOOP
+
+
+def reaches_within(csr, a, b, blocks):
+    """Can "a" reach "b" by a path of at least one edge that stays in
+    "blocks"?"""
+    seen = set()
+    stack = [a]
+    while stack:
+        v = stack.pop()
+        for s in csr.successors(v):
+            if s == b:
+                return True
+            if s in blocks and s not in seen:
+                seen.add(s)
+                stack.append(s)
+    return False
+
+
+def check(cfg):
+    """Return a list of the ways the loops of "cfg" are wrong"""
+    errors = []
+    csr = cfg.csr
+    entry = cfg.entry_node.number
+    reachable = reached(csr, entry)
+    doms = dominator_sets(csr, entry)
+    forest = cfg.loops()
+    loops = forest.loops
+
+    for loop in loops:
+        h, blocks = loop.header, loop.blocks
+        for b in blocks:
+            if not (reaches_within(csr, h, b, blocks) and reaches_within(csr, b, h, blocks)):
+                errors.append("%r: %d and the header aren't on a cycle" % (loop, b))
+        entered = any(
+            p in reachable and p not in blocks
+            for b in blocks - set([h])
+            for p in csr.predecessors(b)
+        )
+        if entered != loop.irreducible:
+            errors.append("%r: entered other than at the header: %s" % (loop, entered))
+        if not loop.irreducible and not all(h in doms[b] for b in blocks):
+            errors.append("%r: the header doesn't dominate the loop" % loop)
+        latches = set(b for b in blocks if h in csr.successors(b))
+        if loop.latches != latches:
+            errors.append("%r: latches %s, expected %s" % (loop, loop.latches, latches))
+        exits = set(b for b in blocks if any(s not in blocks for s in csr.successors(b)))
+        if loop.exits != exits:
+            errors.append("%r: exits %s, expected %s" % (loop, loop.exits, exits))
+        if loop.parent is None:
+            if loop.depth != 1:
+                errors.append("%r: outermost loop at depth %d" % (loop, loop.depth))
+        elif not (blocks < loop.parent.blocks and loop.depth == loop.parent.depth + 1):
+            errors.append("%r: doesn't nest in %r" % (loop, loop.parent))
+
+    for a, h, _ in csr.edges():
+        if a in doms and h in doms[a]:
+            header_loops = [loop for loop in loops if loop.header == h and a in loop.latches]
+            if not header_loops:
+                errors.append("back edge %d -> %d isn't from a latch" % (a, h))
+
+    for b in range(csr.n):
+        on_cycle = b in reachable and reaches_within(csr, b, b, reachable)
+        i = forest.loop_of[b]
+        if on_cycle != (i >= 0):
+            errors.append("block %d: on a cycle %s, loop_of %d" % (b, on_cycle, i))
+        if i >= 0:
+            loop = loops[i]
+            if b not in loop.blocks or any(b in c.blocks for c in loop.children):
+                errors.append("block %d: %r isn't its innermost loop" % (b, loop))
+        is_header = any(loop.header == b for loop in loops)
+        if is_header != (BB_LOOP in cfg.blocks[b].flags):
+            errors.append("block %d: header %s, flags %s" % (b, is_header, cfg.blocks[b].flags))
+    return errors
+
+
+def main(graphs, seed):
+    rand = random.Random(seed)
+    failures = 0
+    for i in range(graphs):
+        cfg = random_cfg(rand)
+        errors = check(cfg)
+        if errors:
+            failures += 1
+            print("graph %d, edges %s:" % (i, list(cfg.csr.edges())))
+            for error in errors:
+                print("  " + error)
+    print("%d graphs, %d failures" % (graphs, failures))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 0,
+    )